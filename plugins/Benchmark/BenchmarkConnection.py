@@ -0,0 +1,166 @@
+import os
+import io
+import time
+import shutil
+import socket
+import collections
+
+import gevent
+
+from Plugin import PluginManager
+from Config import config
+
+
+@PluginManager.registerTo("Actions")
+class ActionsPlugin:
+    # Request mix of the synthetic peers (roughly the ratio of commands on a busy node)
+    peer_benchmark_mix = (
+        "getFile", "streamFile", "getFile", "listModified", "getFile",
+        "pex", "streamFile", "getFile", "update", "listModified"
+    )
+
+    def getBenchmarkTests(self, online=False):
+        tests = super().getBenchmarkTests(online)
+        tests.extend([
+            {"func": self.testPeerProtocol, "kwargs": {"num_peers": 10}, "num": 2000, "time_standard": 1.5}
+        ])
+        return tests
+
+    def getFreePort(self, ip="127.0.0.1"):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind((ip, 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+    # Create and sign a site with a small and a large file to serve
+    def createBenchmarkSite(self):
+        from Crypt import CryptBitcoin
+        from Site.Site import Site
+        from Site import SiteManager
+
+        SiteManager.site_manager.list()  # Plugins expect the site list to be loaded
+        privatekey = CryptBitcoin.newPrivatekey()
+        address = CryptBitcoin.privatekeyToAddress(privatekey)
+        site_dir = "%s/%s" % (config.data_dir, address)
+        os.makedirs(site_dir + "/data")
+        with open(site_dir + "/data/small.bin", "wb") as file:
+            file.write(os.urandom(16 * 1024))
+        with open(site_dir + "/data/big.bin", "wb") as file:
+            file.write(os.urandom(1024 * 1024))
+
+        settings = {"own": True, "serving": True, "permissions": [], "cache": {}}  # Don't touch sites.json
+        site = Site(address, settings=settings)
+        site.content_manager.sign(privatekey=privatekey)
+        return site
+
+    def deleteBenchmarkSite(self, site):
+        site.content_manager.contents.db.deleteSite(site)
+        shutil.rmtree(site.storage.directory, ignore_errors=True)
+
+    # Start a FileServer on loopback and send num_requests request from num_peers synthetic peers
+    # Return: {cmd: {"num": requests, "times": [latency, ...], "bytes": received bytes, "errors": failed requests}}, time taken
+    def runPeerBenchmark(self, num_peers=10, num_requests=1000, on_progress=None):
+        from File import FileServer
+        from Connection import ConnectionServer
+        from Peer import Peer
+
+        site = self.createBenchmarkSite()
+        server = FileServer("127.0.0.1", self.getFreePort())
+        server.sites = {site.address: site}
+        site.connection_server = server
+        ConnectionServer.start(server, check_connections=False)
+        thread_listen = gevent.spawn(ConnectionServer.listen, server)
+
+        content = site.content_manager.contents["content.json"]
+        content_body = site.storage.read("content.json")
+        params = {
+            "getFile": {"site": site.address, "inner_path": "data/small.bin", "location": 0},
+            "streamFile": {"site": site.address, "inner_path": "data/big.bin", "location": 0, "read_bytes": 512 * 1024},
+            "listModified": {"site": site.address, "since": 0},
+            "pex": {"site": site.address, "peers": [], "need": 5},
+            "update": {"site": site.address, "inner_path": "content.json", "modified": content["modified"], "body": content_body}
+        }
+
+        stats = collections.defaultdict(lambda: {"num": 0, "times": [], "bytes": 0, "errors": 0})
+
+        def peerWorker(peer_i, num):
+            client = ConnectionServer("127.0.0.1", 0)
+            peer = Peer(server.ip, server.port, connection_server=client)
+            for i in range(num):
+                cmd = self.peer_benchmark_mix[(peer_i + i) % len(self.peer_benchmark_mix)]
+                # Updates of the same file are rate limited per connection, so send them on new connection like publishers do
+                if cmd == "update" and peer.connection:
+                    peer.connection.close("Benchmark update")
+                if cmd == "streamFile":
+                    stream_to = io.BytesIO()
+                else:
+                    stream_to = None
+                if peer.connection and not peer.connection.closed:
+                    bytes_recv_before = peer.connection.bytes_recv
+                else:
+                    bytes_recv_before = 0
+                s = time.time()
+                res = peer.request(cmd, params[cmd], stream_to=stream_to)
+                taken = time.time() - s
+                stat = stats[cmd]
+                stat["num"] += 1
+                if not res or "error" in res:
+                    stat["errors"] += 1
+                else:
+                    stat["times"].append(taken)
+                    stat["bytes"] += max(0, peer.connection.bytes_recv - bytes_recv_before)
+                if on_progress:
+                    on_progress()
+            client.closeConnections()
+
+        s = time.time()
+        try:
+            threads = [
+                gevent.spawn(peerWorker, peer_i, num_requests // num_peers + (peer_i < num_requests % num_peers))
+                for peer_i in range(num_peers)
+            ]
+            gevent.joinall(threads, raise_error=True)
+            time_taken = time.time() - s
+        finally:
+            server.stop()
+            server.closeConnections()
+            thread_listen.kill()
+            self.deleteBenchmarkSite(site)
+
+        return dict(stats), time_taken
+
+    def getPercentile(self, times, percent):
+        if not times:
+            return 0.0
+        times = sorted(times)
+        return times[min(len(times) - 1, int(len(times) * percent / 100))]
+
+    def testPeerProtocol(self, num_run=1, num_peers=10):
+        """
+        Test FileServer request handling using synthetic peers on loopback
+        """
+        yield "x %s peers " % num_peers
+        progress = []
+
+        stats_thread = gevent.spawn(self.runPeerBenchmark, num_peers, num_run, lambda: progress.append("."))
+        while not stats_thread.ready():
+            stats_thread.join(timeout=0.1)
+            while progress:
+                yield progress.pop()
+        stats, time_taken = stats_thread.get()
+
+        num_errors = 0
+        yield "\n"
+        for cmd in self.peer_benchmark_mix:
+            if cmd not in stats:
+                continue
+            stat = stats.pop(cmd)
+            num_errors += stat["errors"]
+            yield "  - %-12s %5s req, %7.1f req/s, p50: %6.2fms, p99: %6.2fms, %8.1f KB/s, errors: %s\n" % (
+                cmd, stat["num"], stat["num"] / time_taken,
+                self.getPercentile(stat["times"], 50) * 1000, self.getPercentile(stat["times"], 99) * 1000,
+                stat["bytes"] / 1024 / time_taken, stat["errors"]
+            )
+        yield "  - Total: %.1f req/s" % (num_run / time_taken)
+        assert num_errors == 0, "%s requests failed" % num_errors
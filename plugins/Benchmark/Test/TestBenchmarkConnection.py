@@ -0,0 +1,37 @@
+import os
+
+import pytest
+
+from Benchmark import BenchmarkConnection
+from Config import config
+
+
+@pytest.mark.usefixtures("resetSettings")
+class TestBenchmarkConnection:
+    def testPeerBenchmark(self):
+        actions = BenchmarkConnection.ActionsPlugin()
+        data_dir_before = os.listdir(config.data_dir)
+        stats, time_taken = actions.runPeerBenchmark(num_peers=3, num_requests=100)
+
+        assert time_taken > 0
+        assert sorted(stats.keys()) == sorted(set(actions.peer_benchmark_mix))
+        assert sum(stat["num"] for stat in stats.values()) == 100
+        assert sum(stat["errors"] for stat in stats.values()) == 0
+        assert len(stats["getFile"]["times"]) == stats["getFile"]["num"]
+        assert stats["getFile"]["bytes"] > stats["getFile"]["num"] * 16 * 1024
+        assert stats["streamFile"]["bytes"] > stats["streamFile"]["num"] * 512 * 1024
+
+        # Benchmark site removed
+        dirs_added = [
+            name for name in set(os.listdir(config.data_dir)) - set(data_dir_before)
+            if os.path.isdir("%s/%s" % (config.data_dir, name))
+        ]
+        assert not dirs_added
+
+    def testPeerProtocol(self):
+        actions = BenchmarkConnection.ActionsPlugin()
+        output = "".join(actions.testPeerProtocol(20, num_peers=2))
+        assert output.count(".") >= 20
+        for cmd in set(actions.peer_benchmark_mix):
+            assert "- %s" % cmd in output
+        assert "p99" in output
@@ -0,0 +1 @@
+from src.Test.conftest import *
\ No newline at end of file
@@ -1,4 +1,8 @@
 import array
+import re
+
+
+run_max = 10000  # Longer runs are rejected by unpackPiecefield
 
 
 def packPiecefield(data):
@@ -9,24 +13,15 @@ def packPiecefield(data):
     if not data:
         return array.array("H", b"")
 
-    if data[0] == b"\x00":
-        res.append(0)
-        find = b"\x01"
-    else:
-        find = b"\x00"
-    last_pos = 0
-    pos = 0
-    while 1:
-        pos = data.find(find, pos)
-        if find == b"\x00":
-            find = b"\x01"
-        else:
-            find = b"\x00"
-        if pos == -1:
-            res.append(len(data) - last_pos)
-            break
-        res.append(pos - last_pos)
-        last_pos = pos
+    if data[0] == 0:
+        res.append(0)  # Runs starts with the number of downloaded pieces
+
+    for run in re.finditer(b"\x00+|[^\x00]+", data):
+        run_len = run.end() - run.start()
+        while run_len > run_max:  # Split to run_max long parts separated by empty runs
+            res += [run_max, 0]
+            run_len -= run_max
+        res.append(run_len)
     return array.array("H", res)
 
 
@@ -34,17 +29,10 @@ def unpackPiecefield(data):
     if not data:
         return b""
 
-    res = []
-    char = b"\x01"
-    for times in data:
-        if times > 10000:
-            return b""
-        res.append(char * times)
-        if char == b"\x01":
-            char = b"\x00"
-        else:
-            char = b"\x01"
-    return b"".join(res)
+    if max(data) > run_max:
+        return b""
+
+    return b"".join([b"\x00" * times if i % 2 else b"\x01" * times for i, times in enumerate(data)])
 
 
 def spliceBit(data, idx, bit):
@@ -55,39 +43,86 @@ def spliceBit(data, idx, bit):
         data = data.ljust(idx + 1, b"\x00")
     return data[:idx] + bit + data[idx+ 1:]
 
+
+bytes_to_bits_table = b"0" + b"1" * 255
+bits_to_bytes_table = bytes.maketrans(b"01", b"\x00\x01")
+
+
+# Convert b"\x00\x01..." piece list to bit packed bytearray
+def bytesToBits(data):
+    if not data:
+        return bytearray()
+    num_bytes = (len(data) + 7) // 8
+    bits = data.translate(bytes_to_bits_table).ljust(num_bytes * 8, b"0")
+    return bytearray(int(bits, 2).to_bytes(num_bytes, "big"))
+
+
+# Convert first size bit of the bit packed bytearray to b"\x00\x01..." piece list
+def bitsToBytes(data, size):
+    if not size:
+        return b""
+    bits = format(int.from_bytes(data, "big"), "0%sb" % (len(data) * 8))
+    return bits[:size].encode("ascii").translate(bits_to_bytes_table)
+
+
 class Piecefield(object):
     def tostring(self):
         return "".join(["1" if b else "0" for b in self.tobytes()])
 
+    def __len__(self):
+        return len(self.tobytes())
+
+    # Return: Number of downloaded pieces
+    def count(self):
+        data = self.tobytes()
+        return len(data) - data.count(b"\x00")
 
+
+# One bit per piece, set and query in place
 class BigfilePiecefield(Piecefield):
-    __slots__ = ["data"]
+    __slots__ = ["data", "size"]
 
     def __init__(self):
-        self.data = b""
+        self.data = bytearray()
+        self.size = 0
 
     def frombytes(self, s):
         if not isinstance(s, bytes) and not isinstance(s, bytearray):
             raise Exception("Invalid type: %s" % type(s))
-        self.data = s
+        self.data = bytesToBits(s)
+        self.size = len(s)
 
     def tobytes(self):
-        return self.data
+        return bitsToBytes(self.data, self.size)
 
     def pack(self):
-        return packPiecefield(self.data).tobytes()
+        return packPiecefield(self.tobytes()).tobytes()
 
     def unpack(self, s):
-        self.data = unpackPiecefield(array.array("H", s))
+        self.frombytes(unpackPiecefield(array.array("H", s)))
+
+    def __len__(self):
+        return self.size
+
+    def count(self):
+        return bin(int.from_bytes(self.data, "big")).count("1")
 
     def __getitem__(self, key):
-        try:
-            return self.data[key]
-        except IndexError:
+        if not 0 <= key < self.size:
             return False
+        return (self.data[key >> 3] >> (7 - (key & 7))) & 1
 
     def __setitem__(self, key, value):
-        self.data = spliceBit(self.data, key, value)
+        if value != b"\x00" and value != b"\x01":
+            raise Exception("Invalid bit: %s" % value)
+        if key >= self.size:
+            self.data.extend(b"\x00" * (key // 8 + 1 - len(self.data)))
+            self.size = key + 1
+        if value == b"\x01":
+            self.data[key >> 3] |= 0x80 >> (key & 7)
+        else:
+            self.data[key >> 3] &= ~(0x80 >> (key & 7)) & 0xFF
+
 
 class BigfilePiecefieldPacked(Piecefield):
     __slots__ = ["data"]
@@ -8,6 +8,7 @@ import warnings
 import base64
 import binascii
 import json
+import bisect
 
 import gevent
 import gevent.lock
@@ -29,15 +30,33 @@ from .BigfilePiecefield import BigfilePiecefield, BigfilePiecefieldPacked
 # We can only import plugin host clases after the plugins are loaded
 @PluginManager.afterLoad
 def importPluginnedClasses():
-    global VerifyError, config
+    global VerifyError, config, thread_pool_fs_hash
     from Content.ContentManager import VerifyError
     from Config import config
+    from Site.SiteStorage import thread_pool_fs_hash
 
 
 if "upload_nonces" not in locals():
     upload_nonces = {}
 
 
+# Hash functions running in the file hash thread pool
+def hashPiece(piece):
+    piece_i, data = piece
+    return piece_i, CryptHash.sha512t(data).digest()
+
+
+def hashFilePiece(piece):
+    piece_i, file, pos, size = piece
+    if hasattr(os, "pread"):
+        data = os.pread(file.fileno(), size, pos)
+    else:  # No positional read on Windows
+        with open(file.name, "rb") as file_piece:
+            file_piece.seek(pos)
+            data = file_piece.read(size)
+    return piece_i, CryptHash.sha512t(data).digest()
+
+
 @PluginManager.registerTo("UiRequest")
 class UiRequestPlugin(object):
     def isCorsAllowed(self, path):
@@ -278,48 +297,44 @@ class ContentManagerPlugin(object):
             if recv_left <= 0:
                 break
 
-    def hashBigfile(self, read_func, size, piece_size=1024 * 1024, file_out=None):
-        self.site.settings["has_bigfile"] = True
-
-        recv = 0
-        try:
-            piece_hash = CryptHash.sha512t()
-            piece_hashes = []
-            piece_recv = 0
-
-            mt = merkletools.MerkleTools()
-            mt.hash_function = CryptHash.sha512t
-
-            part = ""
-            for part in self.readFile(read_func, size):
-                if file_out:
-                    file_out.write(part)
-
-                recv += len(part)
-                piece_recv += len(part)
-                piece_hash.update(part)
-                if piece_recv >= piece_size:
-                    piece_digest = piece_hash.digest()
-                    piece_hashes.append(piece_digest)
-                    mt.leaves.append(piece_digest)
-                    piece_hash = CryptHash.sha512t()
-                    piece_recv = 0
-
-                    if len(piece_hashes) % 100 == 0 or recv == size:
-                        self.log.info("- [HASHING:%.0f%%] Pieces: %s, %.1fMB/%.1fMB" % (
-                            float(recv) / size * 100, len(piece_hashes), recv / 1024 / 1024, size / 1024 / 1024
-                        ))
-                        part = ""
-            if len(part) > 0:
-                piece_digest = piece_hash.digest()
-                piece_hashes.append(piece_digest)
-                mt.leaves.append(piece_digest)
-        except Exception as err:
-            raise err
-        finally:
+    # Collect the parts of the stream to pieces
+    def readPieces(self, read_func, size, piece_size, file_out=None):
+        piece_parts = []
+        piece_recv = 0
+        piece_i = 0
+        for part in self.readFile(read_func, size):
             if file_out:
-                file_out.close()
-
+                file_out.write(part)
+
+            piece_parts.append(part)
+            piece_recv += len(part)
+            if piece_recv >= piece_size:
+                yield piece_i, b"".join(piece_parts)
+                piece_parts = []
+                piece_recv = 0
+                piece_i += 1
+
+        if piece_recv > 0:
+            yield piece_i, b"".join(piece_parts)
+
+    # Hash the pieces parallel in the file hash thread pool
+    # Return: [piece digest, ...] in the order of the pieces
+    def hashPieces(self, hash_func, pieces, size, piece_size):
+        piece_hashes = {}
+        pieces_hashed = thread_pool_fs_hash.imapUnordered(hash_func, pieces, maxsize=thread_pool_fs_hash.max_size * 4)
+        for piece_i, piece_digest in pieces_hashed:
+            piece_hashes[piece_i] = piece_digest
+            if len(piece_hashes) % 100 == 0:
+                recv = min(len(piece_hashes) * piece_size, size)
+                self.log.info("- [HASHING:%.0f%%] Pieces: %s, %.1fMB/%.1fMB" % (
+                    float(recv) / size * 100, len(piece_hashes), recv / 1024 / 1024, size / 1024 / 1024
+                ))
+        return [piece_hashes[piece_i] for piece_i in range(len(piece_hashes))]
+
+    def getPiecemapInfo(self, piece_hashes, piece_size):
+        mt = merkletools.MerkleTools()
+        mt.hash_function = CryptHash.sha512t
+        mt.leaves = piece_hashes[:]
         mt.make_tree()
         merkle_root = mt.get_merkle_root()
         if type(merkle_root) is bytes:  # Python <3.5
@@ -328,6 +343,31 @@ class ContentManagerPlugin(object):
             "sha512_pieces": piece_hashes
         }
 
+    def hashBigfile(self, read_func, size, piece_size=1024 * 1024, file_out=None):
+        self.site.settings["has_bigfile"] = True
+
+        try:
+            pieces = self.readPieces(read_func, size, piece_size, file_out)
+            piece_hashes = self.hashPieces(hashPiece, pieces, size, piece_size)
+        finally:
+            if file_out:
+                file_out.close()
+
+        return self.getPiecemapInfo(piece_hashes, piece_size)
+
+    # Hash the stored file, the pieces read by the hashing threads
+    def hashBigfileFile(self, inner_path, size, piece_size=1024 * 1024):
+        self.site.settings["has_bigfile"] = True
+
+        with self.site.storage.open(inner_path, "rb") as file:
+            pieces = (
+                (piece_i, file, pos, min(piece_size, size - pos))
+                for piece_i, pos in enumerate(range(0, size, piece_size))
+            )
+            piece_hashes = self.hashPieces(hashFilePiece, pieces, size, piece_size)
+
+        return self.getPiecemapInfo(piece_hashes, piece_size)
+
     def hashFile(self, dir_inner_path, file_relative_path, optional=False):
         inner_path = dir_inner_path + file_relative_path
 
@@ -357,7 +397,7 @@ class ContentManagerPlugin(object):
                 return super(ContentManagerPlugin, self).hashFile(dir_inner_path, file_relative_path, optional)
 
             self.log.info("- [HASHING] %s" % file_relative_path)
-            merkle_root, piece_size, piecemap_info = self.hashBigfile(self.site.storage.open(inner_path, "rb").read, file_size)
+            merkle_root, piece_size, piecemap_info = self.hashBigfileFile(inner_path, file_size)
             if not hash:
                 hash = merkle_root
 
@@ -376,6 +416,7 @@ class ContentManagerPlugin(object):
         hash_id = self.site.content_manager.hashfield.getHashId(hash)
         self.optionalDownloaded(inner_path, hash_id, file_size, own=True)
         self.site.storage.piecefields[hash].frombytes(b"\x01" * piece_num)
+        self.site.storage.onPiecefieldChanged(hash)
 
         back[file_relative_path] = {"sha512": hash, "size": file_size, "piecemap": piecemap_relative_path, "piece_size": piece_size}
         return back
@@ -417,6 +458,7 @@ class ContentManagerPlugin(object):
             # Mark piece downloaded
             piece_i = int(pos_from / file_info["piece_size"])
             self.site.storage.piecefields[file_info["sha512"]][piece_i] = b"\x01"
+            self.site.storage.onPiecefieldChanged(file_info["sha512"])
 
             # Only add to site size on first request
             if hash_id in self.hashfield:
@@ -436,6 +478,7 @@ class ContentManagerPlugin(object):
             sha512 = file_info["sha512"]
             if sha512 in self.site.storage.piecefields:
                 del self.site.storage.piecefields[sha512]
+                self.site.storage.onPiecefieldChanged(sha512)
 
             # Also remove other pieces of the file from download queue
             for key in list(self.site.bad_files.keys()):
@@ -445,16 +488,101 @@ class ContentManagerPlugin(object):
         return super(ContentManagerPlugin, self).optionalRemoved(inner_path, hash_id, size)
 
 
+@PluginManager.registerTo("ContentDb")
+class ContentDbPlugin(object):
+    def getSchema(self):
+        schema = super(ContentDbPlugin, self).getSchema()
+
+        schema["tables"]["piecefield"] = {
+            "cols": [
+                ["site_id", "INTEGER REFERENCES site (site_id) ON DELETE CASCADE"],
+                ["sha512", "TEXT"],
+                ["piecefield", "BLOB"]
+            ],
+            "indexes": [
+                "CREATE UNIQUE INDEX piecefield_key ON piecefield (site_id, sha512)"
+            ],
+            "schema_changed": 1
+        }
+
+        return schema
+
+    # Return: {sha512: packed piecefield, ...} of the site
+    def getPiecefields(self, site):
+        site_id = self.needSite(site)
+        res = self.execute("SELECT sha512, piecefield FROM piecefield WHERE ?", {"site_id": site_id})
+        return {row["sha512"]: row["piecefield"] for row in res}
+
+    # Store the packed piecefields, delete it if the value is None
+    def setPiecefields(self, site, piecefields_packed):
+        site_id = self.needSite(site)
+        for sha512, piecefield_packed in piecefields_packed.items():
+            if piecefield_packed is None:
+                self.execute("DELETE FROM piecefield WHERE ?", {"site_id": site_id, "sha512": sha512})
+            else:
+                self.execute(
+                    "INSERT OR REPLACE INTO piecefield ?",
+                    {"site_id": site_id, "sha512": sha512, "piecefield": piecefield_packed}
+                )
+
+
 @PluginManager.registerTo("SiteStorage")
 class SiteStoragePlugin(object):
     def __init__(self, *args, **kwargs):
         super(SiteStoragePlugin, self).__init__(*args, **kwargs)
-        self.piecefields = collections.defaultdict(BigfilePiecefield)
-        if "piecefields" in self.site.settings.get("cache", {}):
-            for sha512, piecefield_packed in self.site.settings["cache"].get("piecefields").items():
-                if piecefield_packed:
-                    self.piecefields[sha512].unpack(base64.b64decode(piecefield_packed))
-            self.site.settings["cache"]["piecefields"] = {}
+        self._piecefields = None  # Loaded from content.db on first access
+        self.piecefields_changed = set()  # Sha512 of piecefields not saved to content.db yet
+        self.piecefields_save_thread = None
+
+    @property
+    def piecefields(self):
+        if self._piecefields is None:
+            self.loadPiecefields()
+        return self._piecefields
+
+    def loadPiecefields(self):
+        piecefields = collections.defaultdict(BigfilePiecefield)
+        for sha512, piecefield_packed in self.site.content_manager.contents.db.getPiecefields(self.site).items():
+            piecefields[sha512].unpack(piecefield_packed)
+
+        # Migrate piecefields stored in sites.json by older versions
+        for sha512, piecefield_packed in self.site.settings.get("cache", {}).pop("piecefields", {}).items():
+            if piecefield_packed:
+                piecefields[sha512].unpack(base64.b64decode(piecefield_packed))
+                self.piecefields_changed.add(sha512)
+
+        self._piecefields = piecefields
+        if self.piecefields_changed:
+            self.savePiecefields()
+        return piecefields
+
+    # Queue the piecefield of the file to save to content.db
+    def onPiecefieldChanged(self, sha512):
+        self.piecefields_changed.add(sha512)
+        if not self.piecefields_save_thread:
+            self.piecefields_save_thread = gevent.spawn_later(1, self.savePiecefields)
+
+    # Write the changed piecefields to content.db
+    def savePiecefields(self):
+        if self.piecefields_save_thread:
+            self.piecefields_save_thread.kill(block=False)
+            self.piecefields_save_thread = None
+        if not self.piecefields_changed:
+            return 0
+        piecefields_changed = self.piecefields_changed
+        self.piecefields_changed = set()
+        piecefields_packed = {}
+        for sha512 in piecefields_changed:
+            if sha512 in self.piecefields:
+                piecefields_packed[sha512] = self.piecefields[sha512].pack()
+            else:
+                piecefields_packed[sha512] = None  # Deleted
+        self.site.content_manager.contents.db.setPiecefields(self.site, piecefields_packed)
+        return len(piecefields_packed)
+
+    def flushDbUpdates(self):
+        self.savePiecefields()
+        return super(SiteStoragePlugin, self).flushDbUpdates()
 
     def createSparseFile(self, inner_path, size, sha512=None):
         file_path = self.getPath(inner_path)
@@ -472,6 +600,7 @@ class SiteStoragePlugin(object):
         if sha512 and sha512 in self.piecefields:
             self.log.debug("%s: File not exists, but has piecefield. Deleting piecefield." % inner_path)
             del self.piecefields[sha512]
+            self.onPiecefieldChanged(sha512)
 
     def write(self, inner_path, content):
         if "|" not in inner_path:
@@ -516,10 +645,12 @@ class SiteStoragePlugin(object):
                     piece_data = b"\x01"
                 self.log.debug("%s: File exists, but not in piecefield. Filling piecefiled with %s * %s." % (inner_path, piece_num, piece_data))
                 self.piecefields[sha512].frombytes(piece_data * piece_num)
+                self.onPiecefieldChanged(sha512)
         else:
             self.log.debug("Creating bigfile: %s" % inner_path)
             self.createSparseFile(inner_path, file_info["size"], sha512)
             self.piecefields[sha512].frombytes(b"\x00" * piece_num)
+            self.onPiecefieldChanged(sha512)
             self.log.debug("Created bigfile: %s" % inner_path)
         return True
 
@@ -530,6 +661,93 @@ class SiteStoragePlugin(object):
         return BigFile(self.site, inner_path, prebuffer=prebuffer)
 
 
+# Adaptive prefetch of the pieces ahead of the reading position of an opened BigFile
+class BigFileReadahead(object):
+    min_pieces = 2
+    max_pieces = 16
+
+    def __init__(self, big_file, prebuffer=0):
+        self.big_file = big_file
+        self.site = big_file.site
+        self.piece_size = big_file.piece_size
+        self.num_pieces_start = int(math.ceil(float(prebuffer) / self.piece_size))  # Prefetch before sequential read detected
+        self.num_pieces = self.num_pieces_start
+        self.sequential_bytes = 0
+        self.pos_next = None  # Read position if the file is read sequentially
+        self.tasks = {}  # Prefetch tasks started by us, Key: inner_path, Value: task
+        # Tasks requested by someone else too lose their task["prefetch_owner"], so they are never canceled by us
+
+    def getPieceInnerPath(self, piece_i):
+        pos_from = piece_i * self.piece_size
+        return "%s|%s-%s" % (self.big_file.inner_path, pos_from, pos_from + self.piece_size)
+
+    # Update the window after a read of pos - read_until and request the pieces ahead
+    def onRead(self, pos, read_until):
+        if pos == self.pos_next:
+            self.sequential_bytes += read_until - pos
+            if self.num_pieces < self.min_pieces:
+                self.num_pieces = self.min_pieces
+            elif self.sequential_bytes >= self.num_pieces * self.piece_size and self.num_pieces < self.max_pieces:
+                # Reader consumed the whole window, it's a stream: double the window
+                self.num_pieces = min(self.num_pieces * 2, self.max_pieces)
+                self.sequential_bytes = 0
+                self.site.log.debug("%s: Readahead increased to %s pieces" % (self.big_file.inner_path, self.num_pieces))
+        self.pos_next = read_until
+        self.prefetch(read_until)
+
+    # Reset the window and cancel not started prefetches if the reader jumps to a new position
+    def onSeek(self, pos):
+        if pos == self.pos_next:
+            return False
+        self.pos_next = None
+        self.num_pieces = self.num_pieces_start
+        self.sequential_bytes = 0
+        self.cancel(pos)
+        return True
+
+    # Request the next num_pieces piece after read_until, closer pieces with higher priority
+    def prefetch(self, read_until):
+        for inner_path, task in list(self.tasks.items()):
+            if task["done"]:
+                del self.tasks[inner_path]
+
+        piece_first = int((read_until - 1) / self.piece_size) + 1
+        piece_last = min(piece_first + self.num_pieces, int(math.ceil(float(self.big_file.size) / self.piece_size)))
+        for piece_i in range(piece_first, piece_last):
+            if self.big_file.piecefield[piece_i]:
+                continue
+            inner_path = self.getPieceInnerPath(piece_i)
+            priority = max(0, 8 - (piece_i - piece_first))  # Escalates as the reader gets closer
+            task = self.site.worker_manager.tasks.findTask(inner_path)
+            is_own = not task or task.get("prefetch_owner") is self
+            self.site.needFile(inner_path, blocking=False, update=True, priority=priority)
+            task = self.site.worker_manager.tasks.findTask(inner_path)
+            if is_own and task:
+                task["prefetch_owner"] = self
+                self.tasks[inner_path] = task
+
+    # Cancel the prefetches outside of the window from pos that no worker started and nobody else requested yet
+    def cancel(self, pos):
+        piece_first = int(pos / self.piece_size)
+        piece_last = piece_first + max(self.num_pieces, 1)
+        num_canceled = 0
+        for inner_path, task in list(self.tasks.items()):
+            if task["done"]:
+                del self.tasks[inner_path]
+                continue
+            if task["workers_num"] or piece_first <= task.get("piece_i", -1) < piece_last:
+                continue  # Already downloading or still needed
+            del self.tasks[inner_path]
+            if task.get("prefetch_owner") is not self:
+                continue  # Someone else waits for it
+            if self.site.worker_manager.failTask(task, reason="Prefetch canceled") is not False:
+                self.site.bad_files.pop(inner_path, None)
+                num_canceled += 1
+        if num_canceled:
+            self.site.log.debug("%s: Canceled %s prefetch on seek" % (self.big_file.inner_path, num_canceled))
+        return num_canceled
+
+
 class BigFile(object):
     def __init__(self, site, inner_path, prebuffer=0):
         self.site = site
@@ -545,10 +763,12 @@ class BigFile(object):
         self.piecefield = self.site.storage.piecefields[self.sha512]
         self.f = open(file_path, "rb+")
         self.read_lock = gevent.lock.Semaphore()
+        self.readahead = BigFileReadahead(self, prebuffer)
 
     def read(self, buff=64 * 1024):
         with self.read_lock:
             pos = self.f.tell()
+            read_from = pos
             read_until = min(self.size, pos + buff)
             requests = []
             # Request all required blocks
@@ -565,29 +785,15 @@ class BigFile(object):
             if not all(requests):
                 return None
 
-            # Request prebuffer
-            if self.prebuffer:
-                prebuffer_until = min(self.size, read_until + self.prebuffer)
-                priority = 3
-                while 1:
-                    piece_i = int(pos / self.piece_size)
-                    if piece_i * self.piece_size >= prebuffer_until:
-                        break
-                    pos_from = piece_i * self.piece_size
-                    pos_to = pos_from + self.piece_size
-                    if not self.piecefield[piece_i]:
-                        self.site.needFile("%s|%s-%s" % (self.inner_path, pos_from, pos_to), blocking=False, update=True, priority=max(0, priority))
-                    priority -= 1
-                    pos += self.piece_size
+            # Request the pieces ahead
+            if read_until > read_from:
+                self.readahead.onRead(read_from, read_until)
 
             gevent.joinall(requests)
+            if not all(request is True or request.value for request in requests):
+                return None  # Piece download failed
             self.read_bytes += buff
 
-            # Increase buffer for long reads
-            if self.read_bytes > 7 * 1024 * 1024 and self.prebuffer < 5 * 1024 * 1024:
-                self.site.log.debug("%s: Increasing bigfile buffer size to 5MB..." % self.inner_path)
-                self.prebuffer = 5 * 1024 * 1024
-
             return self.f.read(buff)
 
     def seek(self, pos, whence=0):
@@ -595,6 +801,8 @@ class BigFile(object):
             if whence == 2:  # Relative from file end
                 pos = self.size + pos  # Use the real size instead of size on the disk
                 whence = 0
+            if whence == 0:
+                self.readahead.onSeek(pos)
             return self.f.seek(pos, whence)
 
     def seekable(self):
@@ -613,9 +821,207 @@ class BigFile(object):
         self.close()
 
 
+# Not started piece tasks of a file ordered by the number of peers having the piece
+class BigfileFreeTasks(object):
+    def __init__(self):
+        self.items = []  # (piece availability, task id, task)
+        self.task_items = {}  # Key: task id, Value: item in items
+
+    def __len__(self):
+        return len(self.task_items)
+
+    def __iter__(self):
+        return (item[2] for item in self.items)
+
+    def add(self, task, availability):
+        if task["id"] in self.task_items:
+            return False
+        item = (availability, task["id"], task)
+        bisect.insort(self.items, item)
+        self.task_items[task["id"]] = item
+        return True
+
+    def remove(self, task):
+        item = self.task_items.pop(task["id"], None)
+        if not item:
+            return False
+        del self.items[bisect.bisect_left(self.items, item)]
+        return True
+
+    # Re-order the tasks by the new piece availability
+    def sort(self, availability):
+        self.items = sorted([
+            (availability[task["piece_i"]] if task["piece_i"] < len(availability) else 0, task_id, task)
+            for task_id, (_, _, task) in self.task_items.items()
+        ])
+        self.task_items = {item[1]: item for item in self.items}
+
+
+# Select the piece for a peer: rarest piece first, keep the last pieces for the faster peers
+# and request the pieces of the slowest peers again at the end of the download
+class BigfilePieceScheduler(object):
+    availability_cache_time = 5
+    slow_peer_ratio = 2  # Leave the last pieces to the peers that are this times faster
+    endgame_max_workers = 2
+
+    def __init__(self, worker_manager):
+        self.worker_manager = worker_manager
+        self.site = worker_manager.site
+        self.availability = {}  # Key: sha512, Value: (time calculated, [number of peers having the piece, ...])
+        self.free_tasks = {}  # Key: sha512, Value: BigfileFreeTasks
+
+    # Return: Number of known peers having the pieces of the file
+    def getAvailability(self, sha512):
+        cached = self.availability.get(sha512)
+        if cached and time.time() - cached[0] < self.availability_cache_time:
+            return cached[1]
+
+        piecefields = [
+            peer.piecefields[sha512].tobytes() for peer in list(self.site.peers.values())
+            if sha512 in peer.piecefields
+        ]
+        piece_num = max([len(piecefield) for piecefield in piecefields] or [0])
+        availability = [sum(pieces) for pieces in zip(*[piecefield.ljust(piece_num, b"\x00") for piecefield in piecefields])]
+        self.availability[sha512] = (time.time(), availability)
+        if sha512 in self.free_tasks:
+            self.free_tasks[sha512].sort(availability)
+        return availability
+
+    def getPieceAvailability(self, task):
+        availability = self.getAvailability(task["sha512"])
+        if task["piece_i"] < len(availability):
+            return availability[task["piece_i"]]
+        else:
+            return 0
+
+    # Keep the free task buckets in sync with the task's state
+    def updateTask(self, task):
+        if "piece_i" not in task:
+            return
+        sha512 = task["sha512"]
+        if not task["done"] and not task["workers_num"] and self.worker_manager.tasks.isIndexed(task):
+            availability = self.getPieceAvailability(task)
+            if sha512 not in self.free_tasks:
+                self.free_tasks[sha512] = BigfileFreeTasks()
+            self.free_tasks[sha512].add(task, availability)
+        elif sha512 in self.free_tasks:
+            self.free_tasks[sha512].remove(task)
+            if not self.free_tasks[sha512]:
+                del self.free_tasks[sha512]
+
+    # Remove the tasks that removed from the queue without finishing
+    def removeDoneTasks(self):
+        for free_tasks in list(self.free_tasks.values()):
+            for task in [task for task in free_tasks if task["done"]]:
+                self.updateTask(task)
+
+    def getFreeNum(self, sha512):
+        return len(self.free_tasks.get(sha512, ()))
+
+    def isTaskAllowed(self, peer, task, priority):
+        if task["done"] or task["priority"] != priority or peer in task["failed"]:
+            return False
+        if task["peers"]:
+            return peer in task["peers"]
+        else:
+            return self.worker_manager.tasks.isOpen(task)
+
+    # Return: True if there is enough faster peer working on the file to download the rest of the free pieces
+    def isLeftForFasterPeers(self, peer, task):
+        speed = peer.download_speed
+        if not speed:
+            return False
+        sha512 = task["sha512"]
+        num_faster = 0
+        for worker in list(self.worker_manager.workers.values()):
+            if worker.peer is peer or not worker.task or worker.task.get("sha512") != sha512:
+                continue
+            if worker.peer.download_speed <= speed * self.slow_peer_ratio:
+                continue
+            piecefield = worker.peer.piecefields.get(sha512)
+            if piecefield and piecefield[task["piece_i"]]:
+                num_faster += 1
+        return self.getFreeNum(sha512) <= num_faster
+
+    # Return: The already started piece with the slowest workers if the peer could download it faster
+    def getEndgameTask(self, peer, tasks):
+        speed = peer.download_speed
+        found = None
+        speed_found = None
+        for task in tasks:
+            if task["workers_num"] >= self.endgame_max_workers:
+                continue
+            workers = self.worker_manager.findWorkers(task)
+            if peer in [worker.peer for worker in workers]:
+                continue
+            speed_workers = min([worker.peer.download_speed for worker in workers] or [0])
+            if speed and speed_workers and speed <= speed_workers:
+                continue  # Would not be faster
+            if found is None or speed_workers < speed_found:
+                found = task
+                speed_found = speed_workers
+        return found
+
+    def getTask(self, peer, found):
+        sha512 = found["sha512"]
+        self.getAvailability(sha512)  # Re-order the free tasks if the availability expired
+        for task in self.free_tasks.get(sha512, ()):
+            if self.isTaskAllowed(peer, task, found["priority"]):
+                if self.isLeftForFasterPeers(peer, task):
+                    return None
+                return task
+
+        # No free piece left for the peer: Only the started ones are candidates for the endgame
+        tasks_started = {}
+        for worker in list(self.worker_manager.workers.values()):
+            task = worker.task
+            if task and task.get("sha512") == sha512 and self.isTaskAllowed(peer, task, found["priority"]):
+                tasks_started[task["id"]] = task
+        task = self.getEndgameTask(peer, [tasks_started[task_id] for task_id in sorted(tasks_started)])
+        if task and config.verbose:
+            self.site.log.debug("%s: Endgame request of %s" % (peer.key, task["inner_path"]))
+        return task
+
+
 @PluginManager.registerTo("WorkerManager")
 class WorkerManagerPlugin(object):
+    def __init__(self, *args, **kwargs):
+        super(WorkerManagerPlugin, self).__init__(*args, **kwargs)
+        self.piece_scheduler = BigfilePieceScheduler(self)
+
+    def getTask(self, peer):
+        task = super(WorkerManagerPlugin, self).getTask(peer)
+        if task and "piece_i" in task:
+            task = self.piece_scheduler.getTask(peer, task)
+        return task
+
+    def addTaskWorker(self, task, worker):
+        super(WorkerManagerPlugin, self).addTaskWorker(task, worker)
+        self.piece_scheduler.updateTask(task)
+
+    def removeTaskWorker(self, task, worker):
+        super(WorkerManagerPlugin, self).removeTaskWorker(task, worker)
+        self.piece_scheduler.updateTask(task)
+
+    def doneTask(self, task):
+        super(WorkerManagerPlugin, self).doneTask(task)
+        self.piece_scheduler.updateTask(task)
+
+    def failTask(self, task, *args, **kwargs):
+        back = super(WorkerManagerPlugin, self).failTask(task, *args, **kwargs)
+        self.piece_scheduler.updateTask(task)
+        return back
+
+    def removeSolvedFileTasks(self, *args, **kwargs):
+        back = super(WorkerManagerPlugin, self).removeSolvedFileTasks(*args, **kwargs)
+        self.piece_scheduler.removeDoneTasks()
+        return back
+
     def addTask(self, inner_path, *args, **kwargs):
+        task = self.tasks.findTask(inner_path)
+        if task and task.get("prefetch_owner"):
+            task["prefetch_owner"] = None  # Requested by someone else too, the readahead can't cancel it anymore
+
         file_info = kwargs.get("file_info")
         if file_info and "piecemap" in file_info:  # Bigfile
             self.site.settings["has_bigfile"] = True
@@ -637,6 +1043,7 @@ class WorkerManagerPlugin(object):
                 pos_from, pos_to = map(int, file_range.split("-"))
                 task["piece_i"] = int(pos_from / file_info["piece_size"])
                 task["sha512"] = file_info["sha512"]
+                self.piece_scheduler.updateTask(task)
             else:
                 if inner_path in self.site.bad_files:
                     del self.site.bad_files[inner_path]
@@ -651,14 +1058,16 @@ class WorkerManagerPlugin(object):
                 self.site.storage.createSparseFile(inner_path, file_info["size"], file_info["sha512"])
                 piece_num = int(math.ceil(float(file_info["size"]) / file_info["piece_size"]))
                 self.site.storage.piecefields[file_info["sha512"]].frombytes(b"\x00" * piece_num)
+                self.site.storage.onPiecefieldChanged(file_info["sha512"])
         else:
             task = super(WorkerManagerPlugin, self).addTask(inner_path, *args, **kwargs)
         return task
 
     def taskAddPeer(self, task, peer):
         if "piece_i" in task:
-            if not peer.piecefields[task["sha512"]][task["piece_i"]]:
-                if task["sha512"] not in peer.piecefields:
+            piecefield = peer.piecefields.get(task["sha512"])
+            if not piecefield or not piecefield[task["piece_i"]]:
+                if piecefield is None:
                     gevent.spawn(peer.updatePiecefields, force=True)
                 elif not task["peers"]:
                     gevent.spawn(peer.updatePiecefields)
@@ -789,10 +1198,11 @@ class SitePlugin(object):
         return super(SitePlugin, self).isFileDownloadAllowed(inner_path, file_info)
 
     def getSettingsCache(self):
-        back = super(SitePlugin, self).getSettingsCache()
-        if self.storage.piecefields:
-            back["piecefields"] = {sha512: base64.b64encode(piecefield.pack()).decode("utf8") for sha512, piecefield in self.storage.piecefields.items()}
-        return back
+        if self.isLoaded():
+            if "piecefields" in self.settings.get("cache", {}):
+                self.storage.piecefields  # Migrate the piecefields of older versions before the cache is cleared
+            self.storage.savePiecefields()  # Piecefields are stored in content.db
+        return super(SitePlugin, self).getSettingsCache()
 
     def needFile(self, inner_path, *args, **kwargs):
         if inner_path.endswith("|all"):
@@ -1,8 +1,12 @@
 import time
 import io
 import binascii
+import base64
+import array
 
 import pytest
+import gevent
+import gevent.event
 import mock
 
 from Connection import ConnectionServer
@@ -10,7 +14,9 @@ from Content.ContentManager import VerifyError
 from File import FileServer
 from File import FileRequest
 from Worker import WorkerManager
+from Worker import Worker
 from Peer import Peer
+from Site import SiteManager
 from Bigfile import BigfilePiecefield, BigfilePiecefieldPacked
 from Test import Spy
 from util import Msgpack
@@ -30,6 +36,16 @@ class TestBigfile:
         assert site.content_manager.sign("content.json", self.privatekey)
         return inner_path
 
+    # Return: Downloaded and downloading pieces of the bigfile
+    def getFilePieces(self, site, inner_path):
+        sha512 = site.content_manager.getFileInfo(inner_path)["sha512"]
+        piecefield = site.storage.piecefields[sha512].tostring()
+        tasks = [task["inner_path"] for task in site.worker_manager.tasks]
+        return [
+            i for i in range(10)
+            if piecefield[i:i + 1] == "1" or "%s|%s-%s" % (inner_path, i * self.piece_size, (i + 1) * self.piece_size) in tasks
+        ]
+
     def testPiecemapCreate(self, site):
         inner_path = self.createBigfile(site)
         content = site.storage.loadJson("content.json")
@@ -44,6 +60,43 @@ class TestBigfile:
         assert piecemap["sha512_pieces"][0] != piecemap["sha512_pieces"][1]
         assert binascii.hexlify(piecemap["sha512_pieces"][0]) == b"a73abad9992b3d0b672d0c2a292046695d31bebdcb1e150c8410bbe7c972eff3"
 
+    def testHashBigfileParallel(self, site):
+        import merkletools
+        import threading
+        from Crypt import CryptHash
+        from Bigfile import BigfilePlugin
+
+        data = b"".join([("Test%s" % i).ljust(10, "-").encode() for i in range(1050000)])  # 10 full and 1 partial piece
+        site.storage.write("data/parallel.iso", data)
+
+        # Reference: Sequential hashing of the pieces
+        pieces = [data[pos:pos + self.piece_size] for pos in range(0, len(data), self.piece_size)]
+        mt = merkletools.MerkleTools()
+        mt.hash_function = CryptHash.sha512t
+        mt.leaves = [CryptHash.sha512t(piece).digest() for piece in pieces]
+        mt.make_tree()
+
+        hash_threads = []
+        hash_file_piece = BigfilePlugin.hashFilePiece
+
+        def hashFilePiece(piece):
+            hash_threads.append(threading.current_thread())
+            return hash_file_piece(piece)
+
+        with mock.patch.object(BigfilePlugin, "hashFilePiece", hashFilePiece):
+            merkle_root, piece_size, piecemap_info = site.content_manager.hashBigfileFile("data/parallel.iso", len(data))
+        assert len(hash_threads) == 11
+        assert threading.main_thread() not in hash_threads
+        assert piece_size == self.piece_size
+        assert piecemap_info["sha512_pieces"] == mt.leaves
+        assert merkle_root == mt.get_merkle_root()
+
+        # Hashing the uploaded stream gives the same result
+        out_file = io.BytesIO()
+        out_file.close = lambda: None
+        assert site.content_manager.hashBigfile(io.BytesIO(data).read, len(data), file_out=out_file) == (merkle_root, piece_size, piecemap_info)
+        assert out_file.getvalue() == data
+
     def testVerifyPiece(self, site):
         inner_path = self.createBigfile(site)
 
@@ -190,7 +243,8 @@ class TestBigfile:
             assert set(site_temp.content_manager.hashfield) == set([18343, 43727])
 
             assert site_temp.storage.piecefields[f.sha512].tostring() == "0000010001"
-            assert f.sha512 in site_temp.getSettingsCache()["piecefields"]
+            site_temp.storage.savePiecefields()
+            assert f.sha512 in site_temp.content_manager.contents.db.getPiecefields(site_temp)
 
             # Test requesting already downloaded
             with Spy.Spy(FileRequest, "route") as requests:
@@ -242,6 +296,82 @@ class TestBigfile:
             assert piecefield.tobytes() == piecefield_new.tobytes()
             assert piecefield_new.tobytes() == testdata
 
+    def testPiecefieldBits(self):
+        piecefield = BigfilePiecefield()
+        piecefield.frombytes(b"\x00" * 50000)
+        assert len(piecefield) == 50000
+        assert piecefield.count() == 0
+
+        # In place set, grows if required
+        piecefield[9] = b"\x01"
+        piecefield[49999] = b"\x01"
+        piecefield[50010] = b"\x01"
+        assert piecefield[9] and piecefield[49999] and piecefield[50010]
+        assert not piecefield[10] and not piecefield[50009] and not piecefield[60000]
+        assert len(piecefield) == 50011
+        assert piecefield.count() == 3
+        piecefield[9] = b"\x00"
+        assert not piecefield[9]
+        assert piecefield.count() == 2
+        with pytest.raises(Exception):
+            piecefield[1] = 1
+
+        # Long runs are split to parts accepted by older clients
+        piecefield.frombytes(b"\x01" * 50000)
+        assert max(array.array("H", piecefield.pack())) <= 10000
+        piecefield_packed = BigfilePiecefieldPacked()
+        piecefield_packed.unpack(piecefield.pack())
+        assert piecefield_packed.tobytes() == b"\x01" * 50000
+        assert piecefield_packed.count() == 50000
+
+    def testPiecefieldStore(self, site):
+        inner_path = self.createBigfile(site)
+        sha512 = site.content_manager.getFileInfo(inner_path)["sha512"]
+        content_db = site.content_manager.contents.db
+
+        # Stored in content.db instead of sites.json
+        site.storage.savePiecefields()
+        assert "piecefields" not in site.getSettingsCache()
+        assert content_db.getPiecefields(site)[sha512] == site.storage.piecefields[sha512].pack()
+
+        # Piece changes saved in the background
+        site.storage.piecefields[sha512][3] = b"\x00"
+        site.storage.onPiecefieldChanged(sha512)
+        time.sleep(1.1)
+        assert not site.storage.piecefields_changed
+        piecefield = BigfilePiecefield()
+        piecefield.unpack(content_db.getPiecefields(site)[sha512])
+        assert piecefield.tostring() == "1110111111"
+
+        # Loaded on first access
+        site.storage._piecefields = None
+        assert site.storage.piecefields[sha512].tostring() == "1110111111"
+
+        # Migrate from sites.json cache
+        site.storage._piecefields = None
+        piecefield.frombytes(b"\x01" * 5)
+        site.settings["cache"]["piecefields"] = {"aabb": base64.b64encode(piecefield.pack()).decode("utf8")}
+        assert site.storage.piecefields["aabb"].tostring() == "11111"
+        assert "piecefields" not in site.settings["cache"]
+        assert "aabb" in content_db.getPiecefields(site)
+
+        # Deleted piecefield removed from the store
+        del site.storage.piecefields["aabb"]
+        site.storage.onPiecefieldChanged("aabb")
+        site.storage.savePiecefields()
+        assert "aabb" not in content_db.getPiecefields(site)
+
+        # Migrated if sites.json saved before the first access
+        site.storage._piecefields = None
+        site.settings["cache"]["piecefields"] = {"ccdd": base64.b64encode(piecefield.pack()).decode("utf8")}
+        SiteManager.site_manager.save()
+        assert "piecefields" not in site.settings["cache"]
+        assert "ccdd" in content_db.getPiecefields(site)
+        assert site.storage.piecefields["ccdd"].tostring() == "11111"
+        del site.storage.piecefields["ccdd"]
+        site.storage.onPiecefieldChanged("ccdd")
+        site.storage.savePiecefields()
+
     def testFileGet(self, file_server, site, site_temp):
         inner_path = self.createBigfile(site)
 
@@ -427,7 +557,7 @@ class TestBigfile:
                 f.seek(5 * 1024 * 1024)
                 assert f.read(7) == b"Test524"
             # assert len(requests) == 3  # 1x piecemap + 1x getpiecefield + 1x for pieces
-            assert len([task for task in site_temp.worker_manager.tasks if task["inner_path"].startswith(inner_path)]) == 2
+            assert self.getFilePieces(site_temp, inner_path) == [5, 6, 7]  # Read piece and 2 prebuffered pieces
 
             time.sleep(0.5)  # Wait prebuffer download
 
@@ -440,6 +570,149 @@ class TestBigfile:
 
             assert len([task for task in site_temp.worker_manager.tasks if task["inner_path"].startswith(inner_path)]) == 0
 
+    def testReadahead(self, file_server, site, site_temp):
+        inner_path = self.createBigfile(site)
+
+        # Init source server
+        site.connection_server = file_server
+        file_server.sites[site.address] = site
+
+        # Init client server
+        client = ConnectionServer(file_server.ip, 1545)
+        site_temp.connection_server = client
+        site_temp.addPeer(file_server.ip, 1544)
+
+        # Download site
+        site_temp.download(blind_includes=True, retry_bad_files=False).join(timeout=10)
+
+        def getFileTasks():
+            return sorted([task["inner_path"] for task in site_temp.worker_manager.tasks if task["inner_path"].startswith(inner_path)])
+
+        with site_temp.storage.openBigfile(inner_path) as f:
+            # No prefetch for the first read
+            assert f.read(7) == b"Test0--"
+            assert getFileTasks() == []
+
+            # Sequential read: prefetch the next pieces
+            assert len(f.read(self.piece_size)) == self.piece_size
+            assert f.readahead.num_pieces == 2
+            assert self.getFilePieces(site_temp, inner_path) == [0, 1, 2, 3]
+
+            # Window grows while the file is read sequentially
+            for i in range(3):
+                assert len(f.read(self.piece_size)) == self.piece_size
+            assert f.readahead.num_pieces == 4
+            time.sleep(0.5)  # Wait prefetch download
+            sha512 = site.content_manager.getFileInfo(inner_path)["sha512"]
+            assert site_temp.storage.piecefields[sha512].tostring() == "1111111110"
+
+            # Seek cancels the prefetches not started yet
+            with mock.patch.object(site_temp.worker_manager, "startWorkers"):
+                f.readahead.prefetch(8 * self.piece_size)
+                assert getFileTasks() == ["%s|%s-%s" % (inner_path, 9 * self.piece_size, 10 * self.piece_size)]
+                f.seek(0)
+                assert f.readahead.num_pieces == 0
+                assert getFileTasks() == []
+                assert not [bad_file for bad_file in site_temp.bad_files if bad_file.startswith(inner_path + "|")]
+
+                # Prefetch also requested by an other reader is not canceled
+                piece_inner_path = "%s|%s-%s" % (inner_path, 9 * self.piece_size, 10 * self.piece_size)
+                f.readahead.num_pieces = 1
+                f.readahead.prefetch(8 * self.piece_size)
+                evt = site_temp.needFile(piece_inner_path, blocking=False, update=True, priority=10)
+                f.seek(0)
+                assert getFileTasks() == [piece_inner_path]
+                assert not evt.ready()
+                site_temp.worker_manager.failTask(site_temp.worker_manager.tasks.findTask(piece_inner_path))
+
+            # Read fails if a required piece failed to download
+            def needFileFailed(*args, **kwargs):
+                evt = gevent.event.AsyncResult()
+                evt.set(False)
+                return evt
+
+            f.seek(9 * self.piece_size)
+            with mock.patch.object(site_temp, "needFile", needFileFailed):
+                assert f.read(7) is None
+
+    def testPieceScheduler(self, site):
+        inner_path = self.createBigfile(site)
+        file_info = site.content_manager.getFileInfo(inner_path)
+        sha512 = file_info["sha512"]
+        worker_manager = site.worker_manager
+
+        peer_fast = site.addPeer("1.2.3.4", 15441)
+        peer_medium = site.addPeer("1.2.3.5", 15441)
+        peer_slow = site.addPeer("1.2.3.6", 15441)
+        for peer, num_pieces in [(peer_fast, 10), (peer_medium, 3), (peer_slow, 2)]:
+            peer.piecefields[sha512].frombytes((b"\x01" * num_pieces).ljust(10, b"\x00"))
+            peer.time_piecefields_updated = time.time()
+
+        with mock.patch.object(worker_manager, "startWorkers"), mock.patch.object(worker_manager, "startFindOptional"):
+            tasks = [
+                worker_manager.addTask("%s|%s-%s" % (inner_path, i * self.piece_size, (i + 1) * self.piece_size), file_info=file_info)
+                for i in range(4)
+            ]
+            for task in tasks:
+                for peer in [peer_fast, peer_medium, peer_slow]:
+                    worker_manager.taskAddPeer(task, peer)
+
+            def startTask(peer, task):
+                worker = Worker(worker_manager, peer)
+                worker.task = task
+                worker_manager.workers[peer.key] = worker
+                worker_manager.addTaskWorker(task, worker)
+
+            worker_manager.tasks.updateItem(tasks[0], "priority", 0)  # Remove first task boost
+            assert worker_manager.piece_scheduler.getAvailability(sha512)[0:4] == [3, 3, 2, 1]
+
+            # Free tasks kept ordered by availability
+            piece_scheduler = worker_manager.piece_scheduler
+            assert list(piece_scheduler.free_tasks[sha512]) == [tasks[3], tasks[2], tasks[0], tasks[1]]
+            assert piece_scheduler.getFreeNum(sha512) == 4
+
+            # Rarest first
+            assert worker_manager.getTask(peer_fast) is tasks[3]
+            startTask(peer_fast, tasks[3])
+            assert worker_manager.getTask(peer_medium) is tasks[2]
+            startTask(peer_medium, tasks[2])
+            assert list(piece_scheduler.free_tasks[sha512]) == [tasks[0], tasks[1]]
+
+            # Last free pieces left to the faster peers
+            peer_fast.download_speed = peer_medium.download_speed = 1024 * 1024
+            peer_slow.download_speed = 10 * 1024
+            assert worker_manager.getTask(peer_slow) is None
+            peer_slow.download_speed = 0  # Unknown speed
+            assert worker_manager.getTask(peer_slow) is tasks[0]
+            startTask(peer_slow, tasks[0])
+            peer_slow.download_speed = 10 * 1024
+
+            # Endgame: request the piece of the slowest peer again
+            def doneTask(peer, task):
+                del worker_manager.workers[peer.key]
+                task["done"] = True
+                worker_manager.tasks.remove(task)
+                worker_manager.removeTaskWorker(task, None)
+
+            doneTask(peer_fast, tasks[3])
+            assert worker_manager.getTask(peer_fast) is tasks[1]
+            startTask(peer_fast, tasks[1])
+            doneTask(peer_medium, tasks[2])
+            peer_medium.download_speed = 100 * 1024
+            assert worker_manager.getTask(peer_medium) is tasks[0]  # Faster than peer_slow, slower than peer_fast
+            startTask(peer_medium, tasks[0])
+            assert worker_manager.getTask(peer_fast) is None  # Max workers per piece reached
+            assert piece_scheduler.getFreeNum(sha512) == 0
+
+            # Piece task back to the free ones if its worker left
+            worker_manager.removeTaskWorker(tasks[1], None)
+            assert list(piece_scheduler.free_tasks[sha512]) == [tasks[1]]
+
+            worker_manager.workers.clear()
+            for task in tasks[0:2]:
+                worker_manager.failTask(task)
+            assert sha512 not in piece_scheduler.free_tasks
+
     def testDownloadAllPieces(self, file_server, site, site_temp):
         inner_path = self.createBigfile(site)
 
@@ -317,6 +317,12 @@ class SiteStoragePlugin(object):
 
 @PluginManager.registerTo("Site")
 class SitePlugin(object):
+    def getSettingsCache(self):
+        back = super(SitePlugin, self).getSettingsCache()
+        if self.isLoaded():
+            back["merged_type"] = self.content_manager.contents.get("content.json", {}).get("merged_type")
+        return back
+
     def fileDone(self, inner_path):
         super(SitePlugin, self).fileDone(inner_path)
 
@@ -351,7 +357,10 @@ class SiteManagerPlugin(object):
         for site in self.sites.values():
             # Update merged sites
             try:
-                merged_type = site.content_manager.contents.get("content.json", {}).get("merged_type")
+                if not site.isLoaded() and "merged_type" in site.settings["cache"]:
+                    merged_type = site.settings["cache"]["merged_type"]  # Don't load the site to check it
+                else:
+                    merged_type = site.content_manager.contents.get("content.json", {}).get("merged_type")
             except Exception as err:
                 self.log.error("Error loading site %s: %s" % (site.address, Debug.formatException(err)))
                 continue
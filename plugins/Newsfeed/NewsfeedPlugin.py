@@ -1,12 +1,67 @@
 import time
 import re
+import heapq
+import sqlite3
+import functools
+import collections
 
 from Plugin import PluginManager
 from Db.DbQuery import DbQuery
 from Debug import Debug
 from util import helper
+from util import ThreadPool
 from util.Flag import flag
 
+thread_pool_feed = ThreadPool.ThreadPool(4, name="Feed query")  # Sites have separate db files, so they can be queried parallel
+
+
+# Add the day limit to every part of the followed query and insert the params
+@functools.lru_cache(maxsize=1000)
+def getFeedQuery(query_raw, params, day_limit):
+    query_parts = re.split(r"UNION(?:\s+ALL|)", query_raw)
+    for i, query_part in enumerate(query_parts):
+        db_query = DbQuery(query_part)
+        if day_limit:
+            where = " WHERE %s > strftime('%%s', 'now', '-%s day')" % (db_query.fields.get("date_added", "date_added"), day_limit)
+            if "WHERE" in query_part:
+                query_part = re.sub("WHERE (.*?)(?=$| GROUP BY)", where+" AND (\\1)", query_part)
+            else:
+                query_part += where
+        query_parts[i] = query_part
+    query = " UNION ".join(query_parts)
+
+    if ":params" in query:
+        query_params = map(helper.sqlquote, params)
+        query = query.replace(":params", ",".join(query_params))
+    return query
+
+
+# Query results of the followed feeds, dropped when the site's database changes
+class FeedCache(object):
+    def __init__(self, timeout=60):
+        self.timeout = timeout  # The queries are relative to the current time, so also expire them
+        self.sites = {}  # Key: site address, Value: {(feed name, query, limit): (time cached, rows)}
+        self.site_changes = collections.defaultdict(int)  # Number of invalidations per site, to skip storing outdated results
+
+    def get(self, address, key):
+        cached = self.sites.get(address, {}).get(key)
+        if cached and time.time() - cached[0] < self.timeout:
+            return cached[1]
+        return None
+
+    def set(self, address, key, rows, site_change):
+        if self.site_changes[address] != site_change:  # Site changed since the query started
+            return False
+        self.sites.setdefault(address, {})[key] = (time.time(), rows)
+        return True
+
+    def invalidate(self, address):
+        self.site_changes[address] += 1
+        return self.sites.pop(address, None) is not None
+
+
+feed_cache = FeedCache()
+
 
 @PluginManager.registerTo("UiWebsocket")
 class UiWebsocketPlugin(object):
@@ -28,11 +83,36 @@ class UiWebsocketPlugin(object):
         feeds = self.user.sites.get(self.site.address, {}).get("follow", {})
         self.response(to, feeds)
 
+    # Run the query in the feed query thread pool
+    # Return: [row, ...]
+    def queryFeed(self, db, query):
+        return [dict(row) for row in db.execute(query)]
+
+    # Filter and format the rows of a feed query
+    # Return: [row, ...] ordered by date_added
+    def formatFeedRows(self, address, name, res):
+        rows = []
+        for row in res:
+            if not isinstance(row["date_added"], (int, float, complex)):
+                self.log.debug("Invalid date_added from site %s: %r" % (address, row["date_added"]))
+                continue
+            if row["date_added"] > 1000000000000:  # Formatted as millseconds
+                row["date_added"] = row["date_added"] / 1000
+            if "date_added" not in row or row["date_added"] > time.time() + 120:
+                self.log.debug("Newsfeed item from the future from from site %s" % address)
+                continue  # Feed item is in the future, skip it
+            row["site"] = address
+            row["feed_name"] = name
+            rows.append(row)
+        rows.sort(key=lambda row: row["date_added"], reverse=True)
+        return rows
+
     @flag.admin
     def actionFeedQuery(self, to, limit=10, day_limit=3):
         from Site import SiteManager
-        rows = []
+        rows_feeds = []
         stats = []
+        queries = []  # Feeds not in cache: [(site, db, name, query, cache key, site change), ...]
 
         total_s = time.time()
         num_sites = 0
@@ -50,47 +130,56 @@ class UiWebsocketPlugin(object):
                 if not site or not site.storage.has_db:
                     continue
 
-                s = time.time()
                 try:
                     query_raw, params = query_set
-                    query_parts = re.split(r"UNION(?:\s+ALL|)", query_raw)
-                    for i, query_part in enumerate(query_parts):
-                        db_query = DbQuery(query_part)
-                        if day_limit:
-                            where = " WHERE %s > strftime('%%s', 'now', '-%s day')" % (db_query.fields.get("date_added", "date_added"), day_limit)
-                            if "WHERE" in query_part:
-                                query_part = re.sub("WHERE (.*?)(?=$| GROUP BY)", where+" AND (\\1)", query_part)
-                            else:
-                                query_part += where
-                        query_parts[i] = query_part
-                    query = " UNION ".join(query_parts)
-
-                    if ":params" in query:
-                        query_params = map(helper.sqlquote, params)
-                        query = query.replace(":params", ",".join(query_params))
-
-                    res = site.storage.query(query + " ORDER BY date_added DESC LIMIT %s" % limit)
+                    query = getFeedQuery(query_raw, tuple(params), day_limit)
+                    query += " ORDER BY date_added DESC LIMIT %s" % limit
 
+                    cache_key = (name, query)
+                    rows = feed_cache.get(address, cache_key)
+                    if rows is None:
+                        site_change = feed_cache.site_changes[address]
+                        if site.storage.db_update_queue:  # Include the recently changed files in the result
+                            site.storage.flushDbUpdates()
+                        queries.append((site, site.storage.getDb(), name, query, cache_key, site_change))
+                        continue
                 except Exception as err:  # Log error
                     self.log.error("%s feed query %s error: %s" % (address, name, Debug.formatException(err)))
                     stats.append({"site": site.address, "feed_name": name, "error": str(err)})
                     continue
 
-                for row in res:
-                    row = dict(row)
-                    if not isinstance(row["date_added"], (int, float, complex)):
-                        self.log.debug("Invalid date_added from site %s: %r" % (address, row["date_added"]))
-                        continue
-                    if row["date_added"] > 1000000000000:  # Formatted as millseconds
-                        row["date_added"] = row["date_added"] / 1000
-                    if "date_added" not in row or row["date_added"] > time.time() + 120:
-                        self.log.debug("Newsfeed item from the future from from site %s" % address)
-                        continue  # Feed item is in the future, skip it
-                    row["site"] = address
-                    row["feed_name"] = name
-                    rows.append(row)
-                stats.append({"site": site.address, "feed_name": name, "taken": round(time.time() - s, 3)})
-                time.sleep(0.001)
+                rows_feeds.append(rows)
+                stats.append({"site": site.address, "feed_name": name, "taken": 0.0, "cached": True})
+
+        # Query the rest of the feeds parallel
+        def queryFeedSite(args):
+            site, db, name, query, cache_key, site_change = args
+            s = time.time()
+            try:
+                res = self.queryFeed(db, query)
+            except Exception as err:
+                return args, None, err, time.time() - s
+            return args, res, None, time.time() - s
+
+        for (site, db, name, query, cache_key, site_change), res, err, taken in thread_pool_feed.imapUnordered(queryFeedSite, queries):
+            if err and err.__class__ is sqlite3.DatabaseError:  # Corrupted db, try again with rebuild
+                s = time.time()
+                try:
+                    res = [dict(row) for row in site.storage.query(query)]
+                    err = None
+                except Exception as err_retry:
+                    err = err_retry
+                taken += time.time() - s
+            if err:
+                self.log.error("%s feed query %s error: %s" % (site.address, name, Debug.formatException(err)))
+                stats.append({"site": site.address, "feed_name": name, "error": str(err)})
+                continue
+            rows = self.formatFeedRows(site.address, name, res)
+            feed_cache.set(site.address, cache_key, rows, site_change)
+            rows_feeds.append(rows)
+            stats.append({"site": site.address, "feed_name": name, "taken": round(taken, 3)})
+
+        rows = list(heapq.merge(*rows_feeds, key=lambda row: row["date_added"], reverse=True))
         return self.response(to, {"rows": rows, "stats": stats, "num": len(rows), "sites": num_sites, "taken": round(time.time() - total_s, 3)})
 
     def parseSearch(self, search):
@@ -177,6 +266,21 @@ class UiWebsocketPlugin(object):
         return self.response(to, {"rows": rows, "num": len(rows), "sites": num_sites, "taken": round(time.time() - total_s, 3), "stats": stats})
 
 
+@PluginManager.registerTo("SiteStorage")
+class SiteStoragePlugin(object):
+    def onUpdated(self, inner_path, file=None):
+        feed_cache.invalidate(self.site.address)
+        return super(SiteStoragePlugin, self).onUpdated(inner_path, file=file)
+
+    def rebuildDb(self, *args, **kwargs):
+        feed_cache.invalidate(self.site.address)
+        return super(SiteStoragePlugin, self).rebuildDb(*args, **kwargs)
+
+    def closeDb(self, *args, **kwargs):
+        feed_cache.invalidate(self.site.address)
+        return super(SiteStoragePlugin, self).closeDb(*args, **kwargs)
+
+
 @PluginManager.registerTo("User")
 class UserPlugin(object):
     # Set queries that user follows
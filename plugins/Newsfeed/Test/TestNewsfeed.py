@@ -0,0 +1,71 @@
+import threading
+
+import pytest
+import mock
+
+from Newsfeed import NewsfeedPlugin
+
+
+@pytest.mark.usefixtures("resetSettings")
+class TestNewsfeed:
+    def testFeedQuery(self, site, ui_websocket, user):
+        query_post = "SELECT post_id AS event_uri, 'post' AS type, date_published AS date_added, title, body, '?Post:' || post_id AS url FROM post"
+        user.sites[site.address] = {"follow": {
+            "Posts": [query_post + " WHERE post_id > :params", ["1"]],
+            "First post": [query_post + " WHERE post_id IN (:params)", ["1"]]
+        }}
+        site.settings["permissions"].append("ADMIN")
+        site.storage.getDb()  # Results of queries during the db rebuild are not cached
+        query_threads = []
+        query_feed = ui_websocket.queryFeed
+
+        def queryFeed(*args, **kwargs):
+            query_threads.append(threading.current_thread())
+            return query_feed(*args, **kwargs)
+
+        try:
+            with mock.patch.object(ui_websocket, "queryFeed", queryFeed):
+                res = ui_websocket.testAction("FeedQuery", limit=10, day_limit=0)
+                assert [stat.get("error") for stat in res["stats"]] == [None, None]
+                assert len(query_threads) == 2
+                assert threading.main_thread() not in query_threads
+
+                # Merged from every feeds ordered by date
+                assert res["num"] == len(res["rows"]) == 11  # Limit per feed
+                assert {row["feed_name"] for row in res["rows"]} == {"Posts", "First post"}
+                dates = [row["date_added"] for row in res["rows"]]
+                assert dates == sorted(dates, reverse=True)
+
+                # Not changed: served from cache
+                cache_info = NewsfeedPlugin.getFeedQuery.cache_info()
+                res_cached = ui_websocket.testAction("FeedQuery", limit=10, day_limit=0)
+                assert len(query_threads) == 2
+                assert res_cached["rows"] == res["rows"]
+                assert all(stat["cached"] for stat in res_cached["stats"])
+                assert NewsfeedPlugin.getFeedQuery.cache_info().hits == cache_info.hits + 2
+
+                # Different limit queries the db again
+                res_limit = ui_websocket.testAction("FeedQuery", limit=1, day_limit=0)
+                assert len(query_threads) == 4
+                assert len(res_limit["rows"]) == 2
+
+                # Site db changed
+                site.storage.onUpdated("data/data.json")
+                res = ui_websocket.testAction("FeedQuery", limit=10, day_limit=0)
+                assert len(query_threads) == 6
+                assert not any(stat.get("cached") for stat in res["stats"])
+        finally:
+            site.settings["permissions"].remove("ADMIN")
+
+    def testFeedCache(self):
+        feed_cache = NewsfeedPlugin.FeedCache(timeout=60)
+        site_change = feed_cache.site_changes["1Site"]
+        feed_cache.invalidate("1Site")  # Changed while querying
+        assert not feed_cache.set("1Site", ("Posts", "SELECT 1"), [], site_change)
+        assert feed_cache.get("1Site", ("Posts", "SELECT 1")) is None
+
+        assert feed_cache.set("1Site", ("Posts", "SELECT 1"), [{"date_added": 1}], feed_cache.site_changes["1Site"])
+        assert feed_cache.get("1Site", ("Posts", "SELECT 1")) == [{"date_added": 1}]
+
+        feed_cache.timeout = 0
+        assert feed_cache.get("1Site", ("Posts", "SELECT 1")) is None
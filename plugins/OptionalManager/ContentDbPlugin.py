@@ -219,6 +219,8 @@ class ContentDbPlugin(object):
         num_updated = 0
         num_site = 0
         for site in list(self.sites.values()):
+            if not site.isLoaded():
+                continue  # No peers or hashfield changes yet
             if not site.content_manager.has_optional_files:
                 continue
             if not site.isServing():
@@ -233,7 +235,7 @@ class ContentDbPlugin(object):
                 continue
 
             hashfield_peers = itertools.chain.from_iterable(
-                peer.hashfield.storage
+                peer.hashfield
                 for peer in site.peers.values()
                 if peer.has_hashfield
             )
@@ -52,6 +52,7 @@ class ContentDbPlugin(object):
             peer.reputation = row["reputation"]
             if row["address"].endswith(".onion"):
                 peer.reputation = peer.reputation / 2 - 1 # Onion peers less likely working
+            peer.updateScore()
             num += 1
         if num_hashfield:
             site.content_manager.has_optional_files = True
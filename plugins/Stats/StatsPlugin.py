@@ -96,7 +96,7 @@ class UiRequestPlugin(object):
                 ("%s", connection.type),
                 ("%s:%s", (connection.ip, connection.port)),
                 ("%s", connection.handshake.get("port_opened")),
-                ("<span title='%s %s'>%s</span>", (cipher, tls_version, connection.crypt)),
+                ("<span title='%s %s, compression: %s'>%s</span>", (cipher, tls_version, connection.compression, connection.crypt)),
                 ("%6.3f", connection.last_ping_delay),
                 ("%s", connection.incomplete_buff_recv),
                 ("%s", connection.bad_actions),
@@ -161,6 +161,15 @@ class UiRequestPlugin(object):
                 time.time() - db.last_query_time, db.db_path, db_size, json.dumps(table_rows, sort_keys=True)
             )
 
+    def renderContentCache(self):
+        from Content import ContentDbDict  # importing at the top of the file breaks plugins
+        content_cache = ContentDbDict.content_cache
+        yield "<br><br><b>Content.json cache</b>:<br>"
+        yield "- Size: %.3fMB / %.3fMB, items: %s, hit: %s, miss: %s, evicted: %s<br>" % (
+            content_cache.size / 1024.0 / 1024.0, content_cache.max_size / 1024.0 / 1024.0, len(content_cache.items),
+            content_cache.num_hit, content_cache.num_miss, content_cache.num_evicted
+        )
+
     def renderSites(self):
         yield "<br><br><b>Sites</b>:"
         yield "<table>"
@@ -385,6 +394,7 @@ class UiRequestPlugin(object):
             self.renderTrackers(),
             self.renderTor(),
             self.renderDbStats(),
+            self.renderContentCache(),
             self.renderSites(),
             self.renderBigfiles(),
             self.renderRequests()
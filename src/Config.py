@@ -253,9 +253,14 @@ class Config(object):
 
         self.parser.add_argument('--size_limit', help='Default site size limit in MB', default=10, type=int, metavar='limit')
         self.parser.add_argument('--file_size_limit', help='Maximum per file size limit in MB', default=10, type=int, metavar='limit')
+        self.parser.add_argument('--site_load_lazy', help='Load the sites on first access instead of at startup', type='bool', choices=[True, False], default=True)
+        self.parser.add_argument('--content_cache_size', help='Size of parsed content.json files kept in memory in MB', default=10, type=int, metavar='size')
         self.parser.add_argument('--connected_limit', help='Max connected peer per site', default=8, type=int, metavar='connected_limit')
         self.parser.add_argument('--global_connected_limit', help='Max connections', default=512, type=int, metavar='global_connected_limit')
         self.parser.add_argument('--workers', help='Download workers per site', default=5, type=int, metavar='workers')
+        self.parser.add_argument('--worker_pipeline', help='Max parallel file requests to one peer by the download workers', default=3, type=int, metavar='limit')
+        self.parser.add_argument('--request_inflight_limit', help='Max requests waiting for response per connection', default=10, type=int, metavar='limit')
+        self.parser.add_argument('--request_timeout', help='Give up waiting for a response after this many seconds', default=60, type=int, metavar='seconds')
 
         self.parser.add_argument('--fileserver_ip', help='FileServer bind address', default="*", metavar='ip')
         self.parser.add_argument('--fileserver_port', help='FileServer bind port (0: randomize)', default=0, type=int, metavar='port')
@@ -271,11 +276,14 @@ class Config(object):
         self.parser.add_argument('--trackers', help='Bootstraping torrent trackers', default=trackers, metavar='protocol://address', nargs='*')
         self.parser.add_argument('--trackers_file', help='Load torrent trackers dynamically from a file', metavar='path', nargs='*')
         self.parser.add_argument('--trackers_proxy', help='Force use proxy to connect to trackers (disable, tor, ip:port)', default="disable")
+        self.parser.add_argument('--compression_min_size', help='Compress messages larger than this size in bytes if the peer supports it (0: disable)', default=1024, type=int, metavar='bytes')
+        self.parser.add_argument('--sendfile', help='Use zero-copy os.sendfile to serve files on unencrypted connections', type='bool', choices=[True, False], default=True)
         self.parser.add_argument('--use_libsecp256k1', help='Use Libsecp256k1 liblary for speedup', type='bool', choices=[True, False], default=True)
         self.parser.add_argument('--use_openssl', help='Use OpenSSL liblary for speedup', type='bool', choices=[True, False], default=True)
         self.parser.add_argument('--openssl_lib_file', help='Path for OpenSSL library file (default: detect)', default=argparse.SUPPRESS, metavar="path")
         self.parser.add_argument('--openssl_bin_file', help='Path for OpenSSL binary file (default: detect)', default=argparse.SUPPRESS, metavar="path")
         self.parser.add_argument('--disable_db', help='Disable database updating', action='store_true')
+        self.parser.add_argument('--db_update_delay', help='Collect the json file database updates for this many seconds and do them in one batch', default=0.5, type=float, metavar='seconds')
         self.parser.add_argument('--disable_encryption', help='Disable connection encryption', action='store_true')
         self.parser.add_argument('--force_encryption', help="Enforce encryption to all peer connections", action='store_true')
         self.parser.add_argument('--disable_sslcompression', help='Disable SSL compression to save memory',
@@ -298,6 +306,7 @@ class Config(object):
         self.parser.add_argument('--threads_fs_write', help='Number of threads for file write operations', default=1, type=int)
         self.parser.add_argument('--threads_crypt', help='Number of threads for cryptographic operations', default=2, type=int)
         self.parser.add_argument('--threads_db', help='Number of threads for database operations', default=1, type=int)
+        self.parser.add_argument('--threads_fs_hash', help='Number of threads for file hash verification', default=min(os.cpu_count() or 1, 8), type=int)
 
         self.parser.add_argument("--download_optional", choices=["manual", "auto"], default="manual")
 
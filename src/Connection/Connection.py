@@ -1,7 +1,10 @@
+import os
+import io
 import socket
 import time
 
 import gevent
+import gevent.lock
 try:
     from gevent.coros import RLock
 except:
@@ -10,16 +13,17 @@ except:
 from Config import config
 from Debug import Debug
 from util import Msgpack
+from util import Compression
 from Crypt import CryptConnection
 from util import helper
 
 
 class Connection(object):
     __slots__ = (
-        "sock", "sock_wrapped", "ip", "port", "cert_pin", "target_onion", "id", "protocol", "type", "server", "unpacker", "unpacker_bytes", "req_id", "ip_type",
-        "handshake", "crypt", "connected", "event_connected", "closed", "start_time", "handshake_time", "last_recv_time", "is_private_ip", "is_tracker_connection",
+        "sock", "sock_wrapped", "ip", "port", "cert_pin", "target_onion", "id", "protocol", "type", "server", "unpacker", "unpacker_bytes", "stream_buff", "req_id", "ip_type",
+        "handshake", "crypt", "compression", "connected", "event_connected", "closed", "start_time", "handshake_time", "last_recv_time", "is_private_ip", "is_tracker_connection",
         "last_message_time", "last_send_time", "last_sent_time", "incomplete_buff_recv", "bytes_recv", "bytes_sent", "cpu_time", "send_lock",
-        "last_ping_delay", "last_req_time", "last_cmd_sent", "last_cmd_recv", "bad_actions", "sites", "name", "waiting_requests", "waiting_streams"
+        "last_ping_delay", "last_req_time", "last_cmd_sent", "last_cmd_recv", "bad_actions", "sites", "key", "name", "waiting_requests", "waiting_streams", "request_slots"
     )
 
     def __init__(self, server, ip, port, sock=None, target_onion=None, is_tracker_connection=False):
@@ -28,6 +32,7 @@ class Connection(object):
         if "#" in ip:
             ip, self.cert_pin = ip.split("#")
         self.target_onion = target_onion  # Requested onion adress
+        self.key = None  # ip:port of the peer's fileserver registered in server.connections_by_key
         self.id = server.last_connection_id
         server.last_connection_id += 1
         self.protocol = "?"
@@ -45,9 +50,11 @@ class Connection(object):
         self.server = server
         self.unpacker = None  # Stream incoming socket messages here
         self.unpacker_bytes = 0  # How many bytes the unpacker received
+        self.stream_buff = None  # Preallocated buffer for receiving streams
         self.req_id = 0  # Last request id
         self.handshake = {}  # Handshake info got from peer
         self.crypt = None  # Connection encryption method
+        self.compression = None  # Message compression method agreed in handshake
         self.sock_wrapped = False  # Socket wrapped to encryption
 
         self.connected = False
@@ -78,6 +85,7 @@ class Connection(object):
 
         self.waiting_requests = {}  # Waiting sent requests
         self.waiting_streams = {}  # Waiting response file streams
+        self.request_slots = gevent.lock.BoundedSemaphore(config.request_inflight_limit)  # Limit requests waiting for response
 
     def setIp(self, ip):
         self.ip = ip
@@ -199,11 +207,12 @@ class Connection(object):
                 self.log("Socket peek error: %s" % Debug.formatException(err))
         self.messageLoop()
 
+    # Decode bin to str for the peers without use_bin_type (backward compatibility for <0.7.0)
+    def isMsgpackDecode(self):
+        return not (self.handshake and self.handshake.get("use_bin_type"))
+
     def getMsgpackUnpacker(self):
-        if self.handshake and self.handshake.get("use_bin_type"):
-            return Msgpack.getUnpacker(fallback=True, decode=False)
-        else:  # Backward compatibility for <0.7.0
-            return Msgpack.getUnpacker(fallback=True, decode=True)
+        return Msgpack.getUnpacker(fallback=True, decode=self.isMsgpackDecode())
 
     # Message loop for connection
     def messageLoop(self):
@@ -247,6 +256,8 @@ class Connection(object):
                         if config.debug_socket:
                             self.log("Invalid message type: %s, content: %r, buffer: %r" % (type(message), message, buff[0:16]))
                         raise Exception("Invalid message type: %s" % type(message))
+                    if "compressed" in message:
+                        message = self.decompressMessage(message)
 
                     # Stats
                     self.incomplete_buff_recv = 0
@@ -264,12 +275,7 @@ class Connection(object):
 
                     # Handle message
                     if "stream_bytes" in message:
-                        buff_left = self.handleStream(message, buff)
-                        self.unpacker = self.getMsgpackUnpacker()
-                        self.unpacker.feed(buff_left)
-                        self.unpacker_bytes = len(buff_left)
-                        if config.debug_socket:
-                            self.log("Start new unpacker with buff_left: %r" % buff_left)
+                        self.handleStream(message)
                     else:
                         self.handleMessage(message)
 
@@ -281,44 +287,63 @@ class Connection(object):
                 self.server.stat_recv["error: %s" % err]["num"] += 1
         self.close("MessageLoop ended (closed: %s)" % self.closed)  # MessageLoop ended, close connection
 
+    # Unpack the original message from a compressed one
+    def decompressMessage(self, message):
+        data = Compression.decompress(message["data"], message["compressed"], max_size=5 * 1024 * 1024)
+        message = Msgpack.unpack(data, decode=self.isMsgpackDecode())  # Same types as the uncompressed messages
+        if not type(message) is dict:
+            raise Exception("Invalid compressed message type: %s" % type(message))
+        return message
+
+    # Number of bytes fed to the unpacker, but not processed yet
     def getUnpackerUnprocessedBytesNum(self):
-        if "tell" in dir(self.unpacker):
-            bytes_num = self.unpacker_bytes - self.unpacker.tell()
-        else:
-            bytes_num = self.unpacker._fb_buf_n - self.unpacker._fb_buf_o
-        return bytes_num
+        return self.unpacker_bytes - self.unpacker.tell()
 
     # Stream socket directly to a file
-    def handleStream(self, message, buff):
+    def handleStream(self, message):
         stream_bytes_left = message["stream_bytes"]
-        file = self.waiting_streams[message["to"]]
+        file_drop = io.BytesIO()  # Read and drop the stream of the timed out requests
+        if message["to"] in self.waiting_streams:
+            file = self.waiting_streams[message["to"]]
+        else:
+            self.log("Dropping stream to unknown request: %s" % message["to"])
+            file = file_drop
 
         unprocessed_bytes_num = self.getUnpackerUnprocessedBytesNum()
 
-        if unprocessed_bytes_num:  # Found stream bytes in unpacker
+        if unprocessed_bytes_num:  # Found stream bytes in unpacker, the rest of the data stays there for the next messages
             unpacker_stream_bytes = min(unprocessed_bytes_num, stream_bytes_left)
-            buff_stream_start = len(buff) - unprocessed_bytes_num
-            file.write(buff[buff_stream_start:buff_stream_start + unpacker_stream_bytes])
+            file.write(self.unpacker.read_bytes(unpacker_stream_bytes))
             stream_bytes_left -= unpacker_stream_bytes
+            if message["to"] in self.waiting_requests:
+                self.waiting_requests[message["to"]]["time_progress"] = time.time()
         else:
             unpacker_stream_bytes = 0
 
         if config.debug_socket:
             self.log(
-                "Starting stream %s: %s bytes (%s from unpacker, buff size: %s, unprocessed: %s)" %
-                (message["to"], message["stream_bytes"], unpacker_stream_bytes, len(buff), unprocessed_bytes_num)
+                "Starting stream %s: %s bytes (%s from unpacker, unprocessed: %s)" %
+                (message["to"], message["stream_bytes"], unpacker_stream_bytes, unprocessed_bytes_num)
             )
 
+        if stream_bytes_left > 0 and self.stream_buff is None:
+            self.stream_buff = memoryview(bytearray(64 * 1024))
+
         try:
             while 1:
                 if stream_bytes_left <= 0:
                     break
-                stream_buff = self.sock.recv(min(64 * 1024, stream_bytes_left))
-                if not stream_buff:
+                buff_len = self.sock.recv_into(self.stream_buff, min(64 * 1024, stream_bytes_left))
+                if not buff_len:
                     break
-                buff_len = len(stream_buff)
                 stream_bytes_left -= buff_len
-                file.write(stream_buff)
+                request = self.waiting_requests.get(message["to"])
+                if request:
+                    request["time_progress"] = time.time()  # Receiving, extend the request timeout
+                elif file is not file_drop:  # Request timed out during the stream: don't touch the caller's buffer anymore
+                    self.log("Request timed out, dropping the rest of the stream: %s" % message["to"])
+                    file = file_drop
+                file.write(self.stream_buff[:buff_len])
 
                 # Statistics
                 self.last_recv_time = time.time()
@@ -332,14 +357,10 @@ class Connection(object):
             self.log("End stream %s, file pos: %s" % (message["to"], file.tell()))
 
         self.incomplete_buff_recv = 0
-        self.waiting_requests[message["to"]]["evt"].set(message)  # Set the response to event
-        del self.waiting_streams[message["to"]]
-        del self.waiting_requests[message["to"]]
-
-        if unpacker_stream_bytes:
-            return buff[buff_stream_start + unpacker_stream_bytes:]
-        else:
-            return b""
+        request = self.waiting_requests.pop(message["to"], None)
+        self.waiting_streams.pop(message["to"], None)
+        if request:
+            request["evt"].set(message)  # Set the response to event
 
     # My handshake info
     def getHandshakeInfo(self):
@@ -374,6 +395,8 @@ class Connection(object):
             "crypt": self.crypt,
             "time": int(time.time())
         }
+        if config.compression_min_size:
+            handshake["compression_supported"] = Compression.getSupported()
         if self.target_onion:
             handshake["onion"] = self.target_onion
         elif self.ip_type == "onion":
@@ -397,6 +420,14 @@ class Connection(object):
             return False
 
         self.handshake = handshake
+        compression_supported = handshake.get("compression_supported")
+        if config.compression_min_size and type(compression_supported) is list and compression_supported:
+            handshake["compression_supported"] = [
+                item.decode("utf8", "ignore") if type(item) is bytes else item  # Received before use_bin_type
+                for item in compression_supported
+            ]
+            self.compression = Compression.select(handshake["compression_supported"])
+
         if handshake.get("port_opened", None) is False and "onion" not in handshake and not self.is_private_ip:  # Not connectable
             self.port = 0
         else:
@@ -434,6 +465,9 @@ class Connection(object):
             self.server.ips[self.ip] = self
             self.updateName()
 
+        if self.key:  # Port of incoming connections is known from the handshake
+            self.server.setConnectionKey(self)
+
         self.event_connected.set(True)  # Mark handshake as done
         self.event_connected = None
         self.handshake_time = time.time()
@@ -529,14 +563,20 @@ class Connection(object):
 
             self.server.stat_sent[stat_key]["num"] += 1
             if streaming:
+                if self.isSendfileSupported():
+                    file_writer = self.sendfile
+                else:
+                    file_writer = None
                 with self.send_lock:
-                    bytes_sent = Msgpack.stream(message, self.sock.sendall)
+                    bytes_sent = Msgpack.stream(message, self.sock.sendall, file_writer=file_writer)
                 self.bytes_sent += bytes_sent
                 self.server.bytes_sent += bytes_sent
                 self.server.stat_sent[stat_key]["bytes"] += bytes_sent
                 message = None
             else:
                 data = Msgpack.pack(message)
+                if self.compression and len(data) >= config.compression_min_size and message.get("to") != 0 and message.get("cmd") != "handshake":
+                    data = Msgpack.pack({"compressed": self.compression, "data": Compression.compress(data, self.compression)})
                 self.bytes_sent += len(data)
                 self.server.bytes_sent += len(data)
                 self.server.stat_sent[stat_key]["bytes"] += len(data)
@@ -549,44 +589,97 @@ class Connection(object):
         self.last_sent_time = time.time()
         return True
 
-    # Stream file to connection without msgpacking
-    def sendRawfile(self, file, read_bytes):
+    # Zero-copy sending of files is only possible on unencrypted connections
+    def isSendfileSupported(self):
+        return config.sendfile and not self.crypt and hasattr(os, "sendfile")
+
+    # Send the file content from the current position using os.sendfile (send_lock must be acquired)
+    def sendfile(self, file, size):
+        if not helper.isSendfileSupported(file):
+            return self.sendfileCopy(file, size)
+        self.last_send_time = time.time()
+        offset = file.tell()
+        bytes_sent = helper.sendfile(self.sock, file, offset, size)
+        file.seek(offset + bytes_sent)
+        return bytes_sent
+
+    # Send the file content from the current position using read and sendall (send_lock must be acquired)
+    def sendfileCopy(self, file, size):
         buff = 64 * 1024
-        bytes_left = read_bytes
+        bytes_left = size
         bytes_sent = 0
         while True:
             self.last_send_time = time.time()
             data = file.read(min(bytes_left, buff))
             bytes_sent += len(data)
-            with self.send_lock:
-                self.sock.sendall(data)
+            self.sock.sendall(data)
             bytes_left -= buff
             if bytes_left <= 0:
                 break
+        return bytes_sent
+
+    # Stream file to connection without msgpacking
+    def sendRawfile(self, file, read_bytes):
+        with self.send_lock:
+            if self.isSendfileSupported():
+                bytes_sent = self.sendfile(file, read_bytes)
+            else:
+                bytes_sent = self.sendfileCopy(file, read_bytes)
         self.bytes_sent += bytes_sent
         self.server.bytes_sent += bytes_sent
         self.server.stat_sent["raw_file"]["num"] += 1
         self.server.stat_sent["raw_file"]["bytes"] += bytes_sent
         return True
 
+    # Waiting for response for more than 10 sec, but nothing received from the peer
+    def isStalled(self):
+        if not self.waiting_requests or self.protocol != "v2":
+            return False
+        oldest_request_time = min(request["time"] for request in self.waiting_requests.values())
+        return time.time() - max(oldest_request_time, self.last_recv_time) > 10
+
     # Create and send a request to peer
-    def request(self, cmd, params={}, stream_to=None):
-        # Last command sent more than 10 sec ago, timeout
-        if self.waiting_requests and self.protocol == "v2" and time.time() - max(self.last_req_time, self.last_recv_time) > 10:
+    # Return: Response or False on error or if no response or stream data received within timeout (other requests are not affected)
+    def request(self, cmd, params={}, stream_to=None, timeout=None):
+        if self.isStalled():
             self.close("Request %s timeout: %.3fs" % (self.last_cmd_sent, time.time() - self.last_send_time))
             return False
 
+        if timeout is None:
+            timeout = config.request_timeout
+        time_start = time.time()
+        if not self.request_slots.acquire(timeout=timeout):  # Too many requests in-flight
+            self.log("Request %s timeout: No free request slot in %.3fs" % (cmd, timeout))
+            return False
+
         self.last_req_time = time.time()
         self.last_cmd_sent = cmd
         self.req_id += 1
-        data = {"cmd": cmd, "req_id": self.req_id, "params": params}
+        req_id = self.req_id
+        data = {"cmd": cmd, "req_id": req_id, "params": params}
         event = gevent.event.AsyncResult()  # Create new event for response
-        self.waiting_requests[self.req_id] = {"evt": event, "cmd": cmd}
+        request = {"evt": event, "cmd": cmd, "time": self.last_req_time, "time_progress": time_start}
+        self.waiting_requests[req_id] = request
         if stream_to:
-            self.waiting_streams[self.req_id] = stream_to
-        self.send(data)  # Send request
-        res = event.get()  # Wait until event solves
-        return res
+            self.waiting_streams[req_id] = stream_to
+        try:
+            self.send(data)  # Send request
+            while not event.ready():  # Wait until event solves, the timeout restarts when the stream receives data
+                time_left = request["time_progress"] + timeout - time.time()
+                if time_left <= 0:
+                    break
+                event.wait(timeout=time_left)
+        finally:
+            self.request_slots.release()
+            if not event.ready():  # Timeout or the waiting greenlet killed: Late response will be ignored
+                self.waiting_requests.pop(req_id, None)
+                self.waiting_streams.pop(req_id, None)
+
+        if event.ready():
+            return event.get()
+        else:
+            self.log("Request %s #%s timeout: %.3fs (no progress in %.3fs)" % (cmd, req_id, time.time() - time_start, time.time() - request["time_progress"]))
+            return False
 
     def ping(self):
         s = time.time()
@@ -632,4 +725,5 @@ class Connection(object):
         # Little cleanup
         self.sock = None
         self.unpacker = None
+        self.stream_buff = None
         self.event_connected = None
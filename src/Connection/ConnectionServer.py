@@ -41,6 +41,8 @@ class ConnectionServer(object):
         self.ip_incoming = {}  # Incoming connections from ip in the last minute to avoid connection flood
         self.broken_ssl_ips = {}  # Peerids of broken ssl connections
         self.ips = {}  # Connection by ip
+        self.connections_by_key = {}  # Connections by ip:port of the peer's fileserver
+        self.indexed_sites = set()  # Sites keeping index of their connected peers
         self.has_internet = True  # Internet outage detection
 
         self.stream_server = None
@@ -155,6 +157,7 @@ class ConnectionServer(object):
 
         connection = Connection(self, ip, port, sock)
         self.connections.append(connection)
+        self.setConnectionKey(connection)
         if ip not in config.ip_local:
             self.ips[ip] = connection
         connection.handleIncomingConnection(sock)
@@ -214,6 +217,7 @@ class ConnectionServer(object):
                 self.num_outgoing += 1
                 self.ips[key] = connection
                 self.connections.append(connection)
+                self.setConnectionKey(connection)
                 connection.log("Connecting... (site: %s)" % site)
                 succ = connection.connect()
                 if not succ:
@@ -245,6 +249,33 @@ class ConnectionServer(object):
 
         if connection in self.connections:
             self.connections.remove(connection)
+        self.removeConnectionKey(connection)
+
+    # Register connection by ip:port, called again when the handshake changes the port or ip
+    def setConnectionKey(self, connection):
+        key = "%s:%s" % (connection.ip, connection.port)
+        if connection.key == key or connection.closed:
+            return
+        self.removeConnectionKey(connection)
+        connection.key = key
+        connections = self.connections_by_key.setdefault(key, [])
+        connections.append(connection)
+        if len(connections) == 1:  # First connection to this peer
+            for site in list(self.indexed_sites):
+                site.updateConnectedPeer(key)
+
+    def removeConnectionKey(self, connection):
+        key = connection.key
+        if not key:
+            return
+        connection.key = None
+        connections = self.connections_by_key.get(key, [])
+        if connection in connections:
+            connections.remove(connection)
+        if not connections:  # No more connection to this peer
+            self.connections_by_key.pop(key, None)
+            for site in list(self.indexed_sites):
+                site.updateConnectedPeer(key)
 
     def checkConnections(self):
         run_i = 0
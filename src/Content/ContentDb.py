@@ -1,4 +1,5 @@
 import os
+import time
 
 from Db.Db import Db, DbTableError
 from Config import config
@@ -12,6 +13,8 @@ class ContentDb(Db):
         Db.__init__(self, {"db_name": "ContentDb", "tables": {}}, path)
         self.foreign_keys = True
 
+    verified_signs_limit = 100000  # Max number of cached sign verification results
+
     def init(self):
         try:
             self.schema = self.getSchema()
@@ -36,6 +39,8 @@ class ContentDb(Db):
                 pass
         self.site_ids = {}
         self.sites = {}
+        self.site_sizes = {}  # Size totals of the sites, maintained on content changes, Key: address, Value: [size, size_optional]
+        self.num_verified_sign_added = 0
 
     def getSchema(self):
         schema = {}
@@ -79,11 +84,49 @@ class ContentDb(Db):
             "schema_changed": 1
         }
 
+        schema["tables"]["file_stat"] = {
+            "cols": [
+                ["site_id", "INTEGER REFERENCES site (site_id) ON DELETE CASCADE"],
+                ["inner_path", "TEXT"],
+                ["size", "INTEGER"],
+                ["mtime", "INTEGER"],
+                ["inode", "INTEGER"],
+                ["sha512", "TEXT"]
+            ],
+            "indexes": [
+                "CREATE UNIQUE INDEX file_stat_key ON file_stat (site_id, inner_path)"
+            ],
+            "schema_changed": 1
+        }
+
+        schema["tables"]["verified_sign"] = {
+            "cols": [
+                ["data_hash", "TEXT"],
+                ["address", "TEXT"],
+                ["sign", "TEXT"],
+                ["time_added", "INTEGER"]
+            ],
+            "indexes": [
+                "CREATE UNIQUE INDEX verified_sign_key ON verified_sign (data_hash, address, sign)"
+            ],
+            "schema_changed": 1
+        }
+
         return schema
 
     def initSite(self, site):
         self.sites[site.address] = site
 
+    # Add a not yet loaded site, initSite is called when its contents are loaded
+    def registerSite(self, site):
+        self.needSite(site)
+        self.sites[site.address] = site
+
+    # Return: Addresses of the sites with their root content.json stored
+    def getSitesWithContent(self):
+        res = self.execute("SELECT address FROM content LEFT JOIN site USING (site_id) WHERE inner_path = 'content.json'")
+        return set(row["address"] for row in res)
+
     def needSite(self, site):
         if site.address not in self.site_ids:
             self.execute("INSERT OR IGNORE INTO site ?", {"address": site.address})
@@ -98,19 +141,39 @@ class ContentDb(Db):
             self.execute("DELETE FROM site WHERE site_id = :site_id", {"site_id": site_id})
             del self.site_ids[site.address]
             del self.sites[site.address]
+        self.site_sizes.pop(site.address, None)
+
+    # Add the size change of a content.json to the site totals if they are already calculated
+    def updateSiteSize(self, site, inner_path, size=0, size_optional=0):
+        site_size = self.site_sizes.get(site.address)
+        if not site_size:
+            return False
+        row = self.execute(
+            "SELECT size + size_files AS size, size_files_optional AS size_optional FROM content WHERE ?",
+            {"site_id": self.site_ids.get(site.address, 0), "inner_path": inner_path}
+        ).fetchone()
+        if row:
+            size -= row["size"] or 0
+            size_optional -= row["size_optional"] or 0
+        site_size[0] += size
+        site_size[1] += size_optional
+        return True
 
     def setContent(self, site, inner_path, content, size=0):
-        self.insertOrUpdate("content", {
+        row = {
             "size": size,
             "size_files": sum([val["size"] for key, val in content.get("files", {}).items()]),
             "size_files_optional": sum([val["size"] for key, val in content.get("files_optional", {}).items()]),
             "modified": int(content.get("modified", 0))
-        }, {
+        }
+        self.updateSiteSize(site, inner_path, row["size"] + row["size_files"], row["size_files_optional"])
+        self.insertOrUpdate("content", row, {
             "site_id": self.site_ids.get(site.address, 0),
             "inner_path": inner_path
         })
 
     def deleteContent(self, site, inner_path):
+        self.updateSiteSize(site, inner_path)
         self.execute("DELETE FROM content WHERE ?", {"site_id": self.site_ids.get(site.address, 0), "inner_path": inner_path})
 
     def loadDbDict(self, site):
@@ -126,6 +189,9 @@ class ContentDb(Db):
             return {}
 
     def getTotalSize(self, site, ignore=None):
+        if not ignore and site.address in self.site_sizes:
+            return tuple(self.site_sizes[site.address])
+
         params = {"site_id": self.site_ids.get(site.address, 0)}
         if ignore:
             params["not__inner_path"] = ignore
@@ -137,6 +203,9 @@ class ContentDb(Db):
         if not row["size_optional"]:
             row["size_optional"] = 0
 
+        if not ignore and site.address in self.site_ids:
+            self.site_sizes[site.address] = [row["size"], row["size_optional"]]
+
         return row["size"], row["size_optional"]
 
     def listModified(self, site, after=None, before=None):
@@ -148,6 +217,42 @@ class ContentDb(Db):
         res = self.execute("SELECT inner_path, modified FROM content WHERE ?", params)
         return {row["inner_path"]: row["modified"] for row in res}
 
+    # Stat of the files at their last successful sha512 verification
+    # Return: {inner_path: (size, mtime, inode, sha512), ...}
+    def getFileStats(self, site):
+        res = self.execute("SELECT * FROM file_stat WHERE ?", {"site_id": self.site_ids.get(site.address, 0)})
+        return {row["inner_path"]: (row["size"], row["mtime"], row["inode"], row["sha512"]) for row in res}
+
+    def setFileStats(self, site, file_stats):
+        site_id = self.site_ids.get(site.address, 0)
+        self.getCursor().executemany(
+            "INSERT OR REPLACE INTO file_stat (site_id, inner_path, size, mtime, inode, sha512) VALUES (?, ?, ?, ?, ?, ?)",
+            [(site_id, inner_path) + tuple(file_stat) for inner_path, file_stat in file_stats.items()]
+        )
+
+    def deleteFileStats(self, site, inner_paths):
+        self.execute("DELETE FROM file_stat WHERE ?", {"site_id": self.site_ids.get(site.address, 0), "inner_path": list(inner_paths)})
+
+    # Signs that passed the verification before, the data is identified by its sha256 hash
+    def isSignVerified(self, data_hash, address, sign):
+        res = self.execute(
+            "SELECT 1 FROM verified_sign WHERE ? LIMIT 1",
+            {"data_hash": data_hash, "address": address, "sign": sign}
+        )
+        return bool(res.fetchone())
+
+    def addVerifiedSign(self, data_hash, address, sign):
+        self.execute("INSERT OR IGNORE INTO verified_sign ?", {
+            "data_hash": data_hash, "address": address, "sign": sign, "time_added": int(time.time())
+        })
+        self.num_verified_sign_added += 1
+        if self.num_verified_sign_added % 1000 == 0:  # Drop the oldest ones over the limit
+            self.execute(
+                "DELETE FROM verified_sign WHERE rowid <= (SELECT MAX(rowid) FROM verified_sign) - :limit",
+                {"limit": self.verified_signs_limit}
+            )
+
+
 content_dbs = {}
 
 
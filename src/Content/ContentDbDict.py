@@ -1,16 +1,66 @@
 import time
 import os
+import collections
+import weakref
 
 from . import ContentDb
 from Debug import Debug
 from Config import config
 
 
+# Least recently used parsed content.json files of all sites, limited by the size of the files
+class ContentCache(object):
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.items = collections.OrderedDict()  # (site address, key): (weakref to content_db_dict, size)
+        self.num_hit = 0
+        self.num_miss = 0
+        self.num_evicted = 0
+
+    # Add or mark the key as most recently used
+    def touch(self, contents, key, size):
+        item_id = (contents.site.address, key)
+        if item_id in self.items:
+            self.size -= self.items.pop(item_id)[1]
+        self.items[item_id] = (weakref.ref(contents), size)
+        self.size += size
+        self.checkLimit()
+
+    def hit(self, contents, key):
+        self.num_hit += 1
+        item_id = (contents.site.address, key)
+        if item_id in self.items:
+            self.items.move_to_end(item_id)
+
+    def remove(self, contents, key):
+        item = self.items.pop((contents.site.address, key), None)
+        if item:
+            self.size -= item[1]
+
+    # Remove all items of a deleted site
+    def removeSite(self, address):
+        for item_id in [item_id for item_id in self.items if item_id[0] == address]:
+            self.size -= self.items.pop(item_id)[1]
+
+    # Purge the least recently used items until we fit into the size limit (always keep the latest one)
+    def checkLimit(self):
+        while self.size > self.max_size and len(self.items) > 1:
+            (address, key), (contents_ref, size) = self.items.popitem(last=False)
+            self.size -= size
+            self.num_evicted += 1
+            contents = contents_ref()
+            if contents is not None and dict.get(contents, key):
+                dict.__setitem__(contents, key, False)
+
+
+content_cache = ContentCache(config.content_cache_size * 1024 * 1024)
+
+
 class ContentDbDict(dict):
     def __init__(self, site, *args, **kwargs):
         s = time.time()
         self.site = site
-        self.cached_keys = []
         self.log = self.site.log
         self.db = ContentDb.getContentDb()
         self.db_id = self.db.needSite(site)
@@ -33,27 +83,28 @@ class ContentDbDict(dict):
                 self.__delitem__(key)  # File not exists anymore
             raise KeyError(key)
 
+        content_cache.num_miss += 1
         self.addCachedKey(key)
-        self.checkLimit()
 
         return content
 
     def getItemSize(self, key):
         return self.site.storage.getSize(key)
 
-    # Only keep last 10 accessed json in memory
-    def checkLimit(self):
-        if len(self.cached_keys) > 10:
-            key_deleted = self.cached_keys.pop(0)
-            dict.__setitem__(self, key_deleted, False)
-
-    def addCachedKey(self, key):
-        if key not in self.cached_keys and key != "content.json" and len(key) > 40:  # Always keep keys smaller than 40 char
-            self.cached_keys.append(key)
+    # Only keep the recently accessed json files in memory
+    def addCachedKey(self, key, size=None):
+        if key != "content.json" and len(key) > 40:  # Always keep keys smaller than 40 char
+            if size is None:
+                try:
+                    size = self.getItemSize(key)
+                except Exception:
+                    size = 0
+            content_cache.touch(self, key, size)
 
     def __getitem__(self, key):
         val = dict.get(self, key)
         if val:  # Already loaded
+            content_cache.hit(self, key)
             return val
         elif val is None:  # Unknown key
             raise KeyError(key)
@@ -61,19 +112,15 @@ class ContentDbDict(dict):
             return self.loadItem(key)
 
     def __setitem__(self, key, val):
-        self.addCachedKey(key)
-        self.checkLimit()
         size = self.getItemSize(key)
         self.db.setContent(self.site, key, val, size)
         dict.__setitem__(self, key, val)
+        self.addCachedKey(key, size)
 
     def __delitem__(self, key):
         self.db.deleteContent(self.site, key)
         dict.__delitem__(self, key)
-        try:
-            self.cached_keys.remove(key)
-        except ValueError:
-            pass
+        content_cache.remove(self, key)
 
     def iteritems(self):
         for key in dict.keys(self):
@@ -1,15 +1,18 @@
 import json
 import time
+import hashlib
 import re
 import os
 import copy
 import base64
 import sys
+import collections
 
 import gevent
 
 from Debug import Debug
 from Crypt import CryptHash
+from Crypt import Crypt
 from Config import config
 from util import helper
 from util import Diff
@@ -29,6 +32,8 @@ class SignError(Exception):
 
 @PluginManager.acceptPlugins
 class ContentManager(object):
+    verified_signs = collections.OrderedDict()  # Recently verified valid signs of all sites, Key: (data sha256, address, sign)
+    verified_signs_limit = 10000
 
     def __init__(self, site):
         self.site = site
@@ -802,10 +807,80 @@ class ContentManager(object):
     def getSignsRequired(self, inner_path, content=None):
         return 1  # Todo: Multisig
 
-    def verifyCertSign(self, user_address, user_auth_type, user_name, issuer_address, sign):
+    # Return: The string that the signs of the content.json are created for
+    def getSignContent(self, content):
+        content = {key: val for key, val in content.items() if key not in ("sign", "signs")}  # Signed without the signs
+        sign_content = json.dumps(content, sort_keys=True)  # Dump the json to string to remove whitepsace
+
+        # Fix float representation error on Android
+        modified = content["modified"]
+        if config.fix_float_decimals and type(modified) is float and not str(modified).endswith(".0"):
+            modified_fixed = "{:.6f}".format(modified).strip("0.")
+            sign_content = sign_content.replace(
+                '"modified": %s' % repr(modified),
+                '"modified": %s' % modified_fixed
+            )
+        return sign_content
+
+    def getSignKey(self, data, address, sign):
+        if type(address) is list:  # Any address in the list
+            address = ",".join(address)
+        return (hashlib.sha256(data.encode("utf8")).hexdigest(), address, sign)
+
+    # Check the sign in the crypt thread pool, so other downloads can continue meanwhile
+    @Crypt.thread_pool_crypt.wrap
+    def verifySignUncached(self, data, address, sign):
+        from Crypt import CryptBitcoin
+        return CryptBitcoin.verify(data, address, sign)
+
+    def addVerifiedSign(self, sign_key):
+        self.verified_signs[sign_key] = True
+        if len(self.verified_signs) > self.verified_signs_limit:
+            self.verified_signs.popitem(last=False)  # Drop the least recently used one
+
+    # Check the sign, the valid ones are kept in memory, so they are not checked again
+    def verifySign(self, data, address, sign):
+        if not sign:
+            return False
+        sign_key = self.getSignKey(data, address, sign)
+        if sign_key in self.verified_signs:
+            self.verified_signs.move_to_end(sign_key)
+            return True
+        valid = self.verifySignUncached(data, address, sign)
+        if valid:
+            self.addVerifiedSign(sign_key)
+        return valid
+
+    # Check many signs in parallel using the crypt thread pool, the valid ones are also stored in content.db,
+    # so they are not checked again after restart
+    # Return: [True or False, ...] in the same order as sign_items [(data, address, sign), ...]
+    def verifySigns(self, sign_items):
         from Crypt import CryptBitcoin
+        results = [False] * len(sign_items)
+        sign_keys = {}
+        for i, (data, address, sign) in enumerate(sign_items):
+            if not sign:
+                continue
+            sign_key = self.getSignKey(data, address, sign)
+            if sign_key in self.verified_signs or self.contents.db.isSignVerified(*sign_key):
+                self.addVerifiedSign(sign_key)
+                results[i] = True
+            else:
+                sign_keys[i] = sign_key
+
+        def verifyItem(i):
+            return i, CryptBitcoin.verify(*sign_items[i])
+
+        for i, valid in Crypt.thread_pool_crypt.imapUnordered(verifyItem, list(sign_keys.keys())):
+            results[i] = valid
+            if valid:
+                self.addVerifiedSign(sign_keys[i])
+                self.contents.db.addVerifiedSign(*sign_keys[i])
+        return results
+
+    def verifyCertSign(self, user_address, user_auth_type, user_name, issuer_address, sign):
         cert_subject = "%s#%s/%s" % (user_address, user_auth_type, user_name)
-        return CryptBitcoin.verify(cert_subject, issuer_address, sign)
+        return self.verifySign(cert_subject, issuer_address, sign)
 
     def verifyCert(self, inner_path, content):
         rules = self.getRules(inner_path, content)
@@ -929,7 +1004,6 @@ class ContentManager(object):
     # Return: None = Same as before, False = Invalid, True = Valid
     def verifyFile(self, inner_path, file, ignore_same=True):
         if inner_path.endswith("content.json"):  # content.json: Check using sign
-            from Crypt import CryptBitcoin
             try:
                 if type(file) is dict:
                     new_content = file
@@ -965,16 +1039,7 @@ class ContentManager(object):
                 if "signs" in new_content:
                     del(new_content["signs"])  # The file signed without the signs
 
-                sign_content = json.dumps(new_content, sort_keys=True)  # Dump the json to string to remove whitepsace
-
-                # Fix float representation error on Android
-                modified = new_content["modified"]
-                if config.fix_float_decimals and type(modified) is float and not str(modified).endswith(".0"):
-                    modified_fixed = "{:.6f}".format(modified).strip("0.")
-                    sign_content = sign_content.replace(
-                        '"modified": %s' % repr(modified),
-                        '"modified": %s' % modified_fixed
-                    )
+                sign_content = self.getSignContent(new_content)
 
                 if signs:  # New style signing
                     valid_signers = self.getValidSigners(inner_path, new_content)
@@ -982,7 +1047,7 @@ class ContentManager(object):
 
                     if inner_path == "content.json" and len(valid_signers) > 1:  # Check signers_sign on root content.json
                         signers_data = "%s:%s" % (signs_required, ",".join(valid_signers))
-                        if not CryptBitcoin.verify(signers_data, self.site.address, new_content["signers_sign"]):
+                        if not self.verifySign(signers_data, self.site.address, new_content["signers_sign"]):
                             raise VerifyError("Invalid signers_sign!")
 
                     if inner_path != "content.json" and not self.verifyCert(inner_path, new_content):  # Check if cert valid
@@ -991,7 +1056,7 @@ class ContentManager(object):
                     valid_signs = 0
                     for address in valid_signers:
                         if address in signs:
-                            valid_signs += CryptBitcoin.verify(sign_content, address, signs[address])
+                            valid_signs += self.verifySign(sign_content, address, signs[address])
                         if valid_signs >= signs_required:
                             break  # Break if we has enough signs
                     if valid_signs < signs_required:
@@ -79,6 +79,7 @@ class Db(object):
         next_db_id += 1
         self.progress_sleeping = False
         self.commiting = False
+        self.bulk_inserting = False
         self.log = logging.getLogger("Db#%s:%s" % (self.id, schema["db_name"]))
         self.table_names = None
         self.collect_stats = False
@@ -94,6 +95,8 @@ class Db(object):
         self.num_execute_since_sleep = 0
         self.lock = ThreadPool.Lock()
         self.connect_lock = ThreadPool.Lock()
+        self.map_patterns = None  # Compiled patterns of schema maps
+        self.map_patterns_source = None  # The schema maps dict the patterns compiled from
 
     def __repr__(self):
         return "<Db#%s:%s close_idle:%s>" % (id(self), self.db_path, self.close_idle)
@@ -163,6 +166,10 @@ class Db(object):
             self.log.debug("Commit ignored: Already commiting")
             return False
 
+        if self.bulk_inserting:
+            self.log.debug("Commit ignored: Bulk insert in progress")
+            return False
+
         try:
             s = time.time()
             self.commiting = True
@@ -344,6 +351,23 @@ class Db(object):
 
         return changed_tables
 
+    # Compile the schema map patterns once per schema
+    # Return: [(compiled pattern, map settings), ...]
+    def getMapPatterns(self):
+        if self.map_patterns is not None and self.map_patterns_source is self.schema["maps"]:
+            return self.map_patterns
+
+        map_patterns = []
+        for match, map_settings in self.schema["maps"].items():
+            try:
+                SafeRe.isSafePattern(match)
+                map_patterns.append((re.compile(match), map_settings))
+            except SafeRe.UnsafePatternError as err:
+                self.log.error(err)
+        self.map_patterns = map_patterns
+        self.map_patterns_source = self.schema["maps"]
+        return self.map_patterns
+
     # Update json file to db
     # Return: True if matched
     def updateJson(self, file_path, file=None, cur=None):
@@ -352,13 +376,7 @@ class Db(object):
         relative_path = file_path[len(self.db_dir):]  # File path realative to db file
 
         # Check if filename matches any of mappings in schema
-        matched_maps = []
-        for match, map_settings in self.schema["maps"].items():
-            try:
-                if SafeRe.match(match, relative_path):
-                    matched_maps.append(map_settings)
-            except SafeRe.UnsafePatternError as err:
-                self.log.error(err)
+        matched_maps = [map_settings for pattern, map_settings in self.getMapPatterns() if pattern.match(relative_path)]
 
         # No match found for the file
         if not matched_maps:
@@ -397,6 +415,7 @@ class Db(object):
             # Insert non-relational key values
             if dbmap.get("to_keyvalue"):
                 # Get current values
+                cur.flushPending("keyvalue", json_row["json_id"])
                 res = cur.execute("SELECT * FROM keyvalue WHERE json_id = ?", (json_row["json_id"],))
                 current_keyvalue = {}
                 current_keyvalue_id = {}
@@ -404,17 +423,16 @@ class Db(object):
                     current_keyvalue[row["key"]] = row["value"]
                     current_keyvalue_id[row["key"]] = row["keyvalue_id"]
 
+                keyvalue_rows = []
                 for key in dbmap["to_keyvalue"]:
                     if key not in current_keyvalue:  # Keyvalue not exist yet in the db
-                        cur.execute(
-                            "INSERT INTO keyvalue ?",
-                            {"key": key, "value": data.get(key), "json_id": json_row["json_id"]}
-                        )
+                        keyvalue_rows.append({"key": key, "value": data.get(key), "json_id": json_row["json_id"]})
                     elif data.get(key) != current_keyvalue[key]:  # Keyvalue different value
                         cur.execute(
                             "UPDATE keyvalue SET value = ? WHERE keyvalue_id = ?",
                             (data.get(key), current_keyvalue_id[key])
                         )
+                cur.insertRows("keyvalue", keyvalue_rows, replace=False)
 
             # Insert data to json table for easier joins
             if dbmap.get("to_json_table"):
@@ -450,18 +468,17 @@ class Db(object):
                 if not import_cols:
                     import_cols = set([item[0] for item in self.schema["tables"][table_name]["cols"]])
 
+                cur.flushPending(table_name, json_row["json_id"])
                 cur.execute("DELETE FROM %s WHERE json_id = ?" % table_name, (json_row["json_id"],))
 
                 if node not in data:
                     continue
 
+                rows = []
                 if key_col:  # Map as dict
                     for key, val in data[node].items():
                         if val_col:  # Single value
-                            cur.execute(
-                                "INSERT OR REPLACE INTO %s ?" % table_name,
-                                {key_col: key, val_col: val, "json_id": json_row["json_id"]}
-                            )
+                            rows.append({key_col: key, val_col: val, "json_id": json_row["json_id"]})
                         else:  # Multi value
                             if type(val) is dict:  # Single row
                                 row = val
@@ -476,18 +493,20 @@ class Db(object):
                                                 row[replace_key] = row[replace_key].replace(replace_from, replace_to)
 
                                 row["json_id"] = json_row["json_id"]
-                                cur.execute("INSERT OR REPLACE INTO %s ?" % table_name, row)
+                                rows.append(row)
                             elif type(val) is list:  # Multi row
                                 for row in val:
                                     row[key_col] = key
                                     row["json_id"] = json_row["json_id"]
-                                    cur.execute("INSERT OR REPLACE INTO %s ?" % table_name, row)
+                                    rows.append(row)
                 else:  # Map as list
                     for row in data[node]:
                         row["json_id"] = json_row["json_id"]
                         if import_cols:
                             row = {key: row[key] for key in row if key in import_cols}  # Filter row by import_cols
-                        cur.execute("INSERT OR REPLACE INTO %s ?" % table_name, row)
+                        rows.append(row)
+
+                cur.insertRows(table_name, rows)
 
         # Cleanup json row
         if not data:
@@ -10,6 +10,11 @@ class DbCursor:
     def __init__(self, db):
         self.db = db
         self.logging = False
+        self.bulk_rows = None  # Collected rows in bulk import mode: {(table, cols, replace): [values, ...]}
+        self.bulk_pending = set()  # (table, json_id) pairs that has collected but not yet inserted rows
+        self.bulk_num_rows = 0
+        self.bulk_size = 5000  # Insert collected rows after this many rows
+        self.bulk_num_errors = 0
 
     def quoteValue(self, value):
         if type(value) is int:
@@ -156,6 +161,90 @@ class DbCursor:
 
         return cursor
 
+    # Insert rows to table grouped by their columns using executemany
+    # In bulk mode the rows are collected and inserted later in large batches
+    def insertRows(self, table, rows, replace=True):
+        if self.bulk_rows is None:
+            rows_grouped = {}
+        else:
+            rows_grouped = self.bulk_rows
+
+        for row in rows:
+            cols = tuple(row.keys())
+            key = (table, cols, replace)
+            if key not in rows_grouped:
+                rows_grouped[key] = []
+            rows_grouped[key].append(tuple(row.values()))
+            if "json_id" in row:
+                self.bulk_pending.add((table, row["json_id"]))
+            self.bulk_num_rows += 1
+
+        if self.bulk_rows is None or self.bulk_num_rows >= self.bulk_size:
+            self.flushRows(rows_grouped)
+
+    # Execute the collected inserts
+    def flushRows(self, rows_grouped=None):
+        if rows_grouped is None:
+            rows_grouped = self.bulk_rows
+        if not rows_grouped:
+            return 0
+
+        num_rows = 0
+        try:
+            for (table, cols, replace), values in rows_grouped.items():
+                if replace:
+                    query_type = "INSERT OR REPLACE"
+                else:
+                    query_type = "INSERT"
+                query = "%s INTO %s (%s) VALUES (%s)" % (query_type, table, ", ".join(cols), ", ".join(["?"] * len(cols)))
+                if self.bulk_rows is None:
+                    self.executemany(query, values)
+                else:
+                    self.executemanyBulk(query, values)
+                num_rows += len(values)
+        finally:
+            rows_grouped.clear()
+            self.bulk_pending = set()
+            self.bulk_num_rows = 0
+        return num_rows
+
+    # Execute a batch of collected rows, retry them one by one if any of the rows is invalid
+    def executemanyBulk(self, query, values):
+        self.execute("SAVEPOINT bulk_insert")
+        self.db.bulk_inserting = True  # Avoid commit between savepoint and release
+        try:
+            self.executemany(query, values)
+        except Exception as err:
+            self.execute("ROLLBACK TO bulk_insert")
+            self.db.log.debug("Bulk insert error: %s, retrying %s rows one by one" % (err, len(values)))
+            for row_values in values:
+                try:
+                    self.execute(query, row_values)
+                except Exception as err:
+                    self.bulk_num_errors += 1
+                    self.db.log.error("Bulk insert error: %s (query: %s)" % (err, query))
+        finally:
+            self.execute("RELEASE bulk_insert")
+            self.db.bulk_inserting = False
+
+    # Start collecting the inserted rows instead of executing them one by one
+    def startBulk(self, bulk_size=None):
+        if bulk_size:
+            self.bulk_size = bulk_size
+        if self.bulk_rows is None:
+            self.bulk_rows = {}
+
+    # Insert remaining collected rows and go back to normal mode
+    def endBulk(self):
+        num_rows = self.flushRows()
+        self.bulk_rows = None
+        return num_rows
+
+    # Make sure there is no pending row of the json_id in the table before modifying them
+    def flushPending(self, table, json_id):
+        if self.bulk_rows and (table, json_id) in self.bulk_pending:
+            self.flushRows()
+
     # Creates on updates a database row without incrementing the rowid
     def insertOrUpdate(self, table, query_sets, query_wheres, oninsert={}):
         sql_sets = ["%s = :%s" % (key, key) for key in query_sets.keys()]
@@ -398,9 +398,8 @@ class FileRequest(object):
         RateLimit.called(event_key)
 
         my_hashes = []
-        my_hashfield_set = set(site.content_manager.hashfield)
         for hash_id in params["hash_ids"]:
-            if hash_id in my_hashfield_set:
+            if hash_id in site.content_manager.hashfield:
                 my_hashes.append(hash_id)
 
         if config.verbose:
@@ -23,7 +23,7 @@ class Peer(object):
     __slots__ = (
         "ip", "port", "site", "key", "connection", "connection_server", "time_found", "time_response", "time_hashfield",
         "time_added", "has_hashfield", "is_tracker_connection", "time_my_hashfield_sent", "last_ping", "reputation",
-        "last_content_json_update", "hashfield", "connection_error", "hash_failed", "download_bytes", "download_time"
+        "last_content_json_update", "hashfield", "connection_error", "hash_failed", "download_bytes", "download_time", "download_speed"
     )
 
     def __init__(self, ip, port, site=None, connection_server=None):
@@ -49,6 +49,7 @@ class Peer(object):
         self.hash_failed = 0  # Number of bad files from peer
         self.download_bytes = 0  # Bytes downloaded
         self.download_time = 0  # Time spent to download
+        self.download_speed = 0  # Recent download speed in bytes/sec
 
     def __getattr__(self, key):
         if key == "hashfield":
@@ -70,8 +71,10 @@ class Peer(object):
     def connect(self, connection=None):
         if self.reputation < -10:
             self.reputation = -10
+            self.updateScore()
         if self.reputation > 10:
             self.reputation = 10
+            self.updateScore()
 
         if self.connection:
             self.log("Getting connection (Closing %s)..." % self.connection)
@@ -83,6 +86,7 @@ class Peer(object):
             self.log("Assigning connection %s" % connection)
             self.connection = connection
             self.connection.sites += 1
+            self.updateScore()  # Ping of the new connection
         else:  # Try to find from connection pool or create new connection
             self.connection = None
 
@@ -97,6 +101,7 @@ class Peer(object):
                 self.connection = connection_server.getConnection(self.ip, self.port, site=self.site, is_tracker_connection=self.is_tracker_connection)
                 self.reputation += 1
                 self.connection.sites += 1
+                self.updateScore()
             except Exception as err:
                 self.onConnectionError("Getting connection error")
                 self.log("Getting connection error: %s (connection_error: %s, hash_failed: %s)" %
@@ -143,9 +148,10 @@ class Peer(object):
         if source in ("tracker", "local"):
             self.site.peers_recent.appendleft(self)
         self.time_found = time.time()
+        self.updateScore()
 
     # Send a command to peer and return response value
-    def request(self, cmd, params={}, stream_to=None):
+    def request(self, cmd, params={}, stream_to=None, timeout=None):
         if not self.connection or self.connection.closed:
             self.connect()
             if not self.connection:
@@ -154,11 +160,17 @@ class Peer(object):
 
         self.log("Send request: %s %s %s %s" % (params.get("site", ""), cmd, params.get("inner_path", ""), params.get("location", "")))
 
+        if stream_to:
+            stream_pos = stream_to.tell()
+
         for retry in range(1, 4):  # Retry 3 times
             try:
                 if not self.connection:
                     raise Exception("No connection found")
-                res = self.connection.request(cmd, params, stream_to)
+                if stream_to and retry > 1:  # Drop the partial data of the failed try
+                    stream_to.seek(stream_pos)
+                    stream_to.truncate()
+                res = self.connection.request(cmd, params, stream_to, timeout=timeout)
                 if not res:
                     raise Exception("Send error")
                 if "error" in res:
@@ -168,6 +180,7 @@ class Peer(object):
                 else:  # Successful request, reset connection error num
                     self.connection_error = 0
                 self.time_response = time.time()
+                self.updateScore()  # Ping measured by the connection
                 if res:
                     return res
                 else:
@@ -234,6 +247,12 @@ class Peer(object):
 
         self.download_bytes += recv
         self.download_time += (time.time() - s)
+        speed = recv / max(time.time() - s, 0.001)
+        if self.download_speed:
+            self.download_speed = self.download_speed * 0.7 + speed * 0.3
+        else:
+            self.download_speed = speed
+        self.updateScore()
         if self.site:
             self.site.settings["bytes_recv"] = self.site.settings.get("bytes_recv", 0) + recv
         self.log("Downloaded: %s, pos: %s, read_bytes: %s" % (inner_path, buff.tell(), read_bytes))
@@ -261,6 +280,7 @@ class Peer(object):
         else:
             self.log("Ping failed")
         self.last_ping = response_time
+        self.updateScore()
         return response_time
 
     # Request peer exchange from peer
@@ -385,6 +405,8 @@ class Peer(object):
         self.log("Removing peer...Connection error: %s, Hash failed: %s" % (self.connection_error, self.hash_failed))
         if self.site and self.key in self.site.peers:
             del(self.site.peers[self.key])
+            self.site.connected_peers.pop(self.key, None)
+            self.site.peer_scoreboard.remove(self)
 
         if self.site and self in self.site.peers_recent:
             self.site.peers_recent.remove(self)
@@ -392,6 +414,11 @@ class Peer(object):
         if self.connection:
             self.connection.close(reason)
 
+    # Update peer position in site's scoreboard
+    def updateScore(self):
+        if self.site and self.site.peers.get(self.key) is self:
+            self.site.peer_scoreboard.update(self)
+
     # - EVENTS -
 
     # On connection error
@@ -402,6 +429,7 @@ class Peer(object):
         else:
             limit = 6
         self.reputation -= 1
+        self.updateScore()
         if self.connection_error >= limit:  # Dead peer
             self.remove("Peer connection: %s" % reason)
 
@@ -3,33 +3,64 @@ import time
 
 
 class PeerHashfield(object):
-    __slots__ = ("storage", "time_changed", "append", "remove", "tobytes", "frombytes", "__len__", "__iter__")
+    # Hash ids are 16bit (first 4 hex chars of the sha512), stored as bitset: bit n is set if hash id n is in the field
+    # The ids are also kept in an array to iterate and serialize them without walking the bitset
+    __slots__ = ("storage", "ids", "time_changed")
+    size = 2 ** 16 // 8  # 8KB
+
     def __init__(self):
         self.storage = self.createStorage()
         self.time_changed = time.time()
 
     def createStorage(self):
-        storage = array.array("H")
-        self.append = storage.append
-        self.remove = storage.remove
-        self.tobytes = storage.tobytes
-        self.frombytes = storage.frombytes
-        self.__len__ = storage.__len__
-        self.__iter__ = storage.__iter__
+        storage = bytearray(self.size)
+        self.ids = array.array("H")
         return storage
 
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, hash_id):
+        return 0 <= hash_id < 65536 and bool(self.storage[hash_id >> 3] & (1 << (hash_id & 7)))
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    # Add hash id without changing the time_changed (same as array.append)
+    def append(self, hash_id):
+        if hash_id not in self:
+            self.storage[hash_id >> 3] |= 1 << (hash_id & 7)
+            self.ids.append(hash_id)
+
+    # Remove hash id without changing the time_changed, raise ValueError if not exists (same as array.remove)
+    def remove(self, hash_id):
+        if hash_id not in self:
+            raise ValueError("Hash id %s not in hashfield" % hash_id)
+        self.storage[hash_id >> 3] &= ~(1 << (hash_id & 7)) & 0xFF
+        self.ids.remove(hash_id)
+
+    # Wire format: array of unsigned shorts (compatible with the old array("H") based storage)
+    def tobytes(self):
+        return self.ids.tobytes()
+
+    def frombytes(self, hashfield_raw):
+        hash_ids = array.array("H")
+        hash_ids.frombytes(hashfield_raw)
+        for hash_id in hash_ids:
+            self.append(hash_id)
+
     def appendHash(self, hash):
         hash_id = int(hash[0:4], 16)
-        if hash_id not in self.storage:
-            self.storage.append(hash_id)
+        if hash_id not in self:
+            self.append(hash_id)
             self.time_changed = time.time()
             return True
         else:
             return False
 
     def appendHashId(self, hash_id):
-        if hash_id not in self.storage:
-            self.storage.append(hash_id)
+        if hash_id not in self:
+            self.append(hash_id)
             self.time_changed = time.time()
             return True
         else:
@@ -37,16 +68,16 @@ class PeerHashfield(object):
 
     def removeHash(self, hash):
         hash_id = int(hash[0:4], 16)
-        if hash_id in self.storage:
-            self.storage.remove(hash_id)
+        if hash_id in self:
+            self.remove(hash_id)
             self.time_changed = time.time()
             return True
         else:
             return False
 
     def removeHashId(self, hash_id):
-        if hash_id in self.storage:
-            self.storage.remove(hash_id)
+        if hash_id in self:
+            self.remove(hash_id)
             self.time_changed = time.time()
             return True
         else:
@@ -56,11 +87,11 @@ class PeerHashfield(object):
         return int(hash[0:4], 16)
 
     def hasHash(self, hash):
-        return int(hash[0:4], 16) in self.storage
+        return int(hash[0:4], 16) in self
 
     def replaceFromBytes(self, hashfield_raw):
         self.storage = self.createStorage()
-        self.storage.frombytes(hashfield_raw)
+        self.frombytes(hashfield_raw)
         self.time_changed = time.time()
 
 if __name__ == "__main__":
@@ -72,4 +103,4 @@ if __name__ == "__main__":
     s = time.time()
     for i in range(10000):
         field.hasHash("AABB")
-    print(time.time()-s)
\ No newline at end of file
+    print(time.time()-s)
@@ -0,0 +1,89 @@
+import heapq
+import itertools
+import math
+
+
+# Keep the peers of a site ordered by score, so the best ones can be picked without sorting every peer
+class PeerScoreboard(object):
+    def __init__(self, peers):
+        self.peers = peers  # Peers of the site, Key: ip:port, Value: Peer.Peer
+        self.heap = []  # [(-score, entry_id, peer), ...], can contain outdated entries
+        self.entries = {}  # Latest entry of the peers, Key: ip:port, Value: (entry_id, score, peer)
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Blend of reputation, recent download speed and round trip time
+    def getScore(self, peer):
+        score = peer.reputation
+        if peer.download_speed:
+            score += min(math.log2(1 + peer.download_speed / 1024), 10)  # Max +10 at 1MB/s
+        if peer.connection and peer.connection.last_ping_delay:
+            ping = peer.connection.last_ping_delay
+        else:
+            ping = peer.last_ping
+        if ping:
+            score -= min(ping * 5, 5)  # Max -5 at 1s
+        return round(score, 3)
+
+    def update(self, peer):
+        score = self.getScore(peer)
+        entry = self.entries.get(peer.key)
+        if entry and entry[1] == score and entry[2] is peer:
+            return False  # Not changed
+        entry_id = next(self.counter)
+        self.entries[peer.key] = (entry_id, score, peer)
+        heapq.heappush(self.heap, (-score, entry_id, peer))
+        if len(self.heap) > len(self.entries) * 2 + 100:
+            self.compact()
+        return True
+
+    def remove(self, peer):
+        return self.entries.pop(peer.key, None) is not None
+
+    def isValid(self, heap_entry):
+        peer = heap_entry[2]
+        entry = self.entries.get(peer.key)
+        return entry and entry[0] == heap_entry[1] and self.peers.get(peer.key) is peer
+
+    # Drop the outdated entries from the heap
+    def compact(self):
+        self.heap = [heap_entry for heap_entry in self.heap if self.isValid(heap_entry)]
+        heapq.heapify(self.heap)
+
+    # Add the peers that was added to or removed from the peers dict directly
+    def sync(self):
+        if len(self.entries) == len(self.peers):
+            return False
+        for key in list(self.entries.keys()):
+            if key not in self.peers:
+                del self.entries[key]
+        for peer in list(self.peers.values()):
+            if peer.key not in self.entries:
+                self.update(peer)
+        return True
+
+    # Return: The best need_num peers where filter_func(peer) is True, ordered by score
+    def getBest(self, need_num, filter_func=None):
+        self.sync()
+        found = []
+        popped = []
+        while self.heap and len(found) < need_num:
+            heap_entry = heapq.heappop(self.heap)
+            if not self.isValid(heap_entry):
+                peer = self.peers.get(heap_entry[2].key)
+                if peer and peer is not heap_entry[2]:  # Replaced under the same key, add the new one
+                    self.update(peer)
+                continue
+            peer = heap_entry[2]
+            if self.update(peer):  # Score changed since the entry added, retry with the new one
+                continue
+            popped.append(heap_entry)
+            if filter_func is None or filter_func(peer):
+                found.append(peer)
+
+        for heap_entry in popped:
+            heapq.heappush(self.heap, heap_entry)
+
+        return found
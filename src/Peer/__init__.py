@@ -1,2 +1,3 @@
 from .Peer import Peer
 from .PeerHashfield import PeerHashfield
+from .PeerScoreboard import PeerScoreboard
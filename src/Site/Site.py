@@ -8,6 +8,7 @@ import sys
 import hashlib
 import collections
 import base64
+import heapq
 
 import gevent
 import gevent.pool
@@ -15,9 +16,11 @@ import gevent.pool
 import util
 from Config import config
 from Peer import Peer
+from Peer import PeerScoreboard
 from Worker import WorkerManager
 from Debug import Debug
 from Content import ContentManager
+from Content import ContentDbDict
 from .SiteStorage import SiteStorage
 from Crypt import CryptHash
 from util import helper
@@ -32,7 +35,7 @@ from . import SiteManager
 @PluginManager.acceptPlugins
 class Site(object):
 
-    def __init__(self, address, allow_create=True, settings=None):
+    def __init__(self, address, allow_create=True, settings=None, lazy=False):
         self.address = str(re.sub("[^A-Za-z0-9]", "", address))  # Make sure its correct address
         self.address_hash = hashlib.sha256(self.address.encode("ascii")).digest()
         self.address_sha1 = hashlib.sha1(self.address.encode("ascii")).digest()
@@ -42,32 +45,24 @@ class Site(object):
 
         self.content = None  # Load content.json
         self.peers = {}  # Key: ip:port, Value: Peer.Peer
+        self.connected_peers = {}  # Peers with connection, Key: ip:port, Value: Peer.Peer
+        self.connected_peers_server = None  # Connection server that keeps connected_peers updated
+        self.peer_scoreboard = PeerScoreboard(self.peers)  # Peers ordered by reputation, speed and ping
         self.peers_recent = collections.deque(maxlen=150)
         self.peer_blacklist = SiteManager.peer_blacklist  # Ignore this peers (eg. myself)
         self.greenlet_manager = GreenletManager.GreenletManager()  # Running greenlets
-        self.worker_manager = WorkerManager(self)  # Handle site download from other peers
+        self.allow_create = allow_create
+        self.loading = False  # Creating the workers, storage and content
+        self.load_error = None  # Error of the last failed load, the lazy load is not retried on attribute access
         self.bad_files = {}  # SHA check failed files, need to redownload {"inner.content": 1} (key: file, value: failed accept)
         self.content_updated = None  # Content.js update time
         self.notifications = []  # Pending notifications displayed once on page load [error|ok|info, message, timeout]
         self.page_requested = False  # Page viewed in browser
         self.websockets = []  # Active site websocket connections
 
-        self.connection_server = None
         self.loadSettings(settings)  # Load settings from sites.json
-        self.storage = SiteStorage(self, allow_create=allow_create)  # Save and load site files
-        self.content_manager = ContentManager(self)
-        self.content_manager.loadContents()  # Load content.json files
-        if "main" in sys.modules:  # import main has side-effects, breaks tests
-            import main
-            if "file_server" in dir(main):  # Use global file server by default if possible
-                self.connection_server = main.file_server
-            else:
-                main.file_server = FileServer()
-                self.connection_server = main.file_server
-        else:
-            self.connection_server = FileServer()
-
-        self.announcer = SiteAnnouncer(self)  # Announce and get peer list from other nodes
+        if not lazy:
+            self.loadSite()
 
         if not self.settings.get("wrapper_key"):  # To auth websocket permissions
             self.settings["wrapper_key"] = CryptHash.random()
@@ -77,6 +72,54 @@ class Site(object):
             self.settings["ajax_key"] = CryptHash.random()
             self.log.debug("New ajax key: %s" % self.settings["ajax_key"])
 
+    # Create the workers, storage and content of the site, the components are only kept if all of them loaded
+    def loadSite(self):
+        s = time.time()
+        self.loading = True
+        self.load_error = None
+        components = {}
+        try:
+            if "connection_server" not in self.__dict__:  # Could be set before the lazy load
+                if "main" in sys.modules:  # import main has side-effects, breaks tests
+                    import main
+                    if "file_server" in dir(main):  # Use global file server by default if possible
+                        self.connection_server = main.file_server
+                    else:
+                        main.file_server = FileServer()
+                        self.connection_server = main.file_server
+                else:
+                    self.connection_server = FileServer()
+            components["worker_manager"] = WorkerManager(self)  # Handle site download from other peers
+            components["storage"] = SiteStorage(self, allow_create=self.allow_create)  # Save and load site files
+            components["announcer"] = SiteAnnouncer(self)  # Announce and get peer list from other nodes
+            components["content_manager"] = ContentManager(self)
+            self.__dict__.update(components)  # Loading the contents needs the other components
+            self.content_manager.loadContents()  # Load content.json files
+        except Exception as err:
+            for key in components:
+                self.__dict__.pop(key, None)
+            if "worker_manager" in components:  # Stop the task checker of the dropped worker manager
+                components["worker_manager"].running = False
+                components["worker_manager"].event_check.set()
+            self.load_error = err
+            raise
+        finally:
+            self.loading = False
+        self.log.debug("Loaded in %.3fs" % (time.time() - s))
+
+    # Lazy loaded site: load on first access of the attributes created by loadSite
+    def __getattr__(self, key):
+        if key in ("connection_server", "worker_manager", "storage", "announcer", "content_manager"):
+            if not self.__dict__.get("loading") and "address" in self.__dict__:
+                if self.__dict__.get("load_error"):
+                    raise AttributeError("'%s' has no attribute '%s', load failed: %s" % (self, key, self.load_error))
+                self.loadSite()
+                return self.__dict__[key]
+        raise AttributeError("'%s' object has no attribute '%s'" % (type(self).__name__, key))
+
+    def isLoaded(self):
+        return "content_manager" in self.__dict__ and not self.loading
+
     def __str__(self):
         return "Site %s" % self.address_short
 
@@ -123,6 +166,7 @@ class Site(object):
         if not SiteManager.site_manager.sites.get(self.address):
             SiteManager.site_manager.sites[self.address] = self
             SiteManager.site_manager.load(False)
+        SiteManager.site_manager.markDirty(self.address)
         SiteManager.site_manager.saveDelayed()
 
     def isServing(self):
@@ -132,6 +176,8 @@ class Site(object):
             return self.settings["serving"]
 
     def getSettingsCache(self):
+        if not self.isLoaded():  # Keep the cache loaded from sites.json until the site is loaded
+            return dict(self.settings["cache"], bad_files=self.bad_files)
         back = {}
         back["bad_files"] = self.bad_files
         back["hashfield"] = base64.b64encode(self.content_manager.hashfield.tobytes()).decode("ascii")
@@ -355,15 +401,25 @@ class Site(object):
 
         return valid
 
+    # Download the content.json files in two stages: fetch (download and verify) and load (update db, download files)
+    # The stages are bounded by pool_size, fetch waits for a free load slot, so memory and db usage stays limited
     def pooledDownloadContent(self, inner_paths, pool_size=100, only_if_bad=False):
         self.log.debug("New downloadContent pool: len: %s, only if bad: %s" % (len(inner_paths), only_if_bad))
         self.worker_manager.started_task_num += len(inner_paths)
         pool = gevent.pool.Pool(pool_size)
+        pool_load = gevent.pool.Pool(pool_size)
         num_skipped = 0
         site_size_limit = self.getSizeLimit() * 1024 * 1024
+
+        def fetchContent(inner_path):
+            if self.needFile(inner_path, update=self.bad_files.get(inner_path)):
+                pool_load.spawn(self.downloadContent, inner_path)  # Blocks until a load slot is free
+            else:
+                self.log.debug("DownloadContent %s: Download failed" % inner_path)
+
         for inner_path in inner_paths:
             if not only_if_bad or inner_path in self.bad_files:
-                pool.spawn(self.downloadContent, inner_path)
+                pool.spawn(fetchContent, inner_path)
             else:
                 num_skipped += 1
             self.worker_manager.started_task_num -= 1
@@ -375,6 +431,7 @@ class Site(object):
                 self.worker_manager.removeSolvedFileTasks(mark_as_good=False)
                 break
         pool.join()
+        pool_load.join()
         self.log.debug("Ended downloadContent pool len: %s, skipped: %s" % (len(inner_paths), num_skipped))
 
     def pooledDownloadFile(self, inner_paths, pool_size=100, only_if_bad=False):
@@ -846,7 +903,9 @@ class Site(object):
                 return False  # Ignore blacklist (eg. myself)
             peer = Peer(ip, port, self)
             self.peers[key] = peer
-            peer.found(source)
+            if self.connected_peers_server:
+                self.updateConnectedPeer(key)
+            peer.found(source)  # Also adds to the scoreboard
             return peer
 
     def announce(self, *args, **kwargs):
@@ -888,33 +947,43 @@ class Site(object):
 
     # Return: Probably peers verified to be connectable recently
     def getConnectablePeers(self, need_num=5, ignore=[], allow_private=True):
-        peers = list(self.peers.values())
-        found = []
-        for peer in peers:
+        def isConnectable(peer):
             if peer.key.endswith(":0"):
-                continue  # Not connectable
+                return False  # Not connectable
             if not peer.connection:
-                continue  # No connection
+                if self.connected_peers_server:
+                    self.updateConnectedPeer(peer.key)  # Cleanup: Dropped connection
+                return False  # No connection
             if peer.ip.endswith(".onion") and not self.connection_server.tor_manager.enabled:
-                continue  # Onion not supported
+                return False  # Onion not supported
             if peer.key in ignore:
-                continue  # The requester has this peer
+                return False  # The requester has this peer
             if time.time() - peer.connection.last_recv_time > 60 * 60 * 2:  # Last message more than 2 hours ago
                 peer.connection = None  # Cleanup: Dead connection
-                continue
+                if self.connected_peers_server:
+                    self.updateConnectedPeer(peer.key)
+                return False
             if not allow_private and helper.isPrivateIp(peer.ip):
-                continue
-            found.append(peer)
-            if len(found) >= need_num:
-                break  # Found requested number of peers
+                return False
+            return True
+
+        # Only the peers with live connection can be connectable, use the connection index if available
+        if self.connection_server and self.connected_peers_server is self.connection_server:
+            peers = self.connected_peers.values()
+        else:
+            peers = self.peers.values()
+        found = heapq.nlargest(need_num, filter(isConnectable, list(peers)), key=self.peer_scoreboard.getScore)
 
         if len(found) < need_num:  # Return not that good peers
-            found += [
-                peer for peer in peers
-                if not peer.key.endswith(":0") and
-                peer.key not in ignore and
-                (allow_private or not helper.isPrivateIp(peer.ip))
-            ][0:need_num - len(found)]
+            found += self.peer_scoreboard.getBest(
+                need_num - len(found),
+                lambda peer: (
+                    not peer.key.endswith(":0") and
+                    peer.key not in ignore and
+                    peer not in found and
+                    (allow_private or not helper.isPrivateIp(peer.ip))
+                )
+            )
 
         return found
 
@@ -927,40 +996,52 @@ class Site(object):
         )
 
         if len(found) >= need_num or len(found) >= len(self.peers):
-            return sorted(
-                found,
-                key=lambda peer: peer.reputation,
-                reverse=True
-            )[0:need_num]
+            return heapq.nlargest(need_num, found, key=self.peer_scoreboard.getScore)
 
-        # Add random peers
+        # Add the best scored peers
         need_more = need_num - len(found)
-        if not self.connection_server.tor_manager.enabled:
-            peers = [peer for peer in self.peers.values() if not peer.ip.endswith(".onion")]
-        else:
-            peers = list(self.peers.values())
-
-        found_more = sorted(
-            peers[0:need_more * 50],
-            key=lambda peer: peer.reputation,
-            reverse=True
-        )[0:need_more * 2]
+        found_set = set(found)
+        onion_supported = self.connection_server.tor_manager.enabled
+        found_more = self.peer_scoreboard.getBest(
+            need_more,
+            lambda peer: peer not in found_set and (onion_supported or not peer.ip.endswith(".onion"))
+        )
 
         found += found_more
 
         return found[0:need_num]
 
+    # Rebuild connected peers index and keep it updated on connection changes of the connection server
+    def indexConnectedPeers(self):
+        if self.connected_peers_server:
+            self.connected_peers_server.indexed_sites.discard(self)
+        self.connected_peers_server = self.connection_server
+        self.connection_server.indexed_sites.add(self)
+        self.connected_peers = {}
+        for key in list(self.peers.keys()):
+            self.updateConnectedPeer(key)
+
+    def updateConnectedPeer(self, key):
+        peer = self.peers.get(key)
+        # Also keep the peers of recently closed connections, they are still returned by getConnectablePeers
+        if peer and (key in self.connected_peers_server.connections_by_key or peer.connection):
+            self.connected_peers[key] = peer
+        else:
+            self.connected_peers.pop(key, None)
+
     def getConnectedPeers(self):
         back = []
         if not self.connection_server:
             return []
 
+        if self.connected_peers_server is not self.connection_server:
+            self.indexConnectedPeers()
+
         tor_manager = self.connection_server.tor_manager
-        for connection in self.connection_server.connections:
-            if not connection.connected and time.time() - connection.start_time > 20:  # Still not connected after 20s
-                continue
-            peer = self.peers.get("%s:%s" % (connection.ip, connection.port))
-            if peer:
+        for key, peer in list(self.connected_peers.items()):
+            for connection in self.connection_server.connections_by_key.get(key, []):
+                if not connection.connected and time.time() - connection.start_time > 20:  # Still not connected after 20s
+                    continue
                 if connection.ip.endswith(".onion") and connection.target_onion and tor_manager.start_onions:
                     # Check if the connection is made with the onion address created for the site
                     valid_target_onions = (tor_manager.getOnion(self.address), tor_manager.getOnion("global"))
@@ -969,6 +1050,7 @@ class Site(object):
                 if not peer.connection:
                     peer.connect(connection)
                 back.append(peer)
+                break
         return back
 
     # Cleanup probably dead peers and close connection if too much
@@ -1070,7 +1152,10 @@ class Site(object):
         self.worker_manager.running = False
         num_workers = self.worker_manager.stopWorkers()
         SiteManager.site_manager.delete(self.address)
+        if self.connected_peers_server:
+            self.connected_peers_server.indexed_sites.discard(self)
         self.content_manager.contents.db.deleteSite(self)
+        ContentDbDict.content_cache.removeSite(self.address)
         self.updateWebsocket(deleted=True)
         self.storage.deleteFiles()
         self.log.info(
@@ -23,6 +23,8 @@ class SiteManager(object):
         self.log.debug("SiteManager created.")
         self.sites = {}
         self.sites_changed = int(time.time())
+        self.sites_json = {}  # Last saved sites.json entries, Key: address, Value: serialized entry
+        self.sites_dirty = set()  # Sites with changed settings since the last save
         self.loaded = False
         gevent.spawn(self.saveTimer)
         atexit.register(lambda: self.save(recalculate_size=True))
@@ -45,6 +47,9 @@ class SiteManager(object):
             raise Exception("Unable to load %s: %s" % (json_path, err))
 
         sites_need = []
+        sites_lazy = []
+        if config.site_load_lazy:  # Cheap validity check: the content.json of the site was loaded before
+            sites_stored = ContentDb.getContentDb().getSitesWithContent()
 
         for address, settings in data.items():
             if address not in self.sites:
@@ -52,8 +57,12 @@ class SiteManager(object):
                     # Root content.json exists, try load site
                     s = time.time()
                     try:
-                        site = Site(address, settings=settings)
-                        site.content_manager.contents.get("content.json")
+                        if config.site_load_lazy and address in sites_stored:  # Storage and content loaded on first access
+                            site = Site(address, settings=settings, lazy=True)
+                            sites_lazy.append(site)
+                        else:
+                            site = Site(address, settings=settings)
+                            site.content_manager.contents.get("content.json")
                     except Exception as err:
                         self.log.debug("Error loading site %s: %s" % (address, err))
                         continue
@@ -91,6 +100,13 @@ class SiteManager(object):
                         del content_db.site_ids[address]
                     if address in content_db.sites:
                         del content_db.sites[address]
+                    content_db.site_sizes.pop(address, None)
+
+        # Register the not yet loaded sites to content.db
+        if sites_lazy:
+            content_db = ContentDb.getContentDb()
+            for site in sites_lazy:
+                content_db.registerSite(site)
 
         self.loaded = True
         for address, settings in sites_need:
@@ -101,6 +117,18 @@ class SiteManager(object):
     def saveDelayed(self):
         RateLimit.callAsync("Save sites.json", allowed_again=5, func=self.save)
 
+    # Mark the settings of the site changed, so it's re-formatted on the next save
+    def markDirty(self, address):
+        self.sites_dirty.add(address)
+
+    # Return: Settings of the site as sites.json entry
+    def getSiteJson(self, address, site):
+        settings = dict(site.settings)
+        settings["cache"] = site.getSettingsCache()
+        return helper.jsonDumps({address: settings})[2:-2]  # Remove the outer { and }
+
+    # Only re-format the sites marked dirty and skip the write if nothing changed
+    # The periodic save with recalculate_size re-formats every site to include the changes made without marking
     def save(self, recalculate_size=False):
         if not self.sites:
             self.log.debug("Save skipped: No sites found")
@@ -109,28 +137,37 @@ class SiteManager(object):
             self.log.debug("Save skipped: Not loaded")
             return
         s = time.time()
-        data = {}
+        sites_json = {}
+        num_changed = 0
+        sites_dirty, self.sites_dirty = self.sites_dirty, set()
         # Generate data file
-        s = time.time()
         for address, site in list(self.list().items()):
-            if recalculate_size:
+            if recalculate_size and site.isLoaded():
                 site.settings["size"], site.settings["size_optional"] = site.content_manager.getTotalSize()  # Update site size
-            data[address] = site.settings
-            data[address]["cache"] = site.getSettingsCache()
+            site_json = self.sites_json.get(address)
+            if recalculate_size or address in sites_dirty or site_json is None:
+                site_json_new = self.getSiteJson(address, site)
+                if site_json_new != site_json:
+                    site_json = site_json_new
+                    num_changed += 1
+            sites_json[address] = site_json
+            if site.isLoaded():
+                site.settings["cache"] = {}  # Remove cache from site settings
         time_generate = time.time() - s
 
         s = time.time()
-        if data:
-            helper.atomicWrite("%s/sites.json" % config.data_dir, helper.jsonDumps(data).encode("utf8"))
-        else:
+        if not sites_json:
             self.log.debug("Save error: No data")
+        elif num_changed or sites_json.keys() != self.sites_json.keys():
+            data = "{\n%s\n}" % ",\n".join([sites_json[address] for address in sorted(sites_json.keys())])
+            helper.atomicWrite("%s/sites.json" % config.data_dir, data.encode("utf8"))
+            self.sites_json = sites_json
         time_write = time.time() - s
 
-        # Remove cache from site settings
-        for address, site in self.list().items():
-            site.settings["cache"] = {}
-
-        self.log.debug("Saved sites in %.2fs (generate: %.2fs, write: %.2fs)" % (time.time() - s, time_generate, time_write))
+        self.log.debug(
+            "Saved sites in %.2fs (generate: %.2fs, write: %.2fs, changed: %s/%s)" %
+            (time.time() - s, time_generate, time_write, num_changed, len(sites_json))
+        )
 
     def saveTimer(self):
         while 1:
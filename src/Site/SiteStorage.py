@@ -4,6 +4,7 @@ import shutil
 import json
 import time
 import errno
+import stat
 from collections import defaultdict
 
 import sqlite3
@@ -13,6 +14,7 @@ import util
 from util import SafeRe
 from Db.Db import Db
 from Debug import Debug
+from Crypt import CryptHash
 from Config import config
 from util import helper
 from util import ThreadPool
@@ -23,10 +25,13 @@ from Translate import translate as _
 thread_pool_fs_read = ThreadPool.ThreadPool(config.threads_fs_read, name="FS read")
 thread_pool_fs_write = ThreadPool.ThreadPool(config.threads_fs_write, name="FS write")
 thread_pool_fs_batch = ThreadPool.ThreadPool(1, name="FS batch")
+thread_pool_fs_hash = ThreadPool.ThreadPool(config.threads_fs_hash, name="FS hash")
 
 
 @PluginManager.acceptPlugins
 class SiteStorage(object):
+    db_update_queue_limit = 1000  # Do the queued db updates right away if more json files waiting
+
     def __init__(self, site, allow_create=True):
         self.site = site
         self.directory = "%s/%s" % (config.data_dir, self.site.address)  # Site data diretory
@@ -35,6 +40,8 @@ class SiteStorage(object):
         self.db = None  # Db class
         self.db_checked = False  # Checked db tables since startup
         self.event_db_busy = None  # Gevent AsyncResult if db is working on rebuild
+        self.db_update_queue = {}  # Json files waiting for db update, Key: inner_path, Value: None or False if deleted
+        self.db_update_thread = None
         self.has_db = self.isFile("dbschema.json")  # The site has schema
 
         if not os.path.isdir(self.directory):
@@ -98,9 +105,17 @@ class SiteStorage(object):
             except sqlite3.OperationalError:
                 pass
 
-    # Return db class
-    @util.Noparallel()
+    # Return db class, the queued json file updates are loaded first, so the reads include them
+    # (Writes after the call are not visible until the next getDb() or query() call)
     def getDb(self):
+        db = self.getDbReady()
+        if self.db_update_queue:
+            self.flushDbUpdates()
+        return db
+
+    # Return db class without loading the queued json file updates
+    @util.Noparallel()
+    def getDbReady(self):
         if self.event_db_busy:  # Db not ready for queries
             self.log.debug("Wating for db...")
             self.event_db_busy.get()  # Wait for event
@@ -116,6 +131,48 @@ class SiteStorage(object):
             db = self.getDb()
         return db.updateJson(path, file, cur)
 
+    # Collect the db updates of the changed json files and do them later in one batch
+    def queueDbUpdate(self, inner_path, file=None):
+        self.db_update_queue[inner_path] = file  # Only the latest version of the file is loaded
+        if len(self.db_update_queue) >= self.db_update_queue_limit:
+            self.flushDbUpdates()
+        elif not self.db_update_thread:
+            self.db_update_thread = gevent.spawn_later(config.db_update_delay, self.flushDbUpdates)
+
+    # Load the queued json files to the db
+    def flushDbUpdates(self):
+        self.db_update_thread = None
+        if not self.db_update_queue:
+            return 0
+        db_update_queue = self.db_update_queue
+        self.db_update_queue = {}
+        if config.disable_db or not self.has_db:
+            return 0
+
+        s = time.time()
+        num_updated = 0
+        try:
+            cur = self.getDbReady().getCursor()
+            cur.logging = False
+            cur.startBulk()
+            try:
+                for inner_path, file in db_update_queue.items():
+                    try:
+                        if self.updateDbFile(inner_path, file, cur=cur):
+                            num_updated += 1
+                    except Exception as err:
+                        self.log.error("Json %s load error: %s" % (inner_path, Debug.formatException(err)))
+            finally:
+                cur.endBulk()
+                cur.close()
+        except Exception as err:
+            self.log.error("Db update error: %s" % Debug.formatException(err))
+            self.closeDb("Json load error")
+
+        if config.verbose:
+            self.log.debug("Loaded %s/%s json files to db in %.3fs" % (num_updated, len(db_update_queue), time.time() - s))
+        return num_updated
+
     # Return possible db files for the site
     @thread_pool_fs_read.wrap
     def getDbFiles(self):
@@ -146,6 +203,7 @@ class SiteStorage(object):
     @thread_pool_fs_batch.wrap
     def rebuildDb(self, delete_db=True, reason="Unknown"):
         self.log.info("Rebuilding db (reason: %s)..." % reason)
+        self.db_update_queue = {}  # Every file is loaded by the rebuild
         self.has_db = self.isFile("dbschema.json")
         if not self.has_db:
             return False
@@ -173,6 +231,7 @@ class SiteStorage(object):
 
         cur = self.db.getCursor()
         cur.logging = False
+        cur.startBulk()  # Collect the rows and insert them in large batches
         s = time.time()
         self.log.info("Rebuild: Getting db files...")
         db_files = list(self.getDbFiles())
@@ -206,6 +265,8 @@ class SiteStorage(object):
                     time.sleep(0.001)  # Context switch to avoid UI block
 
         finally:
+            cur.endBulk()
+            num_error += cur.bulk_num_errors
             cur.close()
             if num_total > 100:
                 self.site.messageWebsocket(
@@ -226,7 +287,7 @@ class SiteStorage(object):
             raise Exception("Only SELECT query supported")
 
         try:
-            res = self.getDb().execute(query, params)
+            res = self.getDb().execute(query, params)  # Also includes the recently changed files in the result
         except sqlite3.DatabaseError as err:
             if err.__class__.__name__ == "DatabaseError":
                 self.log.error("Database error: %s, query: %s, try to rebuilding it..." % (err, query))
@@ -360,6 +421,9 @@ class SiteStorage(object):
         elif not config.disable_db and should_load_to_db and self.has_db:  # Load json file to db
             if config.verbose:
                 self.log.debug("Loading json file to db: %s (file: %s)" % (inner_path, file))
+            if file is None or file is False:  # Load from the disk later
+                self.queueDbUpdate(inner_path, file)
+                return
             try:
                 self.updateDbFile(inner_path, file)
             except Exception as err:
@@ -419,14 +483,90 @@ class SiteStorage(object):
                 raise Exception("File not allowed: %s" % path)
         return inner_path
 
+    # Calculate sha512sum and size of the file (runs in FS hash thread)
+    def hashFile(self, inner_path):
+        with open(self.getPath(inner_path), "rb") as file:
+            sha512 = CryptHash.sha512sum(file)
+            return sha512, file.tell()
+
+    # Verify files sha512sum using multiple threads
+    # Yield: (inner_path, ok, error) in order of finish
+    def verifyFilesHash(self, files):
+        def verifyFileHash(file):
+            inner_path, file_info = file
+            try:
+                sha512, size = self.hashFile(inner_path)
+                if sha512 != file_info.get("sha512", ""):
+                    return inner_path, False, "Invalid hash"
+                if size != file_info.get("size", 0):
+                    return inner_path, False, "File size does not match %s <> %s" % (size, file_info.get("size", 0))
+                return inner_path, True, None
+            except Exception as err:
+                return inner_path, False, err
+
+        num_total = len(files)
+        num_done = 0
+        message_id = "verify-%s" % self.site.address
+        for res in thread_pool_fs_hash.imapUnordered(verifyFileHash, files, maxsize=thread_pool_fs_hash.max_size * 4):
+            num_done += 1
+            if num_total > 100 and num_done % 100 == 0:
+                self.site.messageWebsocket(
+                    _["Verifying files...<br>Checked {0} of {1} files..."].format(num_done, num_total),
+                    message_id, int(float(num_done) / num_total * 100)
+                )
+            yield res
+
+        if num_total > 100:
+            self.site.messageWebsocket(
+                _["Verifying files...<br>Checked {0} of {1} files..."].format(num_done, num_total), message_id, 100
+            )
+
+    # Return: (size, mtime, inode) of the file or None if it's not exist
+    def getFileStat(self, inner_path):
+        try:
+            file_stat = os.stat(self.getPath(inner_path))
+        except OSError:
+            return None
+        if not stat.S_ISREG(file_stat.st_mode):
+            return None
+        return (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino & 0x7FFFFFFFFFFFFFFF)  # Fit to sqlite integer
+
     # Verify all files sha512sum using content.json
     def verifyFiles(self, quick_check=False, add_optional=False, add_changed=True):
         bad_files = []
         back = defaultdict(int)
         back["bad_files"] = bad_files
+        hash_files = []  # Files to verify by hash: [(inner_path, file_info), ...]
+        hash_callbacks = {}  # Called with verification result: {inner_path: (callback, args, file_stat, sha512)}
+        optional_num = defaultdict(int)
+        file_stats = self.site.content_manager.contents.db.getFileStats(self.site)  # Stats at last hash verification
+        file_stats_verified = {}  # Newly verified files: {inner_path: (size, mtime, inode, sha512)}
+        file_stats_removed = []  # Changed or missing files
         i = 0
         self.log.debug("Verifing files...")
 
+        def onFileVerified(file_inner_path, ok, err, content):
+            if not ok:
+                back["num_file_invalid"] += 1
+                self.log.debug("[INVALID] %s: %s" % (file_inner_path, err))
+                if add_changed or content.get("cert_user_id"):  # If updating own site only add changed user files
+                    bad_files.append(file_inner_path)
+
+        def onOptionalVerified(file_inner_path, ok, err, file_node, hash_id):
+            if ok:
+                if not self.site.content_manager.isDownloaded(file_inner_path, hash_id):
+                    back["num_optional_added"] += 1
+                    self.site.content_manager.optionalDownloaded(file_inner_path, hash_id, file_node["size"])
+                    optional_num["added"] += 1
+                    self.log.debug("[OPTIONAL FOUND] %s" % file_inner_path)
+            else:
+                if self.site.content_manager.isDownloaded(file_inner_path, hash_id):
+                    back["num_optional_removed"] += 1
+                    self.site.content_manager.optionalRemoved(file_inner_path, hash_id, file_node["size"])
+                    optional_num["removed"] += 1
+                bad_files.append(file_inner_path)
+                self.log.debug("[OPTIONAL CHANGED] %s" % file_inner_path)
+
         if not self.site.content_manager.contents.get("content.json"):  # No content.json, download it first
             self.log.debug("VerifyFile content.json not exists")
             self.site.needFile("content.json", update=True)  # Force update to fix corrupt file
@@ -445,40 +585,39 @@ class SiteStorage(object):
                 back["num_file"] += 1
                 file_inner_path = helper.getDirname(content_inner_path) + file_relative_path  # Relative to site dir
                 file_inner_path = file_inner_path.strip("/")  # Strip leading /
-                file_path = self.getPath(file_inner_path)
-                if not os.path.isfile(file_path):
+                file_node = content["files"][file_relative_path]
+                file_stat = self.getFileStat(file_inner_path)
+                if not file_stat:
                     back["num_file_missing"] += 1
                     self.log.debug("[MISSING] %s" % file_inner_path)
                     bad_files.append(file_inner_path)
+                    if file_inner_path in file_stats:
+                        file_stats_removed.append(file_inner_path)
                     continue
 
-                if quick_check:
-                    ok = os.path.getsize(file_path) == content["files"][file_relative_path]["size"]
-                    if not ok:
-                        err = "Invalid size"
+                if file_stats.get(file_inner_path) == file_stat + (file_node["sha512"],):
+                    back["num_file_unchanged"] += 1  # Not modified since the last hash verification
+                elif quick_check:
+                    ok = file_stat[0] == file_node["size"]
+                    if not ok and file_inner_path in file_stats:
+                        file_stats_removed.append(file_inner_path)
+                    onFileVerified(file_inner_path, ok, "Invalid size", content)
                 else:
-                    try:
-                        ok = self.site.content_manager.verifyFile(file_inner_path, open(file_path, "rb"))
-                    except Exception as err:
-                        ok = False
-
-                if not ok:
-                    back["num_file_invalid"] += 1
-                    self.log.debug("[INVALID] %s: %s" % (file_inner_path, err))
-                    if add_changed or content.get("cert_user_id"):  # If updating own site only add changed user files
-                        bad_files.append(file_inner_path)
+                    hash_files.append((file_inner_path, file_node))
+                    hash_callbacks[file_inner_path] = (onFileVerified, (content,), file_stat, file_node["sha512"])
 
             # Optional files
-            optional_added = 0
-            optional_removed = 0
+            optional_num = defaultdict(int)  # Added and removed optional files of the content (quick check only)
             for file_relative_path in list(content.get("files_optional", {}).keys()):
                 back["num_optional"] += 1
                 file_node = content["files_optional"][file_relative_path]
                 file_inner_path = helper.getDirname(content_inner_path) + file_relative_path  # Relative to site dir
                 file_inner_path = file_inner_path.strip("/")  # Strip leading /
-                file_path = self.getPath(file_inner_path)
                 hash_id = self.site.content_manager.hashfield.getHashId(file_node["sha512"])
-                if not os.path.isfile(file_path):
+                file_stat = self.getFileStat(file_inner_path)
+                if not file_stat:
+                    if file_inner_path in file_stats:
+                        file_stats_removed.append(file_inner_path)
                     if self.site.content_manager.isDownloaded(file_inner_path, hash_id):
                         back["num_optional_removed"] += 1
                         self.log.debug("[OPTIONAL MISSING] %s" % file_inner_path)
@@ -488,34 +627,43 @@ class SiteStorage(object):
                         bad_files.append(file_inner_path)
                     continue
 
-                if quick_check:
-                    ok = os.path.getsize(file_path) == content["files_optional"][file_relative_path]["size"]
+                if file_stats.get(file_inner_path) == file_stat + (file_node["sha512"],):
+                    back["num_optional_unchanged"] += 1  # Not modified since the last hash verification
+                    onOptionalVerified(file_inner_path, True, None, file_node, hash_id)
+                elif quick_check:
+                    ok = file_stat[0] == file_node["size"]
+                    if not ok and file_inner_path in file_stats:
+                        file_stats_removed.append(file_inner_path)
+                    onOptionalVerified(file_inner_path, ok, "Invalid size", file_node, hash_id)
                 else:
-                    try:
-                        ok = self.site.content_manager.verifyFile(file_inner_path, open(file_path, "rb"))
-                    except Exception as err:
-                        ok = False
-
-                if ok:
-                    if not self.site.content_manager.isDownloaded(file_inner_path, hash_id):
-                        back["num_optional_added"] += 1
-                        self.site.content_manager.optionalDownloaded(file_inner_path, hash_id, file_node["size"])
-                        optional_added += 1
-                        self.log.debug("[OPTIONAL FOUND] %s" % file_inner_path)
-                else:
-                    if self.site.content_manager.isDownloaded(file_inner_path, hash_id):
-                        back["num_optional_removed"] += 1
-                        self.site.content_manager.optionalRemoved(file_inner_path, hash_id, file_node["size"])
-                        optional_removed += 1
-                    bad_files.append(file_inner_path)
-                    self.log.debug("[OPTIONAL CHANGED] %s" % file_inner_path)
+                    hash_files.append((file_inner_path, file_node))
+                    hash_callbacks[file_inner_path] = (onOptionalVerified, (file_node, hash_id), file_stat, file_node["sha512"])
 
             if config.verbose:
                 self.log.debug(
                     "%s verified: %s, quick: %s, optionals: +%s -%s" %
-                    (content_inner_path, len(content["files"]), quick_check, optional_added, optional_removed)
+                    (content_inner_path, len(content["files"]), quick_check, optional_num["added"], optional_num["removed"])
                 )
 
+        if hash_files:
+            s = time.time()
+            for file_inner_path, ok, err in self.verifyFilesHash(hash_files):
+                callback, args, file_stat, sha512 = hash_callbacks.pop(file_inner_path)
+                if ok:
+                    file_stats_verified[file_inner_path] = file_stat + (sha512,)
+                elif file_inner_path in file_stats:
+                    file_stats_removed.append(file_inner_path)
+                callback(file_inner_path, ok, err, *args)
+            self.log.debug(
+                "Verified %s files by hash in %.3fs using %s threads" %
+                (len(hash_files), time.time() - s, thread_pool_fs_hash.max_size)
+            )
+
+        if file_stats_verified:
+            self.site.content_manager.contents.db.setFileStats(self.site, file_stats_verified)
+        if file_stats_removed:
+            self.site.content_manager.contents.db.deleteFileStats(self.site, file_stats_removed)
+
         self.site.content_manager.contents.db.processDelayed()
         time.sleep(0.001)  # Context switch to avoid gevent hangs
         return back
@@ -565,6 +713,7 @@ class SiteStorage(object):
 
         if self.isFile("dbschema.json"):
             self.log.debug("Deleting db file...")
+            self.db_update_queue = {}
             self.closeDb("Deleting site")
             self.has_db = False
             try:
@@ -1,5 +1,6 @@
 import time
 import socket
+import io
 import gevent
 
 import pytest
@@ -8,6 +9,8 @@ import mock
 from Crypt import CryptConnection
 from Connection import ConnectionServer
 from Config import config
+from util import Msgpack
+from util import Compression
 
 
 @pytest.mark.usefixtures("resetSettings")
@@ -73,6 +76,140 @@ class TestConnection:
         # Reset supported crypts
         CryptConnection.manager.crypt_supported = crypt_supported_bk
 
+    @pytest.mark.parametrize("chunk_size", [7, 1000, 1024 * 1024])
+    def testStreamFraming(self, chunk_size):
+        from Connection import Connection
+        client = ConnectionServer("127.0.0.1", 1545)
+        sock_conn, sock_peer = socket.socketpair()
+        connection = Connection(client, "127.0.0.1", 1234, sock_conn)
+        connection.handshake = {"use_bin_type": True}
+
+        stream_data = bytes(range(256)) * 400
+        data = b"".join([
+            Msgpack.pack({"cmd": "response", "to": 1, "stream_bytes": 5}), b"12345",
+            Msgpack.pack({"cmd": "response", "to": 2, "stream_bytes": len(stream_data)}), stream_data,
+            Msgpack.pack({"cmd": "response", "to": 3, "body": b"ok"})
+        ])
+        for req_id in [1, 2, 3]:
+            connection.waiting_requests[req_id] = {"evt": gevent.event.AsyncResult(), "cmd": "streamFile"}
+        streams = {1: io.BytesIO(), 2: io.BytesIO()}
+        connection.waiting_streams.update(streams)
+        events = {req_id: request["evt"] for req_id, request in connection.waiting_requests.items()}
+
+        gevent.spawn(connection.messageLoop)
+        unpackers = set()
+        for pos in range(0, len(data), chunk_size):
+            sock_peer.sendall(data[pos:pos + chunk_size])
+            time.sleep(0.001)
+            unpackers.add(id(connection.unpacker))
+
+        assert events[1].get(timeout=5)["stream_bytes"] == 5
+        assert events[2].get(timeout=5)["stream_bytes"] == len(stream_data)
+        assert events[3].get(timeout=5)["body"] == b"ok"
+        assert streams[1].getvalue() == b"12345"
+        assert streams[2].getvalue() == stream_data
+        assert len(unpackers) == 1  # Unpacker not re-created after streams
+
+        connection.close()
+        sock_peer.close()
+        client.stop()
+
+    def testRequestPipelining(self):
+        from Connection import Connection
+        client = ConnectionServer("127.0.0.1", 1545)
+        sock_conn, sock_peer = socket.socketpair()
+        with mock.patch("Config.config.request_inflight_limit", 2):
+            connection = Connection(client, "127.0.0.1", 1234, sock_conn)
+        connection.handshake = {"use_bin_type": True}
+        gevent.spawn(connection.messageLoop)
+
+        requests_received = []
+
+        def peerLoop():
+            unpacker = Msgpack.getUnpacker(decode=False)
+            while True:
+                buff = sock_peer.recv(64 * 1024)
+                if not buff:
+                    break
+                unpacker.feed(buff)
+                for message in unpacker:
+                    requests_received.append(message)
+
+        def respond(req_id, body, stream=None):
+            data = {"cmd": "response", "to": req_id, "body": body}
+            if stream:
+                data["stream_bytes"] = len(stream)
+                sock_peer.sendall(Msgpack.pack(data) + stream)
+            else:
+                sock_peer.sendall(Msgpack.pack(data))
+
+        gevent.spawn(peerLoop)
+
+        # Only 2 requests sent at once
+        threads = [gevent.spawn(connection.request, "test", {"num": i}) for i in range(3)]
+        time.sleep(0.1)
+        assert [request["req_id"] for request in requests_received] == [1, 2]
+
+        respond(2, b"Response 2")
+        assert threads[1].get(timeout=5)["body"] == b"Response 2"
+        time.sleep(0.1)
+        assert [request["req_id"] for request in requests_received] == [1, 2, 3]  # Freed slot used by the third one
+
+        respond(1, b"Response 1")
+        respond(3, b"Response 3")
+        assert threads[0].get(timeout=5)["body"] == b"Response 1"
+        assert threads[2].get(timeout=5)["body"] == b"Response 3"
+
+        # Timeout of a request doesn't affect the others
+        thread = gevent.spawn(connection.request, "test")
+        time.sleep(0.01)
+        buff = io.BytesIO()
+        assert connection.request("stream", stream_to=buff, timeout=0.1) is False
+        assert not connection.closed
+        assert list(connection.waiting_requests.keys()) == [4]
+        assert connection.waiting_streams == {}
+
+        respond(5, b"Late response", stream=b"Dropped")  # Stream of the timed out request dropped
+        respond(4, b"Response 4")
+        assert thread.get(timeout=5)["body"] == b"Response 4"
+        assert buff.getvalue() == b""
+        assert not connection.closed
+        assert connection.waiting_requests == {}
+
+        # Slow, but progressing stream is not timed out
+        buff = io.BytesIO()
+        thread = gevent.spawn(connection.request, "stream", stream_to=buff, timeout=0.3)
+        time.sleep(0.05)
+        sock_peer.sendall(Msgpack.pack({"cmd": "response", "to": 6, "body": b"Slow stream", "stream_bytes": 5}))
+        for char in b"12345":
+            time.sleep(0.15)
+            sock_peer.sendall(bytes([char]))
+        assert thread.get(timeout=5)["body"] == b"Slow stream"
+        assert buff.getvalue() == b"12345"
+
+        # Stream without progress timed out: the rest of the data not written to the buffer
+        buff = io.BytesIO()
+        thread = gevent.spawn(connection.request, "stream", stream_to=buff, timeout=0.2)
+        time.sleep(0.05)
+        sock_peer.sendall(Msgpack.pack({"cmd": "response", "to": 7, "body": b"Stalled stream", "stream_bytes": 4}) + b"12")
+        assert thread.get(timeout=5) is False
+        sock_peer.sendall(b"34")
+        time.sleep(0.05)
+        assert buff.getvalue() == b"12"
+        assert not connection.closed
+
+        # Stalled connection: no response and nothing received in 10 sec
+        thread = gevent.spawn(connection.request, "test")
+        time.sleep(0.1)
+        connection.waiting_requests[8]["time"] -= 20
+        connection.last_recv_time -= 20
+        assert connection.request("test") is False
+        assert connection.closed
+        assert thread.get(timeout=5) is False
+
+        sock_peer.close()
+        client.stop()
+
     def testPing(self, file_server, site):
         client = ConnectionServer(file_server.ip, 1545)
         connection = client.getConnection(file_server.ip, 1544)
@@ -116,3 +253,79 @@ class TestConnection:
 
         # Reset whitelist
         file_server.whitelist = whitelist
+
+    def testCompression(self, file_server, site):
+        file_server.ip_incoming = {}  # Reset flood protection
+        file_server.sites[site.address] = site
+        client = ConnectionServer(file_server.ip, 1545)
+        connection = client.getConnection(file_server.ip, 1544)
+        assert connection.compression in Compression.getSupported()
+        assert file_server.connections[0].compression == connection.compression
+
+        with mock.patch("util.Compression.compress", wraps=Compression.compress) as compress:
+            # Small messages sent as is
+            assert connection.request("ping")["body"] == b"Pong!"
+            assert not compress.called
+
+            # Large messages compressed in both direction
+            bytes_sent = connection.bytes_sent
+            hashes = [("%064d" % i).encode() for i in range(300)]
+            res = connection.request("setHashfield", {"site": site.address, "hashfield_raw": b"".join(hashes)})
+            assert res["ok"]
+            assert compress.call_count == 1
+            assert connection.bytes_sent - bytes_sent < len(b"".join(hashes)) / 2
+
+            res = connection.request("listModified", {"site": site.address, "since": 0})
+            assert "data/users/1C5sgvWaSgfaTpV5kjBCnCiKtENNMYo69q/content.json" in res["modified_files"]
+
+        connection.close()
+        client.stop()
+
+    def testCompressionMessageTypes(self, file_server):
+        file_server.ip_incoming = {}  # Reset flood protection
+        client = ConnectionServer(file_server.ip, 1545)
+        connection = client.getConnection(file_server.ip, 1544)
+        message = {"cmd": "test", "params": {"text": "hello", "data": b"\x00\x01"}}
+        data = Msgpack.pack(message)
+
+        # Compressed messages unpacked the same way as the uncompressed ones
+        for use_bin_type in [True, False]:
+            connection.handshake["use_bin_type"] = use_bin_type
+            unpacker = connection.getMsgpackUnpacker()
+            unpacker.feed(data)
+            message_plain = next(unpacker)
+            for method in Compression.getSupported():
+                message_compressed = {"compressed": method, "data": Compression.compress(data, method)}
+                assert connection.decompressMessage(message_compressed) == message_plain
+
+        # Malformed compression list in handshake
+        compression = connection.compression
+        for compression_supported in ["zlib", [], 5, None]:
+            handshake = dict(connection.handshake, compression_supported=compression_supported)
+            connection.event_connected = gevent.event.AsyncResult()
+            connection.setHandshake(handshake)
+            assert connection.compression == compression
+
+        connection.close()
+        client.stop()
+
+    def testCompressionDisabled(self, file_server):
+        file_server.ip_incoming = {}  # Reset flood protection
+        client = ConnectionServer(file_server.ip, 1545)
+        with mock.patch("Config.config.compression_min_size", 0):
+            connection = client.getConnection(file_server.ip, 1544)
+            assert "compression_supported" not in file_server.connections[0].handshake
+            assert connection.compression is None
+            assert file_server.connections[0].compression is None
+
+        connection.close()
+        client.stop()
+
+    def testCompressionLimit(self):
+        data = b"x" * (1024 * 1024)
+        for method in Compression.getSupported():
+            compressed = Compression.compress(data, method)
+            assert len(compressed) < 10 * 1024
+            assert Compression.decompress(compressed, method, max_size=len(data)) == data
+            with pytest.raises(Exception, match="too large"):
+                Compression.decompress(compressed, method, max_size=len(data) - 1)
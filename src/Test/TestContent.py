@@ -2,9 +2,11 @@ import json
 import time
 import io
 
+import mock
 import pytest
 
 from Crypt import CryptBitcoin
+from Content import ContentManager
 from Content.ContentManager import VerifyError, SignError
 from util.SafeRe import UnsafePatternError
 
@@ -271,3 +273,99 @@ class TestContent:
         assert site.content_manager.isValidRelativePath("any/CONAN")
         assert not site.content_manager.isValidRelativePath("any/CONOUT$")
         assert not site.content_manager.isValidRelativePath("a" * 256)  # Max 255 characters allowed
+
+    def testContentCache(self, site):
+        from Content import ContentDbDict
+        contents = site.content_manager.contents
+        user_keys = sorted([key for key in contents.keys() if key.startswith("data/users/1")])
+        for key in user_keys:
+            dict.__setitem__(contents, key, False)  # Purge from memory
+        key_sizes = [site.storage.getSize(key) for key in user_keys]
+
+        # Only the two latest json fits into the cache
+        cache = ContentDbDict.ContentCache(max_size=max(key_sizes[0], key_sizes[2]) + key_sizes[1])
+        with mock.patch.object(ContentDbDict, "content_cache", cache):
+            assert contents[user_keys[0]]
+            assert contents[user_keys[1]]
+            assert contents[user_keys[0]]  # Mark as recently used
+            assert contents[user_keys[2]]  # Evicts the least recently used: user_keys[1]
+
+            assert dict.get(contents, user_keys[0])
+            assert dict.get(contents, user_keys[1]) is False
+            assert dict.get(contents, user_keys[2])
+            assert cache.num_miss == 3
+            assert cache.num_hit == 1
+            assert cache.num_evicted == 1
+            assert cache.size == key_sizes[0] + key_sizes[2]
+
+            # Reloaded from disk on next access
+            assert contents[user_keys[1]]["cert_user_id"]
+            assert cache.num_miss == 4
+            assert dict.get(contents, user_keys[0]) is False
+
+            # Deleted keys are removed from the cache
+            del contents[user_keys[2]]
+            assert cache.size == key_sizes[1]
+            assert len(cache.items) == 1
+
+            # Items of the deleted site are removed
+            cache.removeSite(site.address)
+            assert cache.size == 0
+            assert not cache.items
+
+        assert "content.json" not in [key for address, key in cache.items]  # Root content.json is never purged
+
+    def testVerifySignCache(self, site):
+        ContentManager.verified_signs.clear()
+        inner_path = "data/users/1CjfbrbwtP8Y2QjPy12vpTATkUT7oSiPQ9/content.json"
+        content = site.storage.loadJson(inner_path)
+        sign_content = site.content_manager.getSignContent(content)
+        address, sign = list(content["signs"].items())[0]
+
+        with mock.patch.object(CryptBitcoin, "verify", wraps=CryptBitcoin.verify) as verify:
+            assert site.content_manager.verifyFile(inner_path, site.storage.open(inner_path), ignore_same=False)
+            num_verify = verify.call_count
+            assert num_verify > 0
+
+            # Valid signs are not checked again
+            assert site.content_manager.verifyFile(inner_path, site.storage.open(inner_path), ignore_same=False)
+            assert site.content_manager.verifySign(sign_content, address, sign)
+            assert verify.call_count == num_verify
+
+            # Invalid signs are not cached
+            assert not site.content_manager.verifySign(sign_content + " ", address, sign)
+            assert not site.content_manager.verifySign(sign_content + " ", address, sign)
+            assert verify.call_count == num_verify + 2
+
+            # Batch verification
+            sign_items = [
+                (sign_content, address, sign),  # Cached
+                (sign_content + "  ", address, sign),  # Invalid
+                ("hello", "1CjfbrbwtP8Y2QjPy12vpTATkUT7oSiPQ9", CryptBitcoin.sign("hello", self.privatekey)),  # Wrong address
+                ("hello", CryptBitcoin.privatekeyToAddress(self.privatekey), CryptBitcoin.sign("hello", self.privatekey)),
+                ("hello", address, None)  # No sign
+            ]
+            verify.reset_mock()
+            assert site.content_manager.verifySigns(sign_items) == [True, False, False, True, False]
+            assert verify.call_count == 3
+            assert site.content_manager.verifySign(*sign_items[3])
+            assert verify.call_count == 3
+
+            # Single verification does not use content.db, the batch one finds the stored signs after restart
+            ContentManager.verified_signs.clear()
+            with mock.patch.object(site.content_manager.contents.db, "isSignVerified") as is_sign_verified:
+                assert site.content_manager.verifySign(*sign_items[3])
+                assert not is_sign_verified.called
+            assert verify.call_count == 4
+            ContentManager.verified_signs.clear()
+            assert site.content_manager.verifySigns(sign_items[3:4]) == [True]
+            assert verify.call_count == 4
+            assert site.content_manager.verifySign(*sign_items[3])
+            assert verify.call_count == 4
+
+        # Memory cache size is limited
+        with mock.patch.object(ContentManager, "verified_signs_limit", 10):
+            for i in range(20):
+                site.content_manager.addVerifiedSign(("hash%s" % i, "address", "sign"))
+            assert len(ContentManager.verified_signs) == 10
+            assert ("hash19", "address", "sign") in ContentManager.verified_signs
@@ -1,4 +1,5 @@
 import io
+import json
 
 
 class TestDb:
@@ -135,3 +136,39 @@ class TestDb:
         assert db.updateJson(db.db_dir + "data.json", f) is False
         assert db.execute("SELECT COUNT(*) AS num FROM test_importfilter").fetchone()["num"] == 0
         assert db.execute("SELECT COUNT(*) AS num FROM test").fetchone()["num"] == 0
+
+    def testUpdateJsonBulk(self, db):
+        db.schema["maps"]["users/.+/data.json"] = db.schema["maps"]["data.json"]
+        cur = db.getCursor()
+        cur.startBulk(bulk_size=100)
+        for user_id in range(50):
+            data = {"test": [{"test_id": user_id * 10 + i, "title": "User %s title %s" % (user_id, i)} for i in range(10)]}
+            f = io.BytesIO(json.dumps(data).encode())
+            assert db.updateJson(db.db_dir + "users/%s/data.json" % user_id, f, cur=cur) is True
+
+        # Updating an already imported file should replace its pending rows
+        f = io.BytesIO(json.dumps({"test": [{"test_id": 0, "title": "Modified"}]}).encode())
+        assert db.updateJson(db.db_dir + "users/0/data.json", f, cur=cur) is True
+        cur.endBulk()
+
+        assert cur.bulk_num_errors == 0
+        assert db.execute("SELECT COUNT(*) AS num FROM test").fetchone()["num"] == 491
+        assert db.execute("SELECT COUNT(*) AS num FROM test_importfilter").fetchone()["num"] == 500  # No json_id col imported
+        assert db.execute("SELECT title FROM test WHERE test_id = 0").fetchone()["title"] == "Modified"
+        assert db.execute("SELECT title FROM test WHERE test_id = 1").fetchone() is None
+        row = db.execute(
+            "SELECT title, path FROM test LEFT JOIN json USING (json_id) WHERE test_id = 123"
+        ).fetchone()
+        assert row["title"] == "User 12 title 3"
+        assert row["path"] == "users/12/data.json"
+
+    def testUpdateJsonBulkInvalidRow(self, db):
+        cur = db.getCursor()
+        cur.startBulk()
+        data = {"test": [{"test_id": 1, "title": "Valid"}, {"test_id": 2, "title": ["Invalid"]}, {"test_id": 3, "title": "Valid"}]}
+        assert db.updateJson(db.db_dir + "data.json", io.BytesIO(json.dumps(data).encode()), cur=cur) is True
+        cur.endBulk()
+
+        # Only the invalid row skipped
+        assert cur.bulk_num_errors == 2  # Both in test and test_importfilter table
+        assert [row["test_id"] for row in db.execute("SELECT test_id FROM test ORDER BY test_id")] == [1, 3]
@@ -1,7 +1,9 @@
 import io
+import os
 
 import pytest
 import time
+import mock
 
 from Connection import ConnectionServer
 from Connection import Connection
@@ -88,6 +90,33 @@ class TestFileRequest:
         connection.close()
         client.stop()
 
+    def testSendfile(self, file_server, site):
+        file_server.ip_incoming = {}  # Reset flood protection
+        client = ConnectionServer(file_server.ip, 1545)
+        connection = client.getConnection(file_server.ip, 1544)
+        file_server.sites[site.address] = site
+        data = site.storage.read("content.json")
+
+        for sendfile in [True, False]:
+            with mock.patch("Config.config.sendfile", sendfile), mock.patch("os.sendfile", wraps=os.sendfile) as os_sendfile:
+                # Stream from position
+                buff = io.BytesIO()
+                response = connection.request(
+                    "streamFile", {"site": site.address, "inner_path": "content.json", "location": 100, "read_bytes": 1000}, buff
+                )
+                assert response["stream_bytes"] == 1000
+                assert buff.getvalue() == data[100:1100]
+
+                # Msgpack body
+                response = connection.request("getFile", {"site": site.address, "inner_path": "content.json", "location": 1000})
+                assert response["body"] == data[1000:]
+                assert response["location"] == len(data)
+
+                assert os_sendfile.called == sendfile
+
+        connection.close()
+        client.stop()
+
     def testPex(self, file_server, site, site_temp):
         file_server.sites[site.address] = site
         client = FileServer(file_server.ip, 1545)
@@ -1,7 +1,9 @@
 import socket
 import struct
 import os
+import io
 
+import gevent
 import pytest
 from util import helper
 from Config import config
@@ -77,3 +79,32 @@ class TestHelper:
 
         os.unlink(locked_f.name)
         os.unlink(locked_f_different.name)
+
+    def testSendfile(self):
+        data = os.urandom(1024 * 1024 * 3)
+        file_path = config.data_dir + "/sendfile.file"
+        with open(file_path, "wb") as f:
+            f.write(data)
+
+        sock_send, sock_recv = socket.socketpair()
+        received = []
+
+        def receiver():
+            while True:
+                buff = sock_recv.recv(64 * 1024)
+                if not buff:
+                    break
+                received.append(buff)
+
+        thread_receiver = gevent.spawn(receiver)
+        with open(file_path, "rb") as f:
+            assert helper.isSendfileSupported(f)
+            assert helper.sendfile(sock_send, f, 100, len(data)) == len(data) - 100  # End of file reached
+            assert helper.sendfile(sock_send, f, 0, 100) == 100
+        sock_send.close()
+        thread_receiver.join(timeout=10)
+        sock_recv.close()
+        os.unlink(file_path)
+
+        assert b"".join(received) == data[100:] + data[:100]
+        assert not helper.isSendfileSupported(io.BytesIO(data))
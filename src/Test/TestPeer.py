@@ -1,11 +1,15 @@
 import time
 import io
+import array
 
 import pytest
+import mock
 
 from File import FileServer
 from File import FileRequest
 from Crypt import CryptHash
+from Peer.PeerHashfield import PeerHashfield
+from Peer import Peer
 from . import Spy
 
 
@@ -52,6 +56,22 @@ class TestPeer:
         connection.close()
         client.stop()
 
+    def testRequestRetryStream(self, site):
+        peer = site.addPeer("1.2.3.4", 15441)
+        peer.connection = mock.MagicMock(closed=False, last_ping_delay=None)
+        results = [False, {"body": b"ok"}]
+
+        def request(cmd, params, stream_to, timeout=None):
+            stream_to.write(b"partial" if len(results) == 2 else b"full")
+            return results.pop(0)
+
+        peer.connection.request.side_effect = request
+        buff = io.BytesIO()
+        buff.write(b"head")
+        with mock.patch("time.sleep"), mock.patch.object(peer, "connect"):
+            assert peer.request("streamFile", {}, stream_to=buff) == {"body": b"ok"}
+        assert buff.getvalue() == b"headfull"  # Partial data of the failed try removed
+
     def testHashfield(self, site):
         sample_hash = list(site.content_manager.contents["content.json"]["files_optional"].values())[0]["sha512"]
 
@@ -75,6 +95,87 @@ class TestPeer:
         assert site.content_manager.hashfield.removeHash(new_hash)
         assert site.content_manager.hashfield.getHashId(new_hash) not in site.content_manager.hashfield
 
+    def testHashfieldBitset(self):
+        hashfield = PeerHashfield()
+        for hash_id in [65535, 0, 1234, 8, 1234]:
+            hashfield.append(hash_id)
+        assert len(hashfield) == 4
+        assert list(hashfield) == [65535, 0, 1234, 8]  # Insertion order, same as array
+        assert 1234 in hashfield and 1235 not in hashfield and 70000 not in hashfield
+
+        hashfield.remove(8)
+        assert 8 not in hashfield
+        assert len(hashfield) == 3
+        with pytest.raises(ValueError):
+            hashfield.remove(8)
+
+        # Wire format is compatible with the array based storage
+        raw = array.array("H", [5, 1234, 5]).tobytes()
+        hashfield_other = PeerHashfield()
+        hashfield_other.replaceFromBytes(raw)
+        assert list(hashfield_other) == [5, 1234]
+        assert hashfield_other.tobytes() == array.array("H", [5, 1234]).tobytes()
+        hashfield_other.replaceFromBytes(hashfield.tobytes())
+        assert list(hashfield_other) == list(hashfield)
+
+    def testPeerScoreboard(self, site):
+        peers = [site.addPeer("1.2.3.%s" % i, 15441) for i in range(100)]
+        for i, peer in enumerate(peers):
+            peer.reputation = i % 10
+            peer.updateScore()
+
+        best = site.peer_scoreboard.getBest(5)
+        assert [peer.reputation for peer in best] == [9] * 5
+        assert site.getRecentPeers(5) == best
+
+        # Fast peers ranked before higher reputation ones
+        peers[0].download_speed = 1024 * 1024
+        peers[0].updateScore()
+        assert site.peer_scoreboard.getBest(1) == [peers[0]]
+
+        # Slow response lowers the score even if the peer is not updated
+        peers[0].last_ping = 1.0
+        assert peers[0] not in site.peer_scoreboard.getBest(10)
+
+        # Filter
+        best = site.peer_scoreboard.getBest(3, lambda peer: peer.ip.endswith("5"))
+        assert [peer.ip for peer in best] == ["1.2.3.5", "1.2.3.15", "1.2.3.25"]
+
+        # Removed and directly added peers
+        best[0].remove()
+        assert best[0] not in site.peer_scoreboard.getBest(100)
+        site.peers["Peer:test"] = Peer("1.2.3.200", 15441, site)
+        site.peers["Peer:test"].key = "Peer:test"
+        site.peers["Peer:test"].reputation = 20
+        assert site.peer_scoreboard.getBest(1) == [site.peers["Peer:test"]]
+
+        # Buried peer reconsidered after a request measured its ping
+        peers[2].connection = mock.MagicMock(closed=False, last_ping_delay=5.0)
+        peers[2].reputation = 25
+        assert peers[2] not in site.peer_scoreboard.getBest(1)
+        peers[2].connection.last_ping_delay = 0.01
+        peers[2].connection.request.return_value = {"body": b"Pong!"}
+        assert peers[2].request("ping")
+        assert site.peer_scoreboard.getBest(1) == [peers[2]]
+        peers[2].connection = None
+        peers[2].reputation = 0
+        peers[2].updateScore()
+
+        # Peer replaced under the same key with the same score
+        peer_replaced = Peer(peers[3].ip, peers[3].port, site)
+        peer_replaced.reputation = peers[3].reputation
+        site.peers[peers[3].key] = peer_replaced
+        peer_replaced.updateScore()
+        best = site.peer_scoreboard.getBest(100)
+        assert peer_replaced in best and peers[3] not in best
+
+        # Outdated entries are removed from the heap
+        for i in range(1000):
+            peers[1].reputation = i
+            peers[1].updateScore()
+        assert len(site.peer_scoreboard.heap) < len(site.peers) * 2 + 101
+        assert site.peer_scoreboard.getBest(1) == [peers[1]]
+
     def testHashfieldExchange(self, file_server, site, site_temp):
         server1 = file_server
         server1.sites[site.address] = site
@@ -1,8 +1,16 @@
 import shutil
 import os
+import time
+import threading
+import json
 
+import gevent
+import mock
 import pytest
 from Site import SiteManager
+from File import FileServer
+from Config import config
+from util import helper
 
 TEST_DATA_PATH = "src/Test/testdata"
 
@@ -68,3 +76,227 @@ class TestSite:
         assert new_site.address in SiteManager.site_manager.sites
         SiteManager.site_manager.delete(new_site.address)
         assert new_site.address not in SiteManager.site_manager.sites
+
+    @pytest.mark.usefixtures("resetTempSettings")
+    def testConnectedPeers(self, file_server, site, site_temp):
+        file_server.sites[site.address] = site
+        site.connection_server = file_server
+        client = FileServer(file_server.ip, 1545)
+        client.sites = {site_temp.address: site_temp}
+        site_temp.connection_server = client
+
+        peer_file_server = site_temp.addPeer(file_server.ip, 1544)
+        assert site_temp.getConnectedPeers() == []
+
+        # Index updated on new connection
+        assert peer_file_server.ping()
+        assert site_temp.getConnectedPeers() == [peer_file_server]
+        connection = peer_file_server.connection
+
+        # Incoming connection is indexed by the fileserver port sent in the handshake
+        peer_client = site.addPeer(file_server.ip, 1545, return_peer=True)
+        assert site.getConnectedPeers() == [peer_client]
+        assert peer_client.connection.key == "%s:1545" % file_server.ip
+
+        # Peer without connection
+        peer_other = site_temp.addPeer("1.2.3.4", 1544)
+        assert peer_other not in site_temp.getConnectedPeers()
+
+        # Removed on connection close
+        connection.close("Test")
+        assert site_temp.getConnectedPeers() == []
+        assert not client.connections_by_key
+
+        # Recently closed connection still connectable
+        assert peer_file_server.key in site_temp.connected_peers
+        assert site_temp.getConnectablePeers(1) == [peer_file_server]
+        peer_file_server.connection.last_recv_time = time.time() - 60 * 60 * 3
+        site_temp.getConnectablePeers(1)
+        assert not peer_file_server.connection  # Dead connection cleaned up
+        assert peer_file_server.key not in site_temp.connected_peers
+
+        # Peer added after connection created
+        peer_file_server.remove()
+        assert peer_file_server.key not in site_temp.connected_peers
+        client.getConnection(file_server.ip, 1544)
+        peer_file_server = site_temp.addPeer(file_server.ip, 1544)
+        assert site_temp.getConnectedPeers() == [peer_file_server]
+        assert peer_file_server.connection
+
+        client.stop()
+        client.closeConnections()
+
+    def testPooledDownloadContent(self, site):
+        inner_paths = ["data/users/%s/content.json" % i for i in range(50)]
+        fetched = []
+        loading = []
+        loaded = []
+
+        def needFile(inner_path, *args, **kwargs):
+            time.sleep(0.01)
+            fetched.append(inner_path)
+            return True
+
+        def downloadContent(inner_path, *args, **kwargs):  # Slow load with files download
+            loading.append(inner_path)
+            assert len(loading) <= 10
+            time.sleep(0.1)
+            loading.remove(inner_path)
+            loaded.append(inner_path)
+            return True
+
+        with mock.patch.object(site, "needFile", needFile), mock.patch.object(site, "downloadContent", downloadContent):
+            thread = gevent.spawn(site.pooledDownloadContent, inner_paths, pool_size=10)
+            time.sleep(0.05)
+            assert len(fetched) >= 20  # Fetching not blocked by the loads
+            thread.join()
+
+        assert sorted(loaded) == sorted(inner_paths)
+
+    def testVerifySignThread(self, site):
+        from Crypt import CryptBitcoin
+        verify_threads = []
+        verify_original = CryptBitcoin.verify
+
+        def verify(*args, **kwargs):
+            verify_threads.append(threading.current_thread())
+            return verify_original(*args, **kwargs)
+
+        with mock.patch.object(CryptBitcoin, "verify", verify):
+            content = site.storage.open("content.json")
+            assert site.content_manager.verifyFile("content.json", content, ignore_same=False)
+
+        assert verify_threads
+        assert threading.main_thread() not in verify_threads
+
+    def testSaveIncremental(self, site):
+        site_manager = SiteManager.site_manager
+        site_manager.sites_json = {}
+        site_manager.save()
+        site_json = site_manager.sites_json[site.address]
+        data = json.load(open("%s/sites.json" % config.data_dir))
+        assert data[site.address]["cache"]["hashfield"] == site.getSettingsCache()["hashfield"]
+        assert site.settings["cache"] == {}
+
+        # Not changed: not re-formatted and not written
+        with mock.patch.object(helper, "jsonDumps") as jsonDumps, mock.patch.object(helper, "atomicWrite") as atomicWrite:
+            site_manager.save()
+            assert not jsonDumps.called
+            assert not atomicWrite.called
+        assert site_manager.sites_json[site.address] is site_json
+
+        # Changed only the modified site is re-formatted
+        site.settings["size_limit"] = 123
+        with mock.patch.object(site_manager, "saveDelayed"):
+            site.saveSettings()
+        with mock.patch.object(helper, "jsonDumps", wraps=helper.jsonDumps) as jsonDumps:
+            site_manager.save()
+            assert jsonDumps.call_count == 1
+        data = json.load(open("%s/sites.json" % config.data_dir))
+        assert data[site.address]["size_limit"] == 123
+
+        # Re-formatted but same as before: not written
+        site_manager.markDirty(site.address)
+        with mock.patch.object(helper, "atomicWrite") as atomicWrite:
+            site_manager.save()
+            assert not atomicWrite.called
+
+        # Changes without marking the site dirty are saved by the periodic full save
+        site.bad_files["data/test.json"] = 1
+        site_manager.save()
+        data = json.load(open("%s/sites.json" % config.data_dir))
+        assert "data/test.json" not in data[site.address]["cache"]["bad_files"]
+        site_manager.save(recalculate_size=True)
+        data = json.load(open("%s/sites.json" % config.data_dir))
+        assert data[site.address]["cache"]["bad_files"] == {"data/test.json": 1}
+
+        # Size totals maintained on content changes without recalculation
+        content_db = site.content_manager.contents.db
+        size, size_optional = site.content_manager.getTotalSize()
+        content_new = {"files": {"a.txt": {"size": 100}}, "files_optional": {"b.txt": {"size": 10, "sha512": "aa" * 32}}}
+        content_db.setContent(site, "data/new/content.json", content_new, size=50)
+        with mock.patch.object(content_db, "execute") as execute:
+            assert site.content_manager.getTotalSize() == (size + 150, size_optional + 10)
+            assert not execute.called
+        content_db.setContent(site, "data/new/content.json", {"files": {"a.txt": {"size": 200}}}, size=60)
+        assert site.content_manager.getTotalSize() == (size + 260, size_optional)
+        content_db.deleteContent(site, "data/new/content.json")
+        assert site.content_manager.getTotalSize() == (size, size_optional)
+        content_db.site_sizes.clear()
+        assert site.content_manager.getTotalSize() == (size, size_optional)
+
+    def testLazyLoad(self, site):
+        site_manager = SiteManager.site_manager
+        site.storage.verifyFiles(quick_check=True)  # Find what optional files we have
+        site_manager.sites_json = {}
+        site_manager.save()
+
+        site_manager.sites.clear()
+        with mock.patch.object(config, "site_load_lazy", True):
+            site_manager.load(cleanup=False)
+        site_lazy = site_manager.sites[site.address]
+        assert site_lazy is not site
+        assert not site_lazy.isLoaded()
+        assert site_lazy.settings["wrapper_key"] == site.settings["wrapper_key"]
+
+        # Saving not loads the site and keeps its cache
+        site_manager.sites_json = {}
+        site_manager.save()
+        assert not site_lazy.isLoaded()
+        data = json.load(open("%s/sites.json" % config.data_dir))
+        assert data[site.address]["cache"]["hashfield"] == site.getSettingsCache()["hashfield"]
+
+        # Loaded on first access
+        assert site_lazy.content_manager.contents["content.json"]["title"] == "ZeroBlog"
+        assert site_lazy.isLoaded()
+        assert site_lazy.storage.directory == site.storage.directory
+        assert site_lazy.content_manager.hashfield.tobytes() == site.content_manager.hashfield.tobytes()
+        assert site_lazy.worker_manager.site is site_lazy
+        with pytest.raises(AttributeError):
+            site_lazy.not_exists
+
+        site_manager.sites[site.address] = site
+
+    def testLazyLoadError(self, site):
+        from Site import Site as SiteModule
+        from Content.ContentManager import ContentManager
+        site_manager = SiteManager.site_manager
+        site_manager.sites_json = {}
+        site_manager.save()
+
+        # Sites without stored content.json are loaded right away to check them
+        site_manager.sites.clear()
+        with mock.patch.object(config, "site_load_lazy", True):
+            with mock.patch.object(site.content_manager.contents.db, "getSitesWithContent", return_value=set()):
+                site_manager.load(cleanup=False)
+        assert site_manager.sites[site.address].isLoaded()
+        site_manager.sites[site.address].worker_manager.running = False
+        site_manager.sites[site.address] = site
+
+        # Partially loaded components are dropped and the load is not retried on every access
+        site_lazy = SiteModule.Site(site.address, settings=site.settings, lazy=True)
+        site_lazy.connection_server = site.connection_server
+        worker_managers = []
+        WorkerManager = SiteModule.WorkerManager
+
+        def createWorkerManager(*args, **kwargs):
+            worker_managers.append(WorkerManager(*args, **kwargs))
+            return worker_managers[-1]
+
+        with mock.patch.object(ContentManager, "loadContents", side_effect=Exception("Broken content")) as load_contents:
+            with mock.patch.object(SiteModule, "WorkerManager", side_effect=createWorkerManager):
+                with pytest.raises(Exception, match="Broken content"):
+                    site_lazy.storage
+                with pytest.raises(AttributeError, match="Broken content"):
+                    site_lazy.worker_manager
+            assert load_contents.call_count == 1
+        assert not site_lazy.isLoaded()
+        assert "worker_manager" not in site_lazy.__dict__ and "storage" not in site_lazy.__dict__
+        assert len(worker_managers) == 1
+        assert not worker_managers[0].running  # Task checker of the dropped worker manager stopped
+
+        # Explicit load retries
+        site_lazy.loadSite()
+        assert site_lazy.isLoaded()
+        assert not site_lazy.load_error
+        site_lazy.worker_manager.running = False
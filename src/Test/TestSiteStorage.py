@@ -1,3 +1,7 @@
+import json
+import time
+
+import mock
 import pytest
 
 
@@ -23,3 +27,106 @@ class TestSiteStorage:
 
     def testDbRebuild(self, site):
         assert site.storage.rebuildDb()
+
+        # Verify imported rows
+        db = site.storage.getDb()
+        assert db.execute("SELECT COUNT(*) AS num FROM post").fetchone()["num"] == 39
+        assert db.execute("SELECT COUNT(*) AS num FROM comment").fetchone()["num"] == 3
+        row = db.execute("SELECT value FROM keyvalue LEFT JOIN json USING (json_id) WHERE ?", {
+            "key": "title", "directory": "", "file_name": "data.json"
+        }).fetchone()
+        assert row["value"] == "ZeroBlog"
+        cert_user_ids = [row["value"] for row in db.execute("SELECT value FROM keyvalue WHERE ?", {"key": "cert_user_id"})]
+        assert sorted(cert_user_ids) == ["newzeroid@zeroid.bit", "toruser@zeroid.bit", "toruser@zeroid.bit"]
+
+        # Same result after rebuild using the existing database
+        assert site.storage.rebuildDb(delete_db=False)
+        assert db.execute("SELECT COUNT(*) AS num FROM post").fetchone()["num"] == 39
+        assert db.execute("SELECT COUNT(*) AS num FROM comment").fetchone()["num"] == 3
+
+    def testVerifyFiles(self, site):
+        from Site import SiteStorage
+
+        # Modify a normal and an optional file without changing their size
+        for inner_path in ["css/all.css", "data/optional.txt"]:
+            data = site.storage.read(inner_path)
+            site.storage.write(inner_path, b"X" + data[1:])
+        site.storage.delete("img/loading.gif")
+
+        res_pooled = site.storage.verifyFiles(quick_check=False)
+        with mock.patch.object(SiteStorage.thread_pool_fs_hash, "pool", None):
+            res_serial = site.storage.verifyFiles(quick_check=False)
+
+        assert sorted(res_pooled["bad_files"]) == sorted(res_serial["bad_files"])
+        assert sorted(res_pooled["bad_files"]) == ["css/all.css", "data/optional.txt", "img/loading.gif"]
+        assert res_pooled["num_file_invalid"] == res_serial["num_file_invalid"] == 1
+        assert res_pooled["num_file_missing"] == res_serial["num_file_missing"] == 1
+        assert res_pooled["num_file"] == res_serial["num_file"]
+
+        # Only size checked on quick check
+        assert site.storage.verifyFiles(quick_check=True)["bad_files"] == ["img/loading.gif"]
+
+    def testVerifyFilesStatCache(self, site):
+        content_db = site.content_manager.contents.db
+
+        res = site.storage.verifyFiles(quick_check=False)
+        assert res["bad_files"] == []
+        assert res["num_file_unchanged"] == 0
+        file_stats = content_db.getFileStats(site)
+        assert file_stats["css/all.css"][0] == site.storage.getSize("css/all.css")
+        assert file_stats["css/all.css"][3] == site.content_manager.getFileInfo("css/all.css")["sha512"]
+        assert "data/optional.txt" in file_stats
+
+        # Unchanged files are not hashed again
+        with mock.patch.object(site.storage, "hashFile", wraps=site.storage.hashFile) as hash_file:
+            res = site.storage.verifyFiles(quick_check=False)
+            assert hash_file.call_count == 0
+        assert res["bad_files"] == []
+        assert res["num_file_unchanged"] == res["num_file"]
+        assert res["num_optional_unchanged"] == len(file_stats) - res["num_file"]
+
+        # Modified file verified again even if the size is the same
+        data = site.storage.read("css/all.css")
+        site.storage.write("css/all.css", b"X" + data[1:])
+        with mock.patch.object(site.storage, "hashFile", wraps=site.storage.hashFile) as hash_file:
+            res = site.storage.verifyFiles(quick_check=False)
+            assert hash_file.call_count == 1
+        assert res["bad_files"] == ["css/all.css"]
+        assert "css/all.css" not in content_db.getFileStats(site)
+
+        # Deleted files removed from the cache
+        site.storage.delete("data/optional.txt")
+        assert site.storage.verifyFiles(quick_check=True)["bad_files"] == []
+        assert "data/optional.txt" not in content_db.getFileStats(site)
+
+    def testDbUpdateQueue(self, site):
+        site.storage.rebuildDb()
+        db = site.storage.getDb()
+        num_comment = db.execute("SELECT COUNT(*) AS num FROM comment").fetchone()["num"]
+
+        # Writes of the json files are loaded to the db in one batch
+        inner_path = "data/users/1CjfbrbwtP8Y2QjPy12vpTATkUT7oSiPQ9/data.json"
+        data = site.storage.loadJson(inner_path)
+        with mock.patch.object(site.storage, "updateDbFile", wraps=site.storage.updateDbFile) as update_db_file:
+            for i in range(3):
+                data["comment"].append({"comment_id": 100 + i, "body": "Hello %s" % i, "post_id": 1, "date_added": 0})
+                site.storage.write(inner_path, json.dumps(data).encode())
+            assert update_db_file.call_count == 0
+            assert list(site.storage.db_update_queue.keys()) == [inner_path]
+
+            time.sleep(0.6)  # Flushed after the delay
+            assert update_db_file.call_count == 1
+        assert not site.storage.db_update_queue
+        assert db.execute("SELECT COUNT(*) AS num FROM comment").fetchone()["num"] == num_comment + 3
+
+        # Queries see the pending changes
+        site.storage.delete(inner_path)
+        assert site.storage.db_update_queue == {inner_path: False}
+        assert site.storage.query("SELECT COUNT(*) AS num FROM comment").fetchone()["num"] < num_comment
+        assert not site.storage.db_update_queue
+
+        # Also the db returned by getDb
+        site.storage.write(inner_path, json.dumps(data).encode())
+        assert site.storage.db_update_queue
+        assert site.storage.getDb().execute("SELECT COUNT(*) AS num FROM comment").fetchone()["num"] == num_comment + 3
+        assert not site.storage.db_update_queue
@@ -0,0 +1,165 @@
+import time
+
+import gevent
+import pytest
+import mock
+
+from Worker import Worker
+
+
+@pytest.mark.usefixtures("resetSettings")
+class TestWorkerManager:
+    def testTaskCheckSchedule(self, site):
+        worker_manager = site.worker_manager
+        task = worker_manager.addTask("data/nonexistent.json")
+        assert task["time_check"] == pytest.approx(task["time_added"] + 15)
+        assert worker_manager.task_checks[0][2] is task
+
+        # Idle checker wakes up only at the deadline
+        time.sleep(0.1)
+        assert worker_manager.popDueTasks(time.time()) == []
+
+        # Deadline reached: task added 60 sec ago without workers gets failed
+        task["time_added"] = time.time() - 59.9
+        assert worker_manager.scheduleTaskCheck(task)
+        assert task["time_check"] == pytest.approx(task["time_added"] + 60)
+        assert task["evt"].get(timeout=1) is False
+        assert not worker_manager.tasks
+
+        # Checker goes idle without tasks
+        time.sleep(0.01)
+        assert worker_manager.task_checks == []
+
+    def testCheckTasksSoon(self, site):
+        worker_manager = site.worker_manager
+        task = worker_manager.addTask("data/nonexistent.json")
+        task["time_added"] = time.time() - 61  # Would be only checked 15 sec later
+
+        s = time.time()
+        worker_manager.checkTasksSoon()
+        assert task["evt"].get(timeout=2) is False
+        assert time.time() - s < 1.5
+
+    def testWaitForTask(self, site):
+        worker_manager = site.worker_manager
+        task = worker_manager.addTask("data/nonexistent.json")
+        task["workers_num"] = 1
+        worker = Worker(worker_manager, site.addPeer("1.2.3.4", 15441))
+
+        s = time.time()
+        thread = gevent.spawn(worker.waitForTask, task, 3)
+        time.sleep(0.01)
+        worker_manager.removeTaskWorker(task, None)  # Last worker left the task
+        thread.join(timeout=1)
+        assert thread.ready()
+        assert time.time() - s < 0.5
+
+    def testGetTask(self, site):
+        worker_manager = site.worker_manager
+        peer1 = site.addPeer("1.2.3.4", 15441)
+        peer2 = site.addPeer("1.2.3.5", 15441)
+        with mock.patch.object(worker_manager, "startWorkers"), mock.patch.object(worker_manager, "startFindOptional"):
+            tasks = [worker_manager.addTask("data/file%s.bin" % i) for i in range(1000)]
+            task_locked = worker_manager.addTask("data/locked.json", peer=peer2)
+            task_optional = worker_manager.addTask(
+                "data/optional.bin", priority=100, file_info={"optional": True, "sha512": "aa" * 32, "size": 1}
+            )
+
+        assert len(worker_manager.tasks.open_tasks) == 1000
+        assert worker_manager.getTask(peer1) is tasks[0]
+        assert worker_manager.getTask(peer2) is task_locked  # Json priority boost, locked to peer2
+
+        # Failed by the peer
+        tasks[0]["failed"].add(peer1)
+        assert worker_manager.getTask(peer1) is tasks[1]
+
+        # Workers lowers the priority
+        worker_manager.addTaskWorker(tasks[1], None)
+        assert worker_manager.getTask(peer1) is tasks[2]
+        assert worker_manager.tasks.open_tasks[:] == [task for task in worker_manager.tasks if task in tasks]
+
+        # Optional task pickable only by peers found for it
+        worker_manager.taskAddPeer(task_optional, peer1)
+        assert worker_manager.getTask(peer1) is task_optional
+        assert worker_manager.getTask(peer2) is task_locked
+
+        # Peer lock released
+        worker_manager.tasks.setTaskPeers(task_optional, set())
+        assert worker_manager.getTask(peer2) is task_optional
+        assert not worker_manager.tasks.getPeerTasks(peer1)
+
+        worker_manager.failTask(task_optional)
+        worker_manager.failTask(task_locked)
+        assert not worker_manager.tasks.getPeerTasks(peer2)
+        assert worker_manager.getTask(peer2) is tasks[0]
+        assert len(worker_manager.tasks.open_tasks) == 1000
+
+    def testPipelineWorker(self, site):
+        worker_manager = site.worker_manager
+        peer = site.addPeer("1.2.3.4", 15441)
+        with mock.patch.object(worker_manager, "startWorkers"), mock.patch.object(worker_manager, "startFindOptional"):
+            tasks = [worker_manager.addTask("data/file%s.bin" % i) for i in range(10)]
+
+        with mock.patch.object(Worker, "start"):
+            assert worker_manager.addWorker(peer)
+            # Peer completed a task: more requests kept outstanding to it
+            assert worker_manager.startPipelineWorker(peer)
+            assert worker_manager.startPipelineWorker(peer)
+            assert len(worker_manager.workers) == 3
+            assert not worker_manager.startPipelineWorker(peer)  # Pipeline limit reached
+
+            # No free task left for the peer
+            worker_manager.workers.clear()
+            assert worker_manager.addWorker(peer)
+            for task in tasks:
+                worker_manager.addTaskWorker(task, None)
+            assert not worker_manager.startPipelineWorker(peer)
+            assert len(worker_manager.workers) == 1
+
+            # Pipelining disabled
+            worker_manager.removeTaskWorker(tasks[0], None)
+            with mock.patch("Config.config.worker_pipeline", 1):
+                assert not worker_manager.startPipelineWorker(peer)
+
+            worker_manager.workers.clear()
+            for task in tasks:
+                worker_manager.failTask(task)
+
+    def testStalledTask(self, site):
+        worker_manager = site.worker_manager
+        peer = site.addPeer("1.2.3.4", 15441)
+        with mock.patch.object(worker_manager, "startWorkers"), mock.patch.object(worker_manager, "startFindOptional"):
+            task = worker_manager.addTask("data/file.bin")
+            worker = Worker(worker_manager, peer)
+            worker.key = peer.key
+            worker.task = task
+            worker_manager.workers[peer.key] = worker
+            peer.connection = mock.MagicMock(last_recv_time=0, last_ping_delay=None)
+
+            # Check scheduled a second after the last received data
+            task["time_started"] = time.time()
+            worker_manager.scheduleTaskCheck(task)
+            assert task["time_check"] == pytest.approx(task["time_started"] + 1)
+            peer.connection.last_recv_time = task["time_started"] + 0.5
+            assert worker_manager.getTaskCheckTime(task) == pytest.approx(task["time_started"] + 1.5)
+
+            # Stalled: more workers started in a second instead of 15
+            peer.connection.last_recv_time = time.time()
+            worker_manager.scheduleTaskCheck(task)
+            s = time.time()
+            while not task["time_slow"] and time.time() - s < 3:
+                time.sleep(0.1)
+            assert 0.8 < time.time() - s < 1.5
+            assert worker_manager.startWorkers.called
+            assert task["time_check"] == pytest.approx(peer.connection.last_recv_time + 10)
+
+            # No data for 10 sec: workers skipped
+            task["time_started"] = peer.connection.last_recv_time = time.time() - 10
+            with mock.patch.object(Worker, "skip") as skip:
+                worker_manager.checkTasksSoon()
+                time.sleep(1.2)
+                assert skip.called
+
+            peer.connection = None
+            worker_manager.workers.clear()
+            worker_manager.failTask(task)
@@ -139,7 +139,7 @@ def cleanup():
         if os.path.isdir(dir_path):
             for file_name in os.listdir(dir_path):
                 ext = file_name.rsplit(".", 1)[-1]
-                if ext not in ["csr", "pem", "srl", "db", "json", "tmp"]:
+                if ext not in ["csr", "pem", "srl", "db", "db-shm", "db-wal", "json", "tmp", "cnf"]:
                     continue
                 file_path = dir_path + "/" + file_name
                 if os.path.isfile(file_path):
@@ -783,6 +783,18 @@ class UiRequest(object):
                 if not file_obj:
                     file_obj = open(file_path, "rb")
 
+                sendfile = self.env.get("zeronet.sendfile")
+                if sendfile and send_header and header_length and not is_html_file and helper.isSendfileSupported(file_obj):
+                    # Response length known: send the file using zero-copy os.sendfile
+                    try:
+                        if range:
+                            sendfile(file_obj, range_start, range_end - range_start)
+                        else:
+                            sendfile(file_obj, 0, file_size)
+                    finally:
+                        file_obj.close()
+                    return
+
                 if range_start:
                     file_obj.seek(range_start)
                 while 1:
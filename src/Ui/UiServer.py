@@ -1,5 +1,6 @@
 import logging
 import time
+import os
 import urllib
 import socket
 import gevent
@@ -11,6 +12,7 @@ from .UiRequest import UiRequest
 from Site import SiteManager
 from Config import config
 from Debug import Debug
+from util import helper
 import importlib
 
 
@@ -43,6 +45,21 @@ class UiWSGIHandler(WebSocketHandler):
             logging.warning("%s error: %s" % (err_name, Debug.formatException(err)))
             self.handleError(err)
 
+    def get_environ(self):
+        env = super(UiWSGIHandler, self).get_environ()
+        if config.sendfile and hasattr(os, "sendfile"):
+            env["zeronet.sendfile"] = self.sendfile
+        return env
+
+    # Send the headers, then the file content using zero-copy os.sendfile
+    # Return: Number of bytes sent
+    def sendfile(self, file, offset, count):
+        if not self.headers_sent:
+            self.write(b"")
+        bytes_sent = helper.sendfile(self.socket, file, offset, count)
+        self.response_length += bytes_sent
+        return bytes_sent
+
     def handle(self):
         # Save socket to be able to close them properly on exit
         self.server.sockets[self.client_address] = self.socket
@@ -388,6 +388,8 @@ class UiWebsocket(object):
         back = {}
         trackers = self.site.announcer.getTrackers()
         for site in list(self.server.sites.values()):
+            if not site.isLoaded():
+                continue  # Not announced yet
             for tracker, stats in site.announcer.stats.items():
                 if tracker not in trackers:
                     continue
@@ -1145,7 +1147,7 @@ class UiWebsocket(object):
             import main
             main.update_after_shutdown = True
             main.restart_after_shutdown = True
-            SiteManager.site_manager.save()
+            SiteManager.site_manager.save(recalculate_size=True)
             main.file_server.stop()
             main.ui_server.stop()
 
@@ -39,33 +39,40 @@ class Worker(object):
         return "<%s>" % self.__str__()
 
     def waitForTask(self, task, timeout):  # Wait for other workers to finish the task
-        for sleep_i in range(1, timeout * 10):
-            time.sleep(0.1)
+        time_start = time.time()
+        time_idle_check = time_start + 1
+        while time.time() - time_start < timeout:
             if task["done"] or task["workers_num"] == 0:
                 if config.verbose:
-                    self.manager.log.debug("%s: %s, picked task free after %ss sleep. (done: %s)" % (
-                        self.key, task["inner_path"], 0.1 * sleep_i, task["done"]
+                    self.manager.log.debug("%s: %s, picked task free after %.1fs sleep. (done: %s)" % (
+                        self.key, task["inner_path"], time.time() - time_start, task["done"]
                     ))
                 break
 
-            if sleep_i % 10 == 0:
+            if time.time() >= time_idle_check:
+                time_idle_check += 1
                 workers = self.manager.findWorkers(task)
                 if not workers or not workers[0].peer.connection:
                     break
                 worker_idle = time.time() - workers[0].peer.connection.last_recv_time
                 if worker_idle > 1:
                     if config.verbose:
-                        self.manager.log.debug("%s: %s, worker %s seems idle, picked up task after %ss sleep. (done: %s)" % (
-                            self.key, task["inner_path"], workers[0].key, 0.1 * sleep_i, task["done"]
+                        self.manager.log.debug("%s: %s, worker %s seems idle, picked up task after %.1fs sleep. (done: %s)" % (
+                            self.key, task["inner_path"], workers[0].key, time.time() - time_start, task["done"]
                         ))
                     break
+
+            # Woken up when the task done or other workers left it
+            self.manager.waitTaskChange(min(time_idle_check, time_start + timeout) - time.time())
         return True
 
     def pickTask(self):  # Find and select a new task for the worker
         task = self.manager.getTask(self.peer)
         if not task:  # No more task
-            time.sleep(0.1)  # Wait a bit for new tasks
-            task = self.manager.getTask(self.peer)
+            time_wait_end = time.time() + 0.1
+            while not task and time.time() < time_wait_end:  # Wait a bit for new tasks
+                self.manager.waitTaskChange(time_wait_end - time.time())
+                task = self.manager.getTask(self.peer)
             if not task:  # Still no task, stop it
                 stats = "downloaded files: %s, failed: %s" % (self.num_downloaded, self.num_failed)
                 self.manager.log.debug("%s: No task found, stopping (%s)" % (self.key, stats))
@@ -73,6 +80,7 @@ class Worker(object):
 
         if not task["time_started"]:
             task["time_started"] = time.time()  # Task started now
+            self.manager.scheduleTaskCheck(task)
 
         if task["workers_num"] > 0:  # Wait a bit if someone already working on it
             if task["peers"]:  # It's an update
@@ -126,7 +134,7 @@ class Worker(object):
                 "%s: Verify failed: %s, error: %s, failed peers: %s, workers: %s" %
                 (self.key, task["inner_path"], error_message, len(task["failed"]), task["workers_num"])
             )
-        task["failed"].append(self.peer)
+        task["failed"].add(self.peer)
         self.peer.hash_failed += 1
         if self.peer.hash_failed >= max(len(self.manager.tasks), 3) or self.peer.connection_error > 10:
             # Broken peer: More fails than tasks number but atleast 3
@@ -212,6 +220,8 @@ class Worker(object):
                 break
 
             self.manager.removeTaskWorker(task, self)
+            if success:
+                self.manager.startPipelineWorker(self.peer)
 
         self.peer.onWorkerDone()
         self.running = False
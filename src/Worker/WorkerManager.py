@@ -1,8 +1,10 @@
 import time
+import heapq
 import logging
 import collections
 
 import gevent
+import gevent.event
 
 from .Worker import Worker
 from .WorkerTaskManager import WorkerTaskManager
@@ -15,6 +17,8 @@ import util
 
 @PluginManager.acceptPlugins
 class WorkerManager(object):
+    task_stall_time = 1  # Find more workers if the workers of the task received nothing for this many seconds
+    task_stall_timeout = 10  # Skip the workers of the task if they received nothing for this many seconds
 
     def __init__(self, site):
         self.site = site
@@ -23,11 +27,16 @@ class WorkerManager(object):
         self.next_task_id = 1
         self.lock_add_task = DebugLock(name="Lock AddTask:%s" % self.site.address_short)
         # {"id": 1, "evt": evt, "workers_num": 0, "site": self.site, "inner_path": inner_path, "done": False, "optional_hash_id": None,
-        # "time_started": None, "time_added": time.time(), "peers": peers, "priority": 0, "failed": peer_ids, "lock": None or gevent.lock.RLock}
+        # "time_started": None, "time_added": time.time(), "peers": set of peers or None, "priority": 0, "failed": set of peers, "lock": None or gevent.lock.RLock}
         self.started_task_num = 0  # Last added task num
         self.asked_peers = []
         self.running = True
         self.time_task_added = 0
+        self.task_checks = []  # Heap of next task checks: [(time, task id, task), ...], can contain outdated entries
+        self.event_check = gevent.event.Event()  # Wake up the task checker
+        self.check_all = False  # Check every task on next wakeup
+        self.time_check_all = 0
+        self.event_task_changed = gevent.event.Event()  # Wake up workers waiting for a task
         self.log = logging.getLogger("WorkerManager:%s" % self.site.address_short)
         self.site.greenlet_manager.spawn(self.checkTasks)
 
@@ -37,32 +46,119 @@ class WorkerManager(object):
     def __repr__(self):
         return "<%s>" % self.__str__()
 
-    # Check expired tasks
+    # Next time when the task needs a check: every 15 sec from the start of the task or when the started task stalls
+    def getTaskCheckTime(self, task, now=None):
+        if now is None:
+            now = time.time()
+        time_start = task["time_started"] or task["time_added"]
+        time_check = time_start + (int((now - time_start) / 15) + 1) * 15
+        if task["time_started"]:
+            time_progress = self.getTaskProgressTime(task)
+            if now < time_progress + self.task_stall_time:
+                time_check = min(time_check, time_progress + self.task_stall_time)
+            elif now < time_progress + self.task_stall_timeout:
+                time_check = min(time_check, time_progress + self.task_stall_timeout)
+        return time_check
+
+    # Last time when the workers of the started task received data
+    def getTaskProgressTime(self, task):
+        time_progress = task["time_started"]
+        for worker in self.findWorkers(task):
+            connection = worker.peer.connection
+            if connection and connection.last_recv_time > time_progress:
+                time_progress = connection.last_recv_time
+        return time_progress
+
+    def scheduleTaskCheck(self, task, time_check=None):
+        if time_check is None:
+            time_check = self.getTaskCheckTime(task)
+        if task["time_check"] == time_check:
+            return False  # Already scheduled
+        task["time_check"] = time_check
+        heapq.heappush(self.task_checks, (time_check, task["id"], task))
+        if self.task_checks[0][2] is task:  # Became the next one, recalculate the checker wait time
+            self.event_check.set()
+        return True
+
+    # Wake up the workers waiting for a task
+    def onTaskChanged(self):
+        event_task_changed, self.event_task_changed = self.event_task_changed, gevent.event.Event()
+        event_task_changed.set()
+
+    # Wait until a task added, done, failed or a worker left it
+    def waitTaskChange(self, timeout=None):
+        if timeout is not None:
+            timeout = max(0, timeout)
+        return self.event_task_changed.wait(timeout)
+
+    # Check all tasks as soon as possible (max once per sec)
+    def checkTasksSoon(self):
+        self.check_all = True
+        self.event_check.set()
+
+    # Pop the tasks that reached their check time
+    def popDueTasks(self, now):
+        tasks = []
+        while self.task_checks and self.task_checks[0][0] <= now:
+            time_check, task_id, task = heapq.heappop(self.task_checks)
+            if task["done"] or task["time_check"] != time_check:
+                continue  # Outdated entry
+            tasks.append(task)
+        return tasks
+
+    # Check expired tasks when their check time reached or something changed
     def checkTasks(self):
         while self.running:
             tasks = task = worker = workers = None  # Cleanup local variables
             announced = False
-            time.sleep(15)  # Check every 15 sec
+
+            if not self.tasks:
+                self.task_checks = []
+            wakeups = []
+            if self.check_all:
+                wakeups.append(self.time_check_all + 1)
+            if self.task_checks:
+                wakeups.append(self.task_checks[0][0])
+            if wakeups:
+                timeout = max(0, min(wakeups) - time.time())
+            else:
+                timeout = None  # Nothing to do until new task added
+            self.event_check.wait(timeout)
+            self.event_check.clear()
+
+            now = time.time()
+            tasks = self.popDueTasks(now)
+            if self.check_all and now >= self.time_check_all + 1:
+                self.check_all = False
+                self.time_check_all = now
+                tasks = self.tasks[:]  # Copy it so removing elements wont cause any problem
 
             # Clean up workers
             for worker in list(self.workers.values()):
                 if worker.task and worker.task["done"]:
                     worker.skip(reason="Task done")  # Stop workers with task done
 
-            if not self.tasks:
+            if not tasks:
                 continue
 
-            tasks = self.tasks[:]  # Copy it so removing elements wont cause any problem
-            num_tasks_started = len([task for task in tasks if task["time_started"]])
+            num_tasks_started = len([task for task in self.tasks if task["time_started"]])
 
             self.log.debug(
-                "Tasks: %s, started: %s, bad files: %s, total started: %s" %
-                (len(tasks), num_tasks_started, len(self.site.bad_files), self.started_task_num)
+                "Tasks: %s, checking: %s, started: %s, bad files: %s, total started: %s" %
+                (len(self.tasks), len(tasks), num_tasks_started, len(self.site.bad_files), self.started_task_num)
             )
 
             for task in tasks:
-                if task["time_started"] and time.time() >= task["time_started"] + 60:
-                    self.log.debug("Timeout, Skipping: %s" % task)  # Task taking too long time, skip it
+                if task["done"]:
+                    continue
+
+                if task["time_started"]:
+                    time_progress = self.getTaskProgressTime(task)
+                else:
+                    time_progress = None
+
+                if task["time_started"] and (now >= task["time_started"] + 60 or now >= time_progress + self.task_stall_timeout):
+                    self.log.debug("Timeout, Skipping: %s" % task)  # Task taking too long time or stalled, skip it
                     # Skip to next file workers
                     workers = self.findWorkers(task)
                     if workers:
@@ -74,8 +170,11 @@ class WorkerManager(object):
                 elif time.time() >= task["time_added"] + 60 and not self.workers:  # No workers left
                     self.failTask(task, reason="Timeout")
 
-                elif (task["time_started"] and time.time() >= task["time_started"] + 15) or not self.workers:
-                    # Find more workers: Task started more than 15 sec ago or no workers
+                elif (
+                    task["time_started"] and (now >= (task["time_slow"] or task["time_started"]) + 15 or now >= time_progress + self.task_stall_time)
+                ) or not self.workers:
+                    # Find more workers: Task started (or found slow) more than 15 sec ago, its workers stalled or no workers
+                    task["time_slow"] = now
                     workers = self.findWorkers(task)
                     self.log.debug(
                         "Slow task: %s, (workers: %s, optional_hash_id: %s, peers: %s, failed: %s, asked: %s)" %
@@ -107,9 +206,12 @@ class WorkerManager(object):
                     else:
                         if task["peers"]:  # Release the peer lock
                             self.log.debug("Task peer lock release: %s" % task["inner_path"])
-                            task["peers"] = []
+                            self.tasks.setTaskPeers(task, set())
                         self.startWorkers(reason="Task checker")
 
+                if not task["done"] and (task["time_check"] is None or task["time_check"] <= now):
+                    self.scheduleTaskCheck(task, self.getTaskCheckTime(task, now))
+
             if len(self.tasks) > len(self.workers) * 2 and len(self.workers) < self.getMaxWorkers():
                 self.startWorkers(reason="Task checker (need more workers)")
 
@@ -117,16 +219,21 @@ class WorkerManager(object):
 
     # Returns the next free or less worked task
     def getTask(self, peer):
-        for task in self.tasks:  # Find a task
-            if task["peers"] and peer not in task["peers"]:
-                continue  # This peer not allowed to pick this task
+        found = None
+        for task in self.tasks.open_tasks:  # Find the first task that any peer can pick
             if peer in task["failed"]:
                 continue  # Peer already tried to solve this, but failed
-            if task["optional_hash_id"] and task["peers"] is None:
-                continue  # No peers found yet for the optional task
             if task["done"]:
                 continue
-            return task
+            found = task
+            break
+
+        for task in self.tasks.getPeerTasks(peer):  # Tasks locked to this peer
+            if peer in task["failed"] or task["done"]:
+                continue
+            if not found or self.tasks.valueToItem(task)[0:2] < self.tasks.valueToItem(found)[0:2]:
+                found = task
+        return found
 
     def removeSolvedFileTasks(self, mark_as_good=True):
         for task in self.tasks[:]:
@@ -137,6 +244,7 @@ class WorkerManager(object):
                 self.tasks.remove(task)
         if not self.tasks:
             self.started_task_num = 0
+        self.onTaskChanged()
         self.site.updateWebsocket()
 
     # New peers added to site
@@ -170,14 +278,24 @@ class WorkerManager(object):
         else:  # We have worker for this peer or its over the limit
             return False
 
+    # Keep more requests outstanding to a peer that completes the tasks
+    def startPipelineWorker(self, peer):
+        if config.worker_pipeline <= 1 or len(self.workers) >= self.getMaxWorkers():
+            return False
+        if len([worker for worker in list(self.workers.values()) if worker.peer is peer]) >= config.worker_pipeline:
+            return False
+        task = self.getTask(peer)
+        if not task or task["workers_num"]:
+            return False  # No free task for the peer
+        return self.addWorker(peer, multiplexing=True)
+
     def taskAddPeer(self, task, peer):
-        if task["peers"] is None:
-            task["peers"] = []
         if peer in task["failed"]:
+            if task["peers"] is None:
+                self.tasks.setTaskPeers(task, set())
             return False
 
-        if peer not in task["peers"]:
-            task["peers"].append(peer)
+        self.tasks.addTaskPeer(task, peer)
         return True
 
     # Start workers to process tasks
@@ -222,12 +340,11 @@ class WorkerManager(object):
             if not peer.has_hashfield:
                 continue
 
-            hashfield_set = set(peer.hashfield)  # Finding in set is much faster
             for task in optional_tasks:
                 optional_hash_id = task["optional_hash_id"]
-                if optional_hash_id in hashfield_set:
+                if optional_hash_id in peer.hashfield:
                     if reset_task and len(task["failed"]) > 0:
-                        task["failed"] = []
+                        task["failed"] = set()
                     if peer in task["failed"]:
                         continue
                     if self.taskAddPeer(task, peer):
@@ -243,9 +360,8 @@ class WorkerManager(object):
             if not peer.has_hashfield:
                 continue
 
-            hashfield_set = set(peer.hashfield)  # Finding in set is much faster
             for optional_hash_id in optional_hash_ids:
-                if optional_hash_id in hashfield_set:
+                if optional_hash_id in peer.hashfield:
                     found[optional_hash_id].append(peer)
                     if limit and len(found[optional_hash_id]) >= limit:
                         optional_hash_ids.remove(optional_hash_id)
@@ -436,6 +552,8 @@ class WorkerManager(object):
             elif self.tasks and not self.workers and worker.task and len(worker.task["failed"]) < 20:
                 self.log.debug("Starting new workers... (tasks: %s)" % len(self.tasks))
                 self.startWorkers(reason="Removed worker")
+        if self.tasks and not self.workers:
+            self.checkTasksSoon()  # No workers left, don't wait for the next scheduled check
 
     # Tasks sorted by this
     def getPriorityBoost(self, inner_path):
@@ -464,18 +582,18 @@ class WorkerManager(object):
         if priority > task["priority"]:
             self.tasks.updateItem(task, "priority", priority)
         if peer and task["peers"]:  # This peer also has new version, add it to task possible peers
-            task["peers"].append(peer)
+            self.tasks.addTaskPeer(task, peer)
             self.log.debug("Added peer %s to %s" % (peer.key, task["inner_path"]))
             self.startWorkers([peer], reason="Added new task (update received by peer)")
         elif peer and peer in task["failed"]:
-            task["failed"].remove(peer)  # New update arrived, remove the peer from failed peers
+            task["failed"].discard(peer)  # New update arrived, remove the peer from failed peers
             self.log.debug("Removed peer %s from failed %s" % (peer.key, task["inner_path"]))
             self.startWorkers([peer], reason="Added new task (peer failed before)")
 
     def addTaskCreate(self, inner_path, peer, priority=0, file_info=None):
         evt = gevent.event.AsyncResult()
         if peer:
-            peers = [peer]  # Only download from this peer
+            peers = {peer}  # Only download from this peer
         else:
             peers = None
         if not file_info:
@@ -505,11 +623,13 @@ class WorkerManager(object):
         task = {
             "id": self.next_task_id, "evt": evt, "workers_num": 0, "site": self.site, "inner_path": inner_path, "done": False,
             "optional_hash_id": optional_hash_id, "time_added": time.time(), "time_started": None, "lock": None,
-            "time_action": None, "peers": peers, "priority": priority, "failed": [], "size": size
+            "time_action": None, "time_check": None, "time_slow": None, "peers": peers, "priority": priority, "failed": set(), "size": size
         }
 
         self.tasks.append(task)
         self.lock_add_task.release()
+        self.scheduleTaskCheck(task)
+        self.onTaskChanged()
 
         self.next_task_id += 1
         self.started_task_num += 1
@@ -557,6 +677,8 @@ class WorkerManager(object):
         if len(task["failed"]) >= len(self.workers):
             fail_reason = "Too many fails: %s (workers: %s)" % (len(task["failed"]), len(self.workers))
             self.failTask(task, reason=fail_reason)
+        if task["workers_num"] == 0:
+            self.onTaskChanged()
 
     # Wait for other tasks
     def checkComplete(self):
@@ -582,6 +704,7 @@ class WorkerManager(object):
             self.site.content_manager.optionalDownloaded(task["inner_path"], task["optional_hash_id"], task["size"])
         self.site.onFileDone(task["inner_path"])
         task["evt"].set(True)
+        self.onTaskChanged()
         if not self.tasks:
             self.site.greenlet_manager.spawn(self.checkComplete)
 
@@ -596,5 +719,6 @@ class WorkerManager(object):
         task["done"] = True
         self.site.onFileFail(task["inner_path"])
         task["evt"].set(False)
+        self.onTaskChanged()
         if not self.tasks:
             self.site.greenlet_manager.spawn(self.checkComplete)
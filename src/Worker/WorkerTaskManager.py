@@ -1,4 +1,5 @@
 import bisect
+import collections
 from collections.abc import MutableSequence
 
 
@@ -84,23 +85,29 @@ class CustomSortedList(MutableSequence):
             return False
 
 
-class WorkerTaskManager(CustomSortedList):
-    def __init__(self):
-        super().__init__()
-        self.inner_paths = {}
-
+class WorkerTaskList(CustomSortedList):
     def getPriority(self, value):
         return 0 - (value["priority"] - value["workers_num"] * 10)
 
     def getId(self, value):
         return value["id"]
 
+
+class WorkerTaskManager(WorkerTaskList):
+    def __init__(self):
+        super().__init__()
+        self.inner_paths = {}
+        self.open_tasks = WorkerTaskList()  # Tasks that any peer can pick, same order as the main list
+        self.peer_tasks = collections.defaultdict(dict)  # Tasks locked to peers, Key: peer, Value: {task id: task}
+
     def __contains__(self, value):
         return value["inner_path"] in self.inner_paths
 
     def __delitem__(self, index):
+        task = self.items[index][2]
         # Remove from inner path cache
-        del self.inner_paths[self.items[index][2]["inner_path"]]
+        del self.inner_paths[task["inner_path"]]
+        self.unindexTask(task)
         super().__delitem__(index)
 
     # Fast task search by inner_path
@@ -111,6 +118,7 @@ class WorkerTaskManager(CustomSortedList):
         super().append(task)
         # Create inner path cache for faster lookup by filename
         self.inner_paths[task["inner_path"]] = task
+        self.indexTask(task)
 
     def remove(self, task):
         if task not in self:
@@ -120,3 +128,64 @@ class WorkerTaskManager(CustomSortedList):
 
     def findTask(self, inner_path):
         return self.inner_paths.get(inner_path, None)
+
+    # Peer eligibility index
+
+    def isOpen(self, task):
+        if task.get("optional_hash_id") and task.get("peers") is None:
+            return False  # No peers found yet for the optional task
+        return not task.get("peers")
+
+    def indexTask(self, task):
+        if self.isOpen(task):
+            self.open_tasks.append(task)
+        else:
+            for peer in task["peers"] or []:
+                self.peer_tasks[peer][task["id"]] = task
+
+    def unindexTask(self, task):
+        if self.isOpen(task):
+            try:
+                self.open_tasks.remove(task)
+            except ValueError:
+                pass
+        else:
+            for peer in task["peers"] or []:
+                peer_tasks = self.peer_tasks.get(peer)
+                if peer_tasks:
+                    peer_tasks.pop(task["id"], None)
+                    if not peer_tasks:
+                        del self.peer_tasks[peer]
+
+    def isIndexed(self, task):
+        return self.inner_paths.get(task["inner_path"]) is task
+
+    # Allow the peer to pick the task
+    def addTaskPeer(self, task, peer):
+        if task["peers"] and peer in task["peers"]:
+            return False
+        is_indexed = self.isIndexed(task)
+        if is_indexed:
+            self.unindexTask(task)
+        if task["peers"] is None:
+            task["peers"] = set()
+        task["peers"].add(peer)
+        if is_indexed:
+            self.indexTask(task)
+        return True
+
+    # Replace the peers that allowed to pick the task (empty: any peer)
+    def setTaskPeers(self, task, peers):
+        is_indexed = self.isIndexed(task)
+        if is_indexed:
+            self.unindexTask(task)
+        task["peers"] = peers
+        if is_indexed:
+            self.indexTask(task)
+
+    # Tasks locked to the peer
+    def getPeerTasks(self, peer):
+        peer_tasks = self.peer_tasks.get(peer)
+        if not peer_tasks:
+            return []
+        return list(peer_tasks.values())
@@ -156,6 +156,12 @@ class Actions(object):
         gevent.joinall([gevent.spawn(ui_server.start), gevent.spawn(file_server.start)])
         logging.info("All server stopped")
 
+        from Site import SiteManager
+        for site in list(SiteManager.site_manager.sites.values()):
+            if not site.isLoaded():
+                continue
+            site.storage.flushDbUpdates()  # Write the pending json file changes to the db
+
     # Site commands
 
     def siteCreate(self, use_master_seed=True):
@@ -246,6 +252,17 @@ class Actions(object):
         site = Site(address)
         bad_files = []
 
+        # Check the signs in parallel first, the content.json verification below uses the cached results
+        sign_items = []
+        for content_inner_path, content in site.content_manager.contents.items():
+            if "modified" not in content:
+                continue
+            sign_content = site.content_manager.getSignContent(content)
+            for sign_address, sign in content.get("signs", {}).items():
+                sign_items.append((sign_content, sign_address, sign))
+        logging.info("Checking %s signs..." % len(sign_items))
+        site.content_manager.verifySigns(sign_items)
+
         for content_inner_path in site.content_manager.contents:
             s = time.time()
             logging.info("Verifing %s signature..." % content_inner_path)
@@ -0,0 +1,58 @@
+import io
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Supported compression methods in order of preference
+def getSupported():
+    if zstandard:
+        return ["zstd", "zlib"]
+    else:
+        return ["zlib"]
+
+
+# Select the most preferred method supported by both side
+# Return: Compression method name or None if no common method found
+def select(remote_supported):
+    for method in getSupported():
+        if method in remote_supported:
+            return method
+    return None
+
+
+def compress(data, method):
+    if method == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    elif method == "zlib":
+        return zlib.compress(data, 6)
+    else:
+        raise Exception("Unsupported compression: %s" % method)
+
+
+# Decompress the data, raise exception if the result would be larger than max_size
+def decompress(data, method, max_size):
+    if method == "zstd" and zstandard:
+        reader = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data))
+        parts = []
+        size = 0
+        while size <= max_size:
+            part = reader.read(max_size + 1 - size)
+            if not part:
+                break
+            parts.append(part)
+            size += len(part)
+        if size > max_size:
+            raise Exception("Decompressed data too large")
+        return b"".join(parts)
+    elif method == "zlib":
+        decompressor = zlib.decompressobj()
+        back = decompressor.decompress(data, max_size)
+        if decompressor.unconsumed_tail:
+            raise Exception("Decompressed data too large")
+        return back
+    else:
+        raise Exception("Unsupported compression: %s" % method)
@@ -17,7 +17,8 @@ def msgpackHeader(size):
         raise Exception("huge binary string")
 
 
-def stream(data, writer):
+# File objects sent using file_writer(file, size) if specified
+def stream(data, writer, file_writer=None):
     packer = msgpack.Packer(use_bin_type=True)
     writer(packer.pack_map_header(len(data)))
     for key, val in data.items():
@@ -27,6 +28,9 @@ def stream(data, writer):
             size = min(max_size, val.read_bytes)
             bytes_left = size
             writer(msgpackHeader(size))
+            if file_writer:
+                file_writer(val, size)
+                continue
             buff = 1024 * 64
             while 1:
                 writer(val.read(min(bytes_left, buff)))
@@ -49,6 +49,12 @@ class ThreadPool:
         else:
             return t.get()
 
+    # Call func for every item of the iterable in the pool, yield the results as they finish
+    def imapUnordered(self, func, iterable, maxsize=None):
+        if self.pool is None or not isMainThread():
+            return map(func, iterable)
+        return self.pool.imap_unordered(func, iterable, maxsize=maxsize)
+
     def kill(self):
         if self.pool is not None and self.pool.size > 0 and main_loop:
             main_loop.call(lambda: gevent.spawn(self.pool.kill).join(timeout=1))
@@ -8,8 +8,10 @@ import time
 import logging
 import base64
 import json
+import io
 
 import gevent
+import gevent.socket
 
 from Config import config
 
@@ -181,6 +183,34 @@ def getFilesize(path):
         return None
 
 
+# Check if the file can be sent using zero-copy os.sendfile
+def isSendfileSupported(file):
+    if not hasattr(os, "sendfile"):
+        return False
+    try:
+        return stat.S_ISREG(os.fstat(file.fileno()).st_mode)
+    except (AttributeError, io.UnsupportedOperation, OSError):
+        return False
+
+
+# Send part of a regular file to a non-tls socket using os.sendfile
+# Return: Number of bytes sent (less than count if end of file reached)
+def sendfile(sock, file, offset, count):
+    sock_fileno = sock.fileno()
+    file_fileno = file.fileno()
+    bytes_sent = 0
+    while bytes_sent < count:
+        try:
+            sent = os.sendfile(sock_fileno, file_fileno, offset + bytes_sent, count - bytes_sent)
+        except BlockingIOError:  # Socket buffer full
+            gevent.socket.wait_write(sock_fileno, timeout=sock.gettimeout())
+            continue
+        if sent == 0:  # End of file
+            break
+        bytes_sent += sent
+    return bytes_sent
+
+
 # Convert hash to hashid for hashfield
 def toHashId(hash):
     return int(hash[0:4], 16)